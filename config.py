@@ -34,8 +34,22 @@ CONFIG = {
     "xml_name":"default",
     "force_reload": False,
     "sample_edges":"sparse",
+    "neg_sampling_ratio": 1.0,
+    "negative_pools": None,
     "gen_sparse_edges": True,
     "train_edge_features": False,
+    "on_disk": False,
+    "node_budget": None,
+    "precompute_gcn_norm": False,
+    "metrics_interval": 1,
+    "auc_bins": None,
+    "ann_decoding": False,
+    "ann_min_vocab": 50000,
+    "ann_probes": 8,
+    "precision": "fp32",
+    "compile": False,
+    "compile_mode": None,
+    "compile_bucket_growth": 1.5,
 }
 
 MATHML_TAGS = [
@@ -11,6 +11,7 @@ from torch_geometric.nn import GraphSAGE, GCNConv, GraphConv
 # from .tests import test_proprocessing as test_prepro
 import utils.stats as stats
 import utils.plot as plot
+import utils.bench as bench
 from models import train, search, test
 from torch.utils.data.dataset import random_split
 from torch_geometric.utils import negative_sampling
@@ -25,14 +26,18 @@ if __name__=="__main__":
     parser.add_argument("-se", "--search", action="store_true", help="Default False. Search hyperparams")
     parser.add_argument("-st", "--stats", action="store_true", help="Default False. Create stats")
     parser.add_argument("-pl", "--plot", action="store_true", help="Default False. Create plots")
+    parser.add_argument("-be", "--bench", choices=["remove_commands","dataset_load","loader","gcn_norm","metrics_interval","embedding_index","dense_decoding","negative_sampling","negative_pool","precision","compile"], help="Run a micro benchmark", default=None)
     # Naming things
     parser.add_argument("-ln", "--latex_name", choices=["OleehyO","sample","Pfahler"], help="Name of the latex Set",default="OleehyO")
     parser.add_argument("-vn", "--vocab_name", choices=["concat","combined","split"], help="Name of the vocab method", default="concat")
     parser.add_argument("-xn", "--xml_name", help="Name of the xml dataset", default="default",)
     parser.add_argument("-mn", "--model_name", help="Name of the model for training", default="default",)
     # Params
-    parser.add_argument("-fr", "--force_reload", action="store_true", help="Default False. Force reload the preprocessing")
+    parser.add_argument("-fr", "--force_reload", action="store_true", help="Default False. Force reload the preprocessing, an interrupted XML conversion then starts over")
     parser.add_argument("-d", "--debug", action="store_true", help="Default False. debug")
+    parser.add_argument("-nw", "--num_workers", help="Number of KaTeX worker processes, and of graph building processes, used for preprocessing. Default: all cores for KaTeX, one process for the graphs", default=None, type=int)
+    parser.add_argument("-fu", "--fused", action="store_true", help="Default False. Count the vocab while building the graphs, in a single pass over the equations")
+    parser.add_argument("-ns", "--num_shards", help="Convert the equations in this many shards, each in its own process. Default: no sharding", default=None, type=int)
 
     parser.add_argument("-e", "--epochs", help="Number of epochs for training", default=200, type=int)
     # parser.add_argument("-oh", "--one_hot", help="OneHot method(s) as list", nargs='*', default=[], choices=["concat","tag","pos"])
@@ -50,6 +55,9 @@ if __name__=="__main__":
     force_reload = args.force_reload
     debug = args.debug
     epochs = args.epochs 
+    num_workers = args.num_workers
+    num_shards = args.num_shards
+    fused = args.fused
     # one_hot = args.one_hot
     # embed = args.embed
     # linear = args.linear
@@ -68,9 +76,10 @@ if __name__=="__main__":
 
     if args.preprocess:      
         print("Starting preprocessing...")
-        mathml = MathmlDataset.MathmlDataset(xml_name,latex_set=latex_set,debug=debug, force_reload=True)
-        vocab = VocabBuilder.VocabBuilder(xml_name,vocab_type=vocab_type, debug=debug, reload_vocab=False, reload_xml_elements=False)
-        dataset = GraphDataset.GraphDataset(mathml.xml_dir,vocab, force_reload=True, debug=debug, max_num_nodes=100)
+        # Without -fr an interrupted conversion resumes after its last committed batch
+        mathml = MathmlDataset.MathmlDataset(xml_name,latex_set=latex_set,debug=debug, force_reload=force_reload, num_workers=num_workers, num_shards=num_shards)
+        vocab = VocabBuilder.VocabBuilder(xml_name,vocab_type=vocab_type, debug=debug, reload_vocab=False, reload_xml_elements=False, fused=fused)
+        dataset = GraphDataset.GraphDataset(mathml.xml_dir,vocab, force_reload=True, debug=debug, max_num_nodes=100, num_workers=num_workers)
         print(f"Pre-processed the Dataset '{latex_set}', generated a vocab with the method '{vocab_type}', and is saved into '{mathml.xml_dir}'")
         print(f"The generated dataset contains {len(dataset)} graphs")
 
@@ -84,7 +93,7 @@ if __name__=="__main__":
         vocab = VocabBuilder.VocabBuilder(xml_name,vocab_type=vocab_type, debug=debug, reload_vocab=False, reload_xml_elements=False)
         dataset = GraphDataset.GraphDataset(mathml.xml_dir,vocab, force_reload=False, debug=debug, max_num_nodes=100)
 
-        graph = dataset.get_graph_list()[-1]
+        graph = dataset.get_graph(-1)
         plot.plot_graph(graph)
 
     if args.train:
@@ -119,6 +128,29 @@ if __name__=="__main__":
         # test.test_all_models(model_name)
         test.main(model_name)
 
+    if args.bench == "remove_commands":
+        bench.bench_remove_commands(latex_set)
+    elif args.bench == "dataset_load":
+        bench.bench_dataset_load(xml_name, vocab_type)
+    elif args.bench == "loader":
+        bench.bench_loader(xml_name)
+    elif args.bench == "gcn_norm":
+        bench.bench_gcn_norm(xml_name)
+    elif args.bench == "metrics_interval":
+        bench.bench_metrics_interval(xml_name)
+    elif args.bench == "embedding_index":
+        bench.bench_embedding_index()
+    elif args.bench == "dense_decoding":
+        bench.bench_dense_decoding(xml_name)
+    elif args.bench == "negative_sampling":
+        bench.bench_negative_sampling(xml_name)
+    elif args.bench == "negative_pool":
+        bench.bench_negative_pool(xml_name)
+    elif args.bench == "precision":
+        bench.bench_precision(xml_name)
+    elif args.bench == "compile":
+        bench.bench_compile(xml_name)
+
     if args.stats:
         # stats.xml_occurences()
         # stats.count_text_occurences_per_tag()
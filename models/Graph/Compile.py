@@ -0,0 +1,169 @@
+import math
+
+import torch
+import torch.nn.functional as F
+from torch import Tensor
+from torch_geometric.nn.models.autoencoder import MAX_LOGSTD
+
+from models.Graph.GraphAutoEncoder import EPS, METHODS, GraphVAE
+
+
+def bucket_size(size, min_size=64, growth=1.5, multiple=64):
+    """
+    Smallest bucket of at least ```size + 2``` (room for two padding nodes). The buckets grow
+    geometrically from ```min_size``` and are rounded up to a ```multiple```, so there are few of
+    them and the padding is at most ```growth``` times the size.
+    """
+    bucket = min_size
+    while bucket < size + 2:
+        bucket = int(math.ceil(bucket * growth / multiple) * multiple)
+    return bucket
+
+
+def pad_nodes(x: Tensor, size):
+    """Zero features for the padding nodes"""
+    return torch.cat([x, x.new_zeros(size - x.size(0), *x.shape[1:])])
+
+
+def pad_edges(edge_index: Tensor, edge_weight: Tensor, size, pad_edge):
+    """
+    Padding edges are copies of ```pad_edge```, with a weight of 0.
+
+    Returns:
+    - edge_index, edge_weight (None if it was), mask of the real edges
+    """
+    num_pad = size - edge_index.size(1)
+    mask = torch.cat([edge_index.new_ones(edge_index.size(1), dtype=torch.bool), edge_index.new_zeros(num_pad, dtype=torch.bool)])
+    edge_index = torch.cat([edge_index, pad_edge.expand(2, num_pad)], dim=1)
+    if edge_weight is not None:
+        edge_weight = torch.cat([edge_weight, edge_weight.new_zeros(num_pad, *edge_weight.shape[1:])])
+    return edge_index, edge_weight, mask
+
+
+def masked_mean(values: Tensor, mask: Tensor):
+    mask = mask.to(values.dtype)
+    return (values * mask).sum() / mask.sum().clamp(min=1)
+
+
+class CompiledStep():
+    """
+    The encode -> decode -> loss step of a ```GraphVAE``` run through ```torch.compile```.
+
+    torch.compile specialises its graph on the input shapes, and every batch has its own number of
+    nodes and edges. The nodes and each edge list are padded up to a bucket (see ```bucket_size```),
+    so the step is compiled once per bucket combination instead of once per batch. A loader with a
+    ```node_budget``` keeps most batches in one node bucket.
+
+    The padding nodes have zero features and are only joined by the padding edges, all between the
+    last two nodes, so the real nodes get the same messages as in eager mode, and the batch norms
+    compute their statistics on the real nodes only. The padding edges aren't self-loops,
+    which GCNConv would replace by one loop per node and so change the number of edges from a batch
+    to the next. The losses are means over the real nodes and edges. Reconstructed edges dropped by
+    the decoder are moved onto the padding nodes instead of being removed, which keeps their number
+    that of the bucket. This needs sparse edges: the dense adjacency decoding has a data-dependent
+    shape.
+
+    Args:
+    - model (GraphVAE): model run by the step
+    - growth (float): growth factor of the buckets
+    - compile_kwargs: passed to ```torch.compile``` (mode, backend, ...)
+    """
+    def __init__(self, model: GraphVAE, growth=1.5, **compile_kwargs):
+        if not model.sparse_edges:
+            raise ValueError("The compiled step needs gen_sparse_edges, the dense decoding isn't shape-stable")
+        self.model = model
+        self.growth = growth
+        self.buckets = set()
+        # Recompiled for each bucket combination and for train/eval, the limit is only raised while
+        # the step runs (see ```__call__```)
+        self.cache_size_limit = max(torch._dynamo.config.cache_size_limit, 64)
+        self.step = torch.compile(padded_step, dynamic=False, **compile_kwargs)
+
+    def __call__(self, x, encoder_edge_index, encoder_edge_weight, pos_edge_index, neg_edge_index, edge_weight=None, alpha=1, beta=0, gamma=0, variational=False):
+        """
+        Args are those of ```GraphVAE.encode``` and ```GraphVAE.recon_full_loss```, the edges of
+        the encoder being given apart (see ```encoder_edges```).
+
+        Returns:
+        - loss (Tensor), with the KL loss when ```variational```
+        - z (Tensor), x_recon (Tensor): of the real nodes
+        """
+        num_nodes = x.size(0)
+        num_padded = bucket_size(num_nodes, growth=self.growth)
+        pad_edge = torch.tensor([[num_padded - 2], [num_padded - 1]], device=x.device)
+
+        x = pad_nodes(x, num_padded)
+        node_mask = torch.arange(num_padded, device=x.device) < num_nodes
+        sizes = [num_padded]
+        encoder_edge_index, encoder_edge_weight, _ = self.pad(encoder_edge_index, encoder_edge_weight, pad_edge, sizes)
+        pos_edge_index, edge_weight, pos_mask = self.pad(pos_edge_index, edge_weight, pad_edge, sizes)
+        neg_edge_index, _, neg_mask = self.pad(neg_edge_index, None, pad_edge, sizes)
+        self.buckets.add((self.model.training, *sizes))
+
+        with torch._dynamo.config.patch(cache_size_limit=self.cache_size_limit):
+            loss, z, x_recon = self.step(
+                self.model, x, node_mask, encoder_edge_index, encoder_edge_weight, pos_edge_index, pos_mask,
+                neg_edge_index, neg_mask, edge_weight, pad_edge, alpha, beta, gamma, variational
+            )
+        return loss, z[:num_nodes], x_recon[:num_nodes]
+
+    def pad(self, edge_index, edge_weight, pad_edge, sizes):
+        size = bucket_size(edge_index.size(1), growth=self.growth)
+        sizes.append(size)
+        return pad_edges(edge_index, edge_weight, size, pad_edge)
+
+
+def padded_step(model: GraphVAE, x, node_mask, encoder_edge_index, encoder_edge_weight, pos_edge_index, pos_mask, neg_edge_index, neg_mask, edge_weight, pad_edge, alpha, beta, gamma, variational):
+    """
+    Same loss as ```GraphVAE.encode``` then ```GraphVAE.recon_full_loss``` (and ```kl_loss```), on
+    padded inputs and with the means taken over the real nodes and edges only.
+    """
+    # Encoding
+    mu, logstd = model.encoder(x, encoder_edge_index, encoder_edge_weight, node_mask=node_mask)
+    logstd = logstd.clamp(max=MAX_LOGSTD)
+    z = model.reparametrize(mu, logstd)
+
+    # Decoding, see ```GraphVAE.decode_all```
+    pos_pred = model.decoder(z, pos_edge_index, sigmoid=True)
+    kept = (pos_pred > 0.5) & pos_mask
+    recon_edge_index = torch.where(kept, pos_edge_index, pad_edge)
+    e_recon = model.decoder.edge_decoder(z, recon_edge_index) if model.edge_features else None
+    x_recon = model.decoder.node_decoder(z, recon_edge_index, e_recon, node_mask=node_mask)
+
+    e_recon = None
+    if edge_weight is not None and gamma != 0 and model.edge_features:
+        e_recon = model.decoder.edge_decoder(z, pos_edge_index)
+
+    # Losses in fp32, see ```GraphVAE.recon_full_loss```
+    with torch.autocast(x.device.type, enabled=False):
+        z, x, x_recon, pos_pred = z.float(), x.float(), x_recon.float(), pos_pred.float()
+
+        neg_pred = model.decoder(z, neg_edge_index, sigmoid=True)
+        adj_loss = masked_mean(-torch.log(pos_pred + EPS), pos_mask) + masked_mean(-torch.log(1 - neg_pred + EPS), neg_mask)
+
+        if model.embedding_method["loss"] == "cross_entropy":
+            node_loss = F.cross_entropy(x_recon, x, reduction="none")
+        elif model.embedding_method["loss"] == "mse":
+            node_loss = F.mse_loss(x_recon, x, reduction="none").mean(dim=1)
+        elif model.embedding_method["loss"] == "cosine":
+            target = x.new_ones(x.size(0))
+            node_loss = F.cosine_embedding_loss(x_recon, x, target, margin=0.0, reduction="none")
+        else:
+            raise ValueError(f"Invalid embedding method. Expected one of {METHODS['loss']}, but got {model.embedding_method['loss']}")
+        node_loss = masked_mean(node_loss, node_mask)
+
+        edge_loss = 0
+        if e_recon is not None:
+            e_recon = e_recon.float()
+            if model.decoder.edge_dim == 1:
+                edge_loss = masked_mean(F.binary_cross_entropy_with_logits(e_recon, edge_weight.float(), reduction="none"), pos_mask)
+            else:
+                edge_loss = masked_mean(F.cross_entropy(e_recon, edge_weight.float(), reduction="none"), pos_mask)
+
+        loss = alpha * adj_loss + beta * node_loss + gamma * edge_loss
+        if variational:
+            mu, logstd = mu.float(), logstd.float()
+            kl = -0.5 * masked_mean(torch.sum(1 + 2 * logstd - mu**2 - logstd.exp()**2, dim=1), node_mask)
+            loss = loss + kl / node_mask.sum()
+
+    return loss, z, x_recon
@@ -0,0 +1,98 @@
+import math
+
+import torch
+import torch.nn.functional as F
+from torch import Tensor
+
+
+class EmbeddingIndex():
+    """
+    Inverted file (IVF) index of the rows of an embedding table for cosine nearest neighbour search.
+
+    The normalised rows are clustered by a spherical k-means into ```num_lists``` lists. A query
+    is only compared with the rows of the ```num_probes``` lists whose centroids are the closest,
+    so a search costs about ```num_lists + num_probes * rows / num_lists``` dot products instead of
+    one per row. The result is approximate: the nearest row can be missed when it's in a list that
+    isn't probed. Probing all the lists gives the exact result.
+
+    Args:
+    - weight (Tensor): (num_rows, dim) embedding table
+    - num_lists (int): number of lists, sqrt(num_rows) by default
+    - num_probes (int): number of lists searched per query
+    - iterations (int): k-means iterations
+    - sample_size (int): number of rows the k-means is trained on, per list
+    - seed (int): seed of the k-means initialisation
+    """
+    def __init__(self, weight: Tensor, num_lists=None, num_probes=8, iterations=10, sample_size=256, seed=0):
+        weight = F.normalize(weight.detach().float(), p=2, dim=1)
+        self.num_rows = weight.size(0)
+        self.num_lists = num_lists or max(1, int(math.sqrt(self.num_rows)))
+        self.num_probes = min(num_probes, self.num_lists)
+
+        generator = torch.Generator().manual_seed(seed)
+        sample = torch.randperm(self.num_rows, generator=generator)[:self.num_lists * sample_size].to(weight.device)
+        self.centroids = self.kmeans(weight[sample], iterations, generator)
+
+        # Rows sorted by list, the rows of list l are rows[offsets[l]:offsets[l + 1]]
+        assignment = self.assign(weight)
+        self.rows = torch.argsort(assignment, stable=True)
+        counts = torch.bincount(assignment, minlength=self.num_lists)
+        self.offsets = torch.cat([counts.new_zeros(1), counts.cumsum(0)]).tolist()
+        self.weight = weight[self.rows]
+
+    def kmeans(self, points, iterations, generator):
+        """Spherical k-means, returns the normalised centroids"""
+        init = torch.randperm(points.size(0), generator=generator)[:self.num_lists].to(points.device)
+        centroids = points[init]
+        if centroids.size(0) < self.num_lists:
+            # Fewer points than lists: the extra lists stay empty
+            centroids = torch.cat([centroids, centroids.new_zeros(self.num_lists - centroids.size(0), points.size(1))])
+
+        for _ in range(iterations):
+            assignment = self.assign(points, centroids)
+            sums = torch.zeros_like(centroids).index_add_(0, assignment, points)
+            empty = torch.bincount(assignment, minlength=self.num_lists) == 0
+            # Empty lists keep their centroid
+            centroids = torch.where(empty.unsqueeze(1), centroids, F.normalize(sums, p=2, dim=1))
+        return centroids
+
+    def assign(self, points, centroids=None, chunk_size=65536):
+        """Closest centroid of each point, by chunks to bound the size of the score matrix"""
+        centroids = self.centroids if centroids is None else centroids
+        return torch.cat([
+            torch.mm(points[start:start + chunk_size], centroids.t()).argmax(dim=1)
+            for start in range(0, points.size(0), chunk_size)
+        ])
+
+    def search(self, queries: Tensor):
+        """
+        Approximate nearest row of each query by cosine similarity.
+
+        Returns:
+        - scores (Tensor): (num_queries,) cosine similarity with the row found
+        - indices (Tensor): (num_queries,) index of the row in the embedding table
+        """
+        queries = F.normalize(queries.detach().float(), p=2, dim=1)
+        probes = torch.mm(queries, self.centroids.t()).topk(self.num_probes, dim=1).indices
+
+        # Every (query, probed list) pair, grouped by list so each list is scored in one product
+        pair_lists = probes.reshape(-1)
+        pairs = torch.argsort(pair_lists, stable=True)
+        pair_counts = torch.bincount(pair_lists, minlength=self.num_lists).tolist()
+        pair_scores = queries.new_full((pair_lists.numel(),), -float("inf"))
+        pair_rows = torch.zeros_like(pair_lists)
+
+        start = 0
+        for list_id, count in enumerate(pair_counts):
+            first, last = self.offsets[list_id], self.offsets[list_id + 1]
+            if count and last > first:
+                group = pairs[start:start + count]
+                scores = torch.mm(queries[group // self.num_probes], self.weight[first:last].t())
+                best, best_index = scores.max(dim=1)
+                pair_scores[group] = best
+                pair_rows[group] = self.rows[first + best_index]
+            start += count
+
+        best, best_probe = pair_scores.view(-1, self.num_probes).max(dim=1)
+        indices = pair_rows.view(-1, self.num_probes).gather(1, best_probe.unsqueeze(1)).squeeze(1)
+        return best, indices
@@ -5,13 +5,14 @@ import torch.nn.functional as F
 from torch_geometric.nn import GCNConv,GraphConv, InnerProductDecoder, BatchNorm, VGAE, MessagePassing
 from torch_geometric.utils import negative_sampling
 from sklearn.metrics import average_precision_score, roc_auc_score, accuracy_score
-from torch_geometric.utils import from_networkx
+from torch_geometric.utils import from_networkx, to_dense_batch
 from torch_geometric.data import DataLoader, Data
 # from torch.nn import BatchNorm1d
 from torch.nn import Module
 from torch import Tensor
 
 from config import MATHML_TAGS
+from models.Graph.EmbeddingIndex import EmbeddingIndex
 
 # MAX_LOGSTD = 10
 EPS = 1e-15
@@ -32,30 +33,92 @@ METHODS = {
     "loss":["cross_entropy","mse","cosine"]
 }
 
+# Vocabs of the split vocab type, each only embeds the nodes of its own tag
+SPLIT_VOCABS = ["mi","mn","mtext","mo"]
+
+
+def autocast_inputs(x, edge_weight=None):
+    """
+    ```x``` and ```edge_weight``` in the dtype of an enabled autocast, unchanged otherwise.
+
+    Autocast only casts the matmuls of a layer, its message passing runs in the dtype of the edge
+    weights (fp32 when GCNConv normalises, they're built in the dtype of x). Casting the inputs of
+    each layer keeps the edge weights and the messages in the autocast dtype.
+    """
+    if x.device.type == "cpu":
+        enabled, dtype = torch.is_autocast_cpu_enabled(), torch.get_autocast_cpu_dtype()
+    else:
+        enabled, dtype = torch.is_autocast_enabled(), torch.get_autocast_gpu_dtype()
+    if not enabled:
+        return x, edge_weight
+    return x.to(dtype), None if edge_weight is None else edge_weight.to(dtype)
+
+
+def batch_norm(norm, x, node_mask=None):
+    """
+    ```norm``` applied to ```x```. With a ```node_mask```, the batch statistics (and the running
+    ones) are those of the masked nodes only, the other nodes are normalised with them. Padding
+    nodes (see ```CompiledStep```) then leave the real nodes as they would be without them.
+    """
+    # PyG's BatchNorm wraps a BatchNorm1d
+    module = getattr(norm, "module", norm)
+    if node_mask is None or not (module.training or module.running_mean is None):
+        return norm(x)
+
+    weight = node_mask.float().unsqueeze(1)
+    count = weight.sum()
+    x_float = x.float()
+    mean = (x_float * weight).sum(dim=0) / count
+    var = ((x_float - mean)**2 * weight).sum(dim=0) / count
+
+    if module.training and module.running_mean is not None:
+        with torch.no_grad():
+            module.num_batches_tracked.add_(1)
+            momentum = module.momentum if module.momentum is not None else 1 / module.num_batches_tracked
+            module.running_mean.mul_(1 - momentum).add_(mean * momentum)
+            # Unbiased variance in the running stats, as BatchNorm1d
+            module.running_var.mul_(1 - momentum).add_(var * count / (count - 1) * momentum)
+
+    out = (x_float - mean) / torch.sqrt(var + module.eps)
+    if module.affine:
+        out = out * module.weight + module.bias
+    return out.to(x.dtype)
+
 
 class GraphEncoder(torch.nn.Module):
-    def __init__(self, in_channels, hidden_channels=32, out_channels=16, layers:int=4,layer_type=GCNConv, batch_norm=False):
+    def __init__(self, in_channels, hidden_channels=32, out_channels=16, layers:int=4,layer_type=GCNConv, batch_norm=False, normalize=True):
+        """
+        Args:
+            normalize (bool): False to feed GCNConv layers with the edges and weights precomputed by
+                ```GcnNorm``` (gcn_edge_index, gcn_edge_weight) instead of normalising at every forward.
+                The parameters are the same in both modes. Ignored by the other layer types.
+        """
         super(GraphEncoder, self).__init__()
         self.convs = nn.ModuleList()
         self.batch_norms = nn.ModuleList() if batch_norm else None
+        self.normalize = normalize or layer_type is not GCNConv
+        layer_kwargs = {} if self.normalize else {"normalize": False}
 
         # Create as many layers as wanted, minimum # is 2
         for i in range(layers - 1):
             channels = in_channels if i == 0 else hidden_channels
-            self.convs.append(layer_type(channels,hidden_channels))
+            self.convs.append(layer_type(channels,hidden_channels,**layer_kwargs))
             if batch_norm:
                 self.batch_norms.append(BatchNorm(hidden_channels))
         
         # Last 2 layers in parallel
-        self.conv_mu = layer_type(hidden_channels, out_channels)
-        self.conv_logstd = layer_type(hidden_channels,out_channels)
+        self.conv_mu = layer_type(hidden_channels, out_channels, **layer_kwargs)
+        self.conv_logstd = layer_type(hidden_channels,out_channels, **layer_kwargs)
 
-    def forward(self, x, edge_index, edge_weight=None):
+    def forward(self, x, edge_index, edge_weight=None, node_mask=None):
+        """```node_mask```: nodes the batch norms compute their statistics on, all by default"""
         for i, layer in enumerate(self.convs):
+            x, edge_weight = autocast_inputs(x, edge_weight)
             x = layer(x, edge_index, edge_weight).relu()  # GCN
             if self.batch_norms is not None:
-                x = self.batch_norms[i](x)  # Batch Norm
+                x = batch_norm(self.batch_norms[i], x, node_mask)  # Batch Norm
         
+        x, edge_weight = autocast_inputs(x, edge_weight)
         mu = self.conv_mu(x, edge_index, edge_weight)
         logstd = self.conv_logstd(x, edge_index, edge_weight)
 
@@ -89,12 +152,15 @@ class GraphDecoder(torch.nn.Module):
         return self.adjency_decoder.forward_all(*args,**kwargs) 
 
     
-    def node_decoder(self, z, edge_index, edge_weight=None):
+    def node_decoder(self, z, edge_index, edge_weight=None, node_mask=None):
+        """```node_mask```: nodes the batch norms compute their statistics on, all by default"""
         for i, layer in enumerate(self.convs):
+            z, edge_weight = autocast_inputs(z, edge_weight)
             z = layer(z, edge_index, edge_weight).relu()  # GCN
             if self.batch_norms is not None:
-                z = self.batch_norms[i](z)  # Batch Norm
+                z = batch_norm(self.batch_norms[i], z, node_mask)  # Batch Norm
         
+        z, _ = autocast_inputs(z)
         return self.conv_out(z, edge_index)
     
     def edge_decoder(self, z, edge_index):
@@ -138,6 +204,8 @@ class GraphVAE(VGAE):
         self.sparse_edges = sparse_edges
         self.edge_features = edge_features
         self.unknown_id = 1
+        self.embedding_index = {}
+        self._normalized_tables = {}
         # self.device = device
 
         # if embedding_method not in EMBEDDINGS:
@@ -150,9 +218,12 @@ class GraphVAE(VGAE):
     def initialize_embeddings(self):
         """
         Initializes embeddings based on the specified embedding method.
+
+        The embeddings are registered so ```model.to(device)``` moves them and they are saved with the
+        model, but they stay frozen: they define the node features the decoder reconstructs.
         """
         if not hasattr(self, 'embeddings'):
-            self.embeddings = {}
+            self.embeddings = nn.ModuleDict()
 
             if "onehot" in self.embedding_method and len(self.embedding_method["onehot"]) != 0:
                 for vocab, embed_dim in self.embedding_method["onehot"].items():
@@ -178,6 +249,128 @@ class GraphVAE(VGAE):
                 for vocab, embed_dim in self.embedding_method["linear"].items():
                     self.embeddings[vocab] = nn.Linear(1,embed_dim)
 
+            self.embeddings.requires_grad_(False)
+            self.initialize_split_tables()
+
+    def initialize_split_tables(self):
+        """
+        Lookups of the fused tables of the split vocabs (see ```split_table```): per tag, the index of
+        its vocab (-1 for the other tags), and per vocab its first row in the table. One-hot vocabs
+        also get the bound above which an id is unknown, the smallest dim of the one-hot vocabs up
+        to them since each of them replaces the ids it can't encode in x.
+        """
+        self.split_vocabs = {}
+        self.split_columns = {}
+        self.split_contiguous = {}
+        self._split_tables = {}
+
+        for kind in ["onehot","embed"]:
+            vocabs = [vocab for vocab in self.embedding_method.get(kind,{}) if vocab in SPLIT_VOCABS]
+            sizes = [self.embeddings[vocab].num_embeddings for vocab in vocabs]
+            dims = [self.embeddings[vocab].embedding_dim for vocab in vocabs]
+
+            tag_to_vocab = torch.full((len(MATHML_TAGS),), -1, dtype=torch.long)
+            for i, vocab in enumerate(vocabs):
+                tag_to_vocab[MATHML_TAGS.index(vocab)] = i
+            # Row 0 is the zero row of the nodes of the other tags
+            offsets = torch.tensor([1 + sum(sizes[:i]) for i in range(len(vocabs))], dtype=torch.long)
+
+            self.register_buffer(f"{kind}_split_tags", tag_to_vocab, persistent=False)
+            self.register_buffer(f"{kind}_split_offsets", offsets, persistent=False)
+            self.split_vocabs[kind] = vocabs
+            self.split_columns[kind] = {vocab: (sum(dims[:i]), sum(dims[:i + 1])) for i, vocab in enumerate(vocabs)}
+            positions = [i for i, vocab in enumerate(self.embedding_method.get(kind,{})) if vocab in SPLIT_VOCABS]
+            self.split_contiguous[kind] = positions == list(range(positions[0], positions[0] + len(positions))) if positions else True
+
+        limits, limit = [], float("inf")
+        for vocab, embed_dim in self.embedding_method.get("onehot",{}).items():
+            if vocab in ["concat","combined"] + SPLIT_VOCABS:
+                limit = min(limit, embed_dim)
+            if vocab in SPLIT_VOCABS:
+                limits.append(limit)
+        self.register_buffer("onehot_split_limits", torch.tensor(limits, dtype=torch.long), persistent=False)
+
+    def split_table(self, kind):
+        """
+        Block-diagonal table holding the embeddings of all the split vocabs of ```kind```, so a node
+        of any split vocab is embedded by a single gather. It's rebuilt when an embedding changed,
+        moved or got loaded.
+        """
+        weights = [self.embeddings[vocab].weight for vocab in self.split_vocabs[kind]]
+        key = tuple((weight.data_ptr(), weight._version) for weight in weights)
+
+        if kind not in self._split_tables or self._split_tables[kind][0] != key:
+            table = weights[0].new_zeros(1 + sum(weight.size(0) for weight in weights), sum(weight.size(1) for weight in weights))
+            row, column = 1, 0
+            for weight in weights:
+                table[row:row + weight.size(0), column:column + weight.size(1)] = weight.detach()
+                row, column = row + weight.size(0), column + weight.size(1)
+            self._split_tables[kind] = (key, table)
+        return self._split_tables[kind][1]
+
+    def embed_split(self, kind, x, tag_index):
+        """Embeddings of the split vocabs of ```kind```, zero outside the columns of each node's vocab"""
+        split_tags = getattr(self, f"{kind}_split_tags")
+        vocab_index = split_tags[tag_index]
+        is_split = vocab_index >= 0
+        vocab_index = vocab_index.clamp(min=0)
+
+        if kind == "onehot":
+            x = torch.where(x >= self.onehot_split_limits[vocab_index], self.unknown_id, x)
+        rows = torch.where(is_split, getattr(self, f"{kind}_split_offsets")[vocab_index] + x, 0)
+        return F.embedding(rows, self.split_table(kind))
+
+    def split_pieces(self, kind, vocab, split_x):
+        """
+        Columns of ```split_x``` to append for ```vocab```. When the split vocabs follow each other in
+        the method, all their columns are appended with the first one: concatenating one wide slice
+        is much cheaper than several narrow ones.
+        """
+        if not self.split_contiguous[kind]:
+            start, end = self.split_columns[kind][vocab]
+            return [split_x[:, start:end]]
+        return [split_x] if vocab == self.split_vocabs[kind][0] else []
+
+    def normalized_embedding(self, vocab):
+        """Row-normalised weight of an embedding, cached until the weight changes, moves or gets loaded"""
+        weight = self.embeddings[vocab].weight
+        key = (weight.data_ptr(), weight._version)
+        if vocab not in self._normalized_tables or self._normalized_tables[vocab][0] != key:
+            self._normalized_tables[vocab] = (key, F.normalize(weight.detach(), p=2, dim=1))
+        return self._normalized_tables[vocab][1]
+
+    def build_embedding_index(self, min_size=50000, **index_kwargs):
+        """
+        Build an ```EmbeddingIndex``` for each embed vocab of at least ```min_size``` rows, so
+        ```reverse_embed_x``` searches its nearest rows approximately instead of comparing with
+        all of them. Build it once the model is on its device: an index is ignored as soon as its
+        embedding changed or moved.
+        """
+        self.embedding_index = {}
+        for vocab in self.embedding_method.get("embed",{}):
+            weight = self.embeddings[vocab].weight
+            if weight.size(0) >= min_size:
+                self.embedding_index[vocab] = ((weight.data_ptr(), weight._version), EmbeddingIndex(weight, **index_kwargs))
+
+    def nearest_embedding(self, vocab, x_embed):
+        """Index of the row of the embedding ```vocab``` the most similar to each row of ```x_embed```"""
+        weight = self.embeddings[vocab].weight
+        key, index = self.embedding_index.get(vocab, (None, None))
+        if index is not None and key == (weight.data_ptr(), weight._version):
+            return index.search(x_embed)[1]
+
+        x_embed_normalized = F.normalize(x_embed, p=2, dim=1)
+        similarity = torch.mm(x_embed_normalized, self.normalized_embedding(vocab).t())
+        return similarity.argmax(dim=1)
+
+    def load_state_dict(self, state_dict, strict=True, assign=False):
+        # Checkpoints saved before the embeddings were registered don't hold them: they keep their
+        # initialisation, which is seeded like it was at training time
+        missing = {key: value for key, value in self.state_dict().items() if key.startswith("embeddings.") and key not in state_dict}
+        if missing:
+            state_dict = {**state_dict, **missing}
+        return super().load_state_dict(state_dict, strict, assign)
+
 
 
     def embed_x(self,x:Tensor, tag_index:Tensor, pos:Tensor, nums:Tensor) -> Tensor:
@@ -195,27 +388,21 @@ class GraphVAE(VGAE):
             Tensor: The embedded and concatenated feature vector.
         """
         embedded = []
-        device = x.device
-        # Ensure all embeddings are moved to the correct device
-        for key in self.embeddings:
-            self.embeddings[key] = self.embeddings[key].to(device)
-            
+
         if "onehot" in self.embedding_method and len(self.embedding_method["onehot"]) != 0:
+            split_x = self.embed_split("onehot", x, tag_index) if self.split_vocabs["onehot"] else None
             for vocab, embed_dim in self.embedding_method["onehot"].items():
                 if vocab == "tag":
                     embedded.append(self.embeddings["tag"](tag_index))
                 elif vocab in ["concat","combined"]:
+                    # Unknown ids are also replaced in x, the accuracy is measured against them
                     max_id = x >= embed_dim
                     x[max_id] = self.unknown_id
                     embedded.append(self.embeddings[vocab](x))
-                elif vocab in ["mi","mn","mtext","mo"]:
+                elif vocab in SPLIT_VOCABS:
                     max_id = x >= embed_dim
                     x[max_id] = self.unknown_id
-
-                    mask = (tag_index == MATHML_TAGS.index(vocab))
-                    vector = torch.zeros(x.size(0),embed_dim, dtype=torch.float32, device=device) #.unsqueeze(1).repeat(1, self.embedding_dim)
-                    vector[mask] = self.embeddings[vocab](x[mask])
-                    embedded.append(vector)
+                    embedded.extend(self.split_pieces("onehot", vocab, split_x))
                 elif vocab == "pos":
                     max_id = x >= embed_dim
                     pos[max_id] = self.unknown_id
@@ -224,28 +411,24 @@ class GraphVAE(VGAE):
                     raise ValueError(f"Invalid one-hot vocab selected. Expected one of {METHODS['onehot']}, but got {vocab}")
 
         if "embed" in self.embedding_method and len(self.embedding_method["embed"]) != 0:
+            split_x = self.embed_split("embed", x, tag_index) if self.split_vocabs["embed"] else None
             for vocab, embed_dim in self.embedding_method["embed"].items():
                 if vocab == "tag":
                     embedded.append(self.embeddings["tag"](tag_index))
                 elif vocab in ["concat","combined"]:
                     embedded.append(self.embeddings[vocab](x))
-                elif vocab in ["mi","mn","mtext","mo"]:
-                    mask = (tag_index == MATHML_TAGS.index(vocab))
-                    vector = torch.zeros(x.size(0),embed_dim, dtype=torch.float32, device=device) #.unsqueeze(1).repeat(1, self.embedding_dim)
-                    vector[mask] = self.embeddings[vocab](x[mask])
-                    embedded.append(vector)
+                elif vocab in SPLIT_VOCABS:
+                    embedded.extend(self.split_pieces("embed", vocab, split_x))
                 elif vocab == "pos":
                     embedded.append(self.embeddings["pos"](pos))
                 else:
                     raise ValueError(f"Invalid embed vocab selected. Expected one of {METHODS['embed']}, but got {vocab}")
 
         if "linear" in self.embedding_method and len(self.embedding_method["linear"]) != 0:
+                mask = (nums != -1).unsqueeze(1) # not a number when num= -1
+                scaled_nums = self.feature_scale(nums).unsqueeze(1)
                 for vocab, embed_dim in self.embedding_method["linear"].items():
-                    mask = (nums != -1) # not a number when num= -1
-                    nums[mask] = self.feature_scale(nums[mask])
-                    vector = torch.zeros(x.size(0), embed_dim, dtype=torch.float32, device=device)
-                    vector[mask] = self.embeddings[vocab](nums[mask].unsqueeze(1)) # 
-                    embedded.append(vector)
+                    embedded.append(torch.where(mask, self.embeddings[vocab](scaled_nums), 0))
 
 
         new_x = torch.cat(embedded,dim=1)
@@ -316,12 +499,8 @@ class GraphVAE(VGAE):
             for vocab, embed_dim in self.embedding_method["embed"].items():
                 x_embed = x_recon[:,vector_index: vector_index + embed_dim]
 
-                x_embed_normalized = F.normalize(x_embed, p=2, dim=1)
-                embedding_weight_normalized = F.normalize(self.embeddings[vocab].weight, p=2, dim=1)
-
-                similarity = torch.mm(x_embed_normalized, embedding_weight_normalized.t())
                 # similarity = F.cosine_similarity(x_embed.unsqueeze(1),self.embeddings[vocab].weight.unsqueeze(0), dim=2)
-                index = similarity.argmax(dim=1)
+                index = self.nearest_embedding(vocab, x_embed)
                 
                 if vocab == "tag":
                     data["tag"] = index
@@ -359,7 +538,13 @@ class GraphVAE(VGAE):
 
         return data, raw_data
     
-    def decode_all(self,z, edge_index, sigmoid=True):
+    def decode_all(self,z, edge_index, sigmoid=True, batch=None):
+        """
+        Decode the edges, their features and the node features from z.
+
+        Without sparse edges every pair of nodes is scored. When ```batch``` (the graph of each
+        node) is given, only the pairs inside each graph are, see ```dense_batch_edges```.
+        """
 
         # Adjency matrix
         if self.sparse_edges:
@@ -367,6 +552,8 @@ class GraphVAE(VGAE):
             adj = (adj > 0.5).float()
             
             edge_index_recon = edge_index[:, adj > 0] # Remove edges with zero probability
+        elif batch is not None:
+            edge_index_recon = self.dense_batch_edges(z, batch, sigmoid)
         else:
             adj = self.decoder.forward_all(z,sigmoid)
             adj = (adj > 0.5).float()
@@ -386,51 +573,98 @@ class GraphVAE(VGAE):
 
         return x_recon, edge_index_recon, e_recon
     
-    def recon_full_loss(self, z, x, pos_edge_index, neg_edge_index, edge_weight = None, alpha = 1, beta = 0, gamma = 0):
-        
-        # Compute link loss
-        adj_loss = self.recon_loss(z, pos_edge_index,neg_edge_index)
-        # pos_loss = -torch.log(self.decoder(z, pos_edge_index, sigmoid=True) + EPS).mean()
-        # neg_loss = -torch.log(1 - self.decoder.forward_all(z, sigmoid=True) + EPS).mean()
-        # adj_loss = pos_loss + neg_loss
+    def dense_batch_edges(self, z, batch, sigmoid=True):
+        """
+        Edges of the dense adjacency decoded graph by graph: the scores are computed on the padded
+        (num_graphs, max_num_nodes, max_num_nodes) blocks of ```to_dense_batch``` instead of the
+        (num_nodes, num_nodes) matrix of the whole batch, and pairs of nodes of different graphs are
+        never predicted. The edges come in the same order as ```torch.nonzero``` over the full matrix.
+        """
+        z_dense, mask = to_dense_batch(z, batch)
+        adj = torch.bmm(z_dense, z_dense.transpose(1, 2))
+        adj = torch.sigmoid(adj) if sigmoid else adj
+        adj = (adj > 0.5) & mask.unsqueeze(2) & mask.unsqueeze(1)
 
-        # Node features loss
-        # x_recon = self.decoder.node_decoder(z, pos_edge_index, edge_weight)
-        x_recon, _, _ = self.decode_all(z, pos_edge_index)
-
-        # If it's onehot or embedding, chose
-        if self.embedding_method["loss"] == "cross_entropy":
-            node_loss = F.cross_entropy(x_recon,x)
-        elif self.embedding_method["loss"] == "mse":
-            node_loss = F.mse_loss(x_recon,x)
-        elif self.embedding_method["loss"] == "cosine":
-            similarity = F.cosine_similarity(x_recon,x, dim=1)
-            target = torch.ones_like(similarity)
-            node_loss = F.cosine_embedding_loss(x_recon, x, target, margin=0.0)
-        else:
-            raise ValueError(f"Invalid embedding method. Expected one of {EMBEDDINGS['loss']}, but got {self.embedding_method['loss']}")
+        graph, row, col = torch.nonzero(adj, as_tuple=True)
+        # First node of each graph in the batch
+        ptr = torch.cumsum(mask.sum(dim=1), dim=0) - mask.sum(dim=1)
+        return torch.stack([ptr[graph] + row, ptr[graph] + col])
 
-        # Edge features loss
-        edge_loss = 0
+    def recon_full_loss(self, z, x, pos_edge_index, neg_edge_index, edge_weight = None, alpha = 1, beta = 0, gamma = 0, return_recon = False, batch = None):
+        """
+        Weighted sum of the link, node features and edge features reconstruction losses.
+        With ```return_recon``` the reconstructed node features are returned with the loss, so the
+        node metrics can reuse them (see ```node_metrics```) instead of decoding again.
+        ```batch``` is passed to ```decode_all```.
+
+        Under a bf16 autocast the decoders run in bf16 but the losses are computed in fp32: the
+        link loss takes the log of probabilities down to EPS, which bf16 can't represent. The
+        returned ```x_recon``` is then fp32 too.
+        """
+        # Node and edge features decoding
+        # x_recon = self.decoder.node_decoder(z, pos_edge_index, edge_weight)
+        x_recon, _, _ = self.decode_all(z, pos_edge_index, batch=batch)
+        e_recon = None
         if edge_weight is not None and gamma != 0 and self.edge_features:
             e_recon = self.decoder.edge_decoder(z, pos_edge_index)
-            
-            if self.decoder.edge_dim == 1:
-                edge_loss = F.binary_cross_entropy_with_logits(e_recon,edge_weight.float())
+
+        with torch.autocast(z.device.type, enabled=False):
+            z, x, x_recon = z.float(), x.float(), x_recon.float()
+
+            # Compute link loss
+            adj_loss = self.recon_loss(z, pos_edge_index,neg_edge_index)
+            # pos_loss = -torch.log(self.decoder(z, pos_edge_index, sigmoid=True) + EPS).mean()
+            # neg_loss = -torch.log(1 - self.decoder.forward_all(z, sigmoid=True) + EPS).mean()
+            # adj_loss = pos_loss + neg_loss
+
+            # Node features loss
+            # If it's onehot or embedding, chose
+            if self.embedding_method["loss"] == "cross_entropy":
+                node_loss = F.cross_entropy(x_recon,x)
+            elif self.embedding_method["loss"] == "mse":
+                node_loss = F.mse_loss(x_recon,x)
+            elif self.embedding_method["loss"] == "cosine":
+                similarity = F.cosine_similarity(x_recon,x, dim=1)
+                target = torch.ones_like(similarity)
+                node_loss = F.cosine_embedding_loss(x_recon, x, target, margin=0.0)
             else:
-                edge_loss = F.cross_entropy(e_recon,edge_weight.float())
+                raise ValueError(f"Invalid embedding method. Expected one of {EMBEDDINGS['loss']}, but got {self.embedding_method['loss']}")
+
+            # Edge features loss
+            edge_loss = 0
+            if e_recon is not None:
+                e_recon = e_recon.float()
+                if self.decoder.edge_dim == 1:
+                    edge_loss = F.binary_cross_entropy_with_logits(e_recon,edge_weight.float())
+                else:
+                    edge_loss = F.cross_entropy(e_recon,edge_weight.float())
+
+        loss = alpha * adj_loss + beta * node_loss + gamma * edge_loss
+        return (loss, x_recon) if return_recon else loss
 
-        return alpha * adj_loss + beta * node_loss + gamma * edge_loss
+    def kl_loss(self, mu=None, logstd=None):
+        """```VGAE.kl_loss```, in fp32 also when the encoder ran under a bf16 autocast"""
+        mu = self.__mu__ if mu is None else mu
+        logstd = self.__logstd__ if logstd is None else logstd
+        with torch.autocast(mu.device.type, enabled=False):
+            return super().kl_loss(mu.float(), logstd.float())
 
-    def test_nodes(self,z, pos_edge_index, x, x_indices, edge_weight=None):
+    def test_nodes(self,z, pos_edge_index, x, x_indices, edge_weight=None, batch=None):
 
         # x_recon = self.decoder.node_decoder(z, pos_edge_index, edge_weight)
 
-        x_recon, _, _ = self.decode_all(z, pos_edge_index)
+        x_recon, _, _ = self.decode_all(z, pos_edge_index, batch=batch)
+        accuracy, similarity = self.node_metrics(x_recon, x, x_indices)
+        return accuracy.item(), similarity.item()
+
+    def node_metrics(self, x_recon, x, x_indices):
+        """
+        Accuracy of the reconstructed indices and similarity of the reconstructed features, as
+        0-dim tensors on the device of ```x_recon```: nothing is synchronised with the host.
+        """
         recon_data, raw_data = self.reverse_embed_x(x_recon)
 
-        similarity = 0
-        accuracy = 0
+        similarity = x_recon.new_zeros(())
         num_embeddings = len(raw_data.keys()) 
         vector_index = 0
 
@@ -441,24 +675,24 @@ class GraphVAE(VGAE):
             if key =="onehot" and x_value is not None:
                 intersection = (x_value * x_cropped).sum(dim=1).float()
                 union = ((x_value + x_cropped) > 0).sum(dim=1).float()
-                similarity += (intersection / (union + EPS)).mean().item()
+                similarity += (intersection / (union + EPS)).mean()
             
             # cosine similarity for embedding
             elif key =="embed" and x_value is not None:
-                similarity += F.cosine_similarity(x_value, x_cropped,dim=1).mean().item()
+                similarity += F.cosine_similarity(x_value, x_cropped,dim=1).mean()
 
             elif key == "linear" and x_value is not None:
                 euclidean_dist = torch.norm(x_value - x_cropped,p=2, dim=1)
-                similarity += (1 / (1 + euclidean_dist)).mean().item()
+                similarity += (1 / (1 + euclidean_dist)).mean()
 
             vector_index +=  x_value.size(1)
         
         similarity /= num_embeddings
-        similarity = max(0, min(1,similarity))
+        similarity = similarity.clamp(0, 1)
 
         # Accuracy
         recon_indices = recon_data["x"]
-        accuracy = (recon_indices == x_indices).float().mean().item()
+        accuracy = (recon_indices == x_indices).float().mean()
         # TODO: add accuracy for pos and tags
 
         # non_zero_indices = x_indices.nonzero()
@@ -0,0 +1,94 @@
+import torch
+from torch import Tensor
+
+
+class LinkMetrics():
+    """
+    Epoch-level AUC and AP of the link predictions, accumulated on the device.
+
+    ```update``` only stores the scores of a batch (or adds them to a histogram), nothing is read
+    back to the host until ```compute``` returns the metrics of all the scores seen since the last
+    ```reset```. Exact mode gives the same values as sklearn's ```roc_auc_score``` and
+    ```average_precision_score``` on the concatenated scores. With ```num_bins``` the scores, in
+    [0, 1], are counted in that many bins instead, which keeps the memory constant and approximates
+    the metrics to the bin width.
+
+    Args:
+    - num_bins (int): number of histogram bins, None to keep the exact scores
+    """
+    def __init__(self, num_bins=None):
+        self.num_bins = num_bins
+        self.reset()
+
+    def reset(self):
+        self.pos_scores, self.neg_scores = [], []
+        self.pos_hist, self.neg_hist = None, None
+
+    def update(self, pos_pred: Tensor, neg_pred: Tensor):
+        """Add the predicted probabilities of a batch of positive and negative edges"""
+        pos_pred, neg_pred = pos_pred.detach().reshape(-1).float(), neg_pred.detach().reshape(-1).float()
+        if self.num_bins is None:
+            self.pos_scores.append(pos_pred)
+            self.neg_scores.append(neg_pred)
+            return
+
+        if self.pos_hist is None:
+            self.pos_hist = torch.zeros(self.num_bins, dtype=torch.long, device=pos_pred.device)
+            self.neg_hist = torch.zeros(self.num_bins, dtype=torch.long, device=pos_pred.device)
+        self.pos_hist += torch.bincount(self.bin(pos_pred), minlength=self.num_bins)
+        self.neg_hist += torch.bincount(self.bin(neg_pred), minlength=self.num_bins)
+
+    def bin(self, scores):
+        return (scores.clamp(0, 1) * self.num_bins).long().clamp(max=self.num_bins - 1)
+
+    def compute(self):
+        """
+        Returns:
+        - auc (float), ap (float): nan if no positive or no negative edge was seen
+        """
+        if self.num_bins is None:
+            if not self.pos_scores:
+                return float("nan"), float("nan")
+            tps, fps = ranked_counts(torch.cat(self.pos_scores), torch.cat(self.neg_scores))
+        else:
+            if self.pos_hist is None:
+                return float("nan"), float("nan")
+            # Bins from the highest scores, each bin is one threshold
+            tps, fps = self.pos_hist.flip(0).cumsum(0), self.neg_hist.flip(0).cumsum(0)
+
+        auc, ap = curve_metrics(tps, fps)
+        return auc.item(), ap.item()
+
+
+def ranked_counts(pos_scores, neg_scores):
+    """
+    True and false positive counts at each distinct score, from the highest, like the thresholds
+    of ```sklearn.metrics.roc_curve``` (without dropping any).
+    """
+    scores = torch.cat([pos_scores, neg_scores])
+    labels = torch.cat([torch.ones_like(pos_scores), torch.zeros_like(neg_scores)])
+    scores, order = torch.sort(scores, descending=True)
+    labels = labels[order]
+
+    # Last index of each group of equal scores
+    distinct = torch.nonzero(scores[1:] != scores[:-1]).reshape(-1)
+    thresholds = torch.cat([distinct, distinct.new_tensor([scores.numel() - 1])])
+
+    tps = labels.cumsum(0)[thresholds]
+    fps = thresholds + 1 - tps
+    return tps, fps
+
+
+def curve_metrics(tps, fps):
+    """AUC (trapezoidal ROC area) and AP (step-wise precision-recall area) from cumulative counts"""
+    tps, fps = tps.double(), fps.double()
+    zero = tps.new_zeros(1)
+    tpr = torch.cat([zero, tps / tps[-1]])
+    fpr = torch.cat([zero, fps / fps[-1]])
+    auc = torch.trapezoid(tpr, fpr)
+
+    # Thresholds with no prediction above them have no precision, and add no recall
+    predicted = tps + fps
+    precision = torch.where(predicted > 0, tps / predicted.clamp(min=1), 0)
+    ap = ((tpr[1:] - tpr[:-1]) * precision).sum()
+    return auc, ap
@@ -0,0 +1,120 @@
+import torch
+from torch import Tensor
+
+
+def in_graph_negative_sampling(edge_index: Tensor, ptr: Tensor, ratio=1.0, force_undirected=True, max_rounds=8, generator=None) -> Tensor:
+    """
+    Negative edges sampled inside each graph of a batch, from the complement of its edges.
+
+    PyG's ```negative_sampling``` draws node pairs over the whole batch, so almost all of them join
+    two different graphs, which the model never has to tell apart. Here every graph draws its own
+    pairs, ```ratio``` negatives per positive edge of the graph, without self-loops. The node pairs
+    of all the graphs are numbered in one index space with the positive pairs taken out, so a draw
+    in the complement is a uniform integer mapped back with a ```searchsorted```: positive pairs are
+    never drawn and there is no loop over the graphs.
+
+    A graph has no duplicated negative. When a graph asks for a quarter of its free pairs or more they
+    are all shuffled and the first ones kept, otherwise the pairs are drawn with replacement and the
+    duplicates are drawn again, at most ```max_rounds``` times. A graph can get fewer negatives than
+    asked when its complement is too small or, rarely, when duplicates remain after the last round.
+
+    Args:
+    - edge_index (Tensor): (2, num_edges) positive edges of the batch
+    - ptr (Tensor): (num_graphs + 1,) first node of each graph, ```batch.ptr```
+    - ratio (float): number of negatives per positive edge
+    - force_undirected (bool): sample unordered pairs and return both directions, as PyG does
+    - max_rounds (int): number of draws for the duplicates
+    - generator (torch.Generator): random generator, the global one by default
+
+    Returns:
+    - neg_edge_index (Tensor): (2, num_neg_edges) negative edges, grouped by graph
+    """
+    device = edge_index.device
+    ptr = ptr.to(device)
+    num_graphs = ptr.numel() - 1
+    sizes = ptr.diff()
+    node_graph = torch.arange(num_graphs, device=device).repeat_interleave(sizes)
+
+    # Pair space of every graph, then of the whole batch
+    num_pairs = sizes * (sizes - 1) // 2 if force_undirected else sizes * (sizes - 1)
+    pair_offsets = torch.cat([num_pairs.new_zeros(1), num_pairs.cumsum(0)])
+
+    # Positive pairs in that space, sorted and without duplicates
+    row, col = edge_index[:, edge_index[0] != edge_index[1]]
+    edge_graph = node_graph[row]
+    pos_codes = torch.unique(pair_offsets[edge_graph] + pair_code(row - ptr[edge_graph], col - ptr[edge_graph], sizes[edge_graph], force_undirected))
+    # The k-th free code is k plus the number of positive codes at or below it
+    pos_shifted = pos_codes - torch.arange(pos_codes.numel(), device=device)
+
+    pos_per_graph = torch.bincount(torch.searchsorted(pair_offsets, pos_codes, right=True) - 1, minlength=num_graphs)
+    num_free = num_pairs - pos_per_graph
+    free_offsets = pair_offsets[:-1] - torch.cat([pos_per_graph.new_zeros(1), pos_per_graph.cumsum(0)[:-1]])
+
+    num_edges = torch.bincount(edge_graph, minlength=num_graphs).double() * ratio
+    wanted = (num_edges / 2 if force_undirected else num_edges).round().long()
+    wanted = torch.minimum(wanted, num_free)
+
+    # Graphs asking for a large share of their free pairs shuffle all of them, which costs at most
+    # four times their negatives. The others draw a duplicate with a probability under a quarter
+    shuffled = 4 * wanted >= num_free
+    free = shuffled_free(free_offsets, num_free, wanted, shuffled, generator)
+
+    # The others draw with replacement until they have no duplicate
+    missing = torch.where(shuffled, 0, wanted)
+    drawn = free.new_empty(0)
+    for _ in range(max_rounds):
+        if not bool(missing.any()):
+            break
+        draw_graph = torch.arange(num_graphs, device=device).repeat_interleave(missing)
+        draws = free_offsets[draw_graph] + (torch.rand(draw_graph.numel(), device=device, generator=generator) * num_free[draw_graph]).long()
+        drawn = torch.unique(torch.cat([drawn, draws]))
+        missing = torch.where(shuffled, 0, wanted - torch.bincount(torch.searchsorted(free_offsets, drawn, right=True) - 1, minlength=num_graphs))
+    free = torch.cat([free, drawn])
+
+    # Back to the pairs of the graphs
+    codes = free + torch.searchsorted(pos_shifted, free, right=True)
+    graph = torch.searchsorted(pair_offsets, codes, right=True) - 1
+    row, col = pair_nodes(codes - pair_offsets[graph], sizes[graph], force_undirected)
+    row, col = row + ptr[graph], col + ptr[graph]
+
+    order = torch.argsort(graph, stable=True)
+    row, col = row[order], col[order]
+    if force_undirected:
+        row, col = torch.cat([row, col]), torch.cat([col, row])
+    return torch.stack([row, col])
+
+
+def shuffled_free(free_offsets, num_free, wanted, selected, generator=None):
+    """First ```wanted``` free codes of a random order of all the free codes of the selected graphs"""
+    counts = torch.where(selected, num_free, 0)
+    graph = torch.arange(counts.numel(), device=counts.device).repeat_interleave(counts)
+    first = torch.cat([counts.new_zeros(1), counts.cumsum(0)[:-1]])
+    local = torch.arange(graph.numel(), device=counts.device) - first[graph]
+
+    scores = torch.rand(graph.numel(), device=counts.device, generator=generator)
+    # Random order within each graph, the graphs stay in order
+    order = torch.argsort(scores, stable=True)
+    order = order[torch.argsort(graph[order], stable=True)]
+    keep = local < wanted[graph]
+    return (free_offsets[graph] + local[order])[keep]
+
+
+def pair_code(row, col, num_nodes, undirected):
+    """Index of the pair (row, col) among the pairs of a graph of ```num_nodes``` nodes, self-loops excluded"""
+    if undirected:
+        low, high = torch.minimum(row, col), torch.maximum(row, col)
+        return high * (high - 1) // 2 + low
+    return row * (num_nodes - 1) + col - (col > row).long()
+
+
+def pair_nodes(code, num_nodes, undirected):
+    """Inverse of ```pair_code```"""
+    if undirected:
+        high = ((1 + torch.sqrt(1 + 8 * code.double())) / 2).floor().long()
+        # Corrects the rounding of the square root
+        high = high - (high * (high - 1) // 2 > code).long()
+        high = high + ((high + 1) * high // 2 <= code).long()
+        return code - high * (high - 1) // 2, high
+    row = code // (num_nodes - 1)
+    col = code % (num_nodes - 1)
+    return row, col + (col >= row).long()
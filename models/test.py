@@ -27,10 +27,11 @@ import xml.etree.ElementTree as ET
 from xml.etree.ElementTree import tostring
 import torch_geometric.transforms as T
 from tqdm import tqdm
-from models.train import validate
+from models.train import encoder_edges, make_loader, make_pre_transform, precompute_gcn_norm, validate
 # from preprocessing.GraphEmbedder import GraphEmbedder, MATHML_TAGS
 from preprocessing.MathmlDataset import MathmlDataset
 from preprocessing.GraphDataset import GraphDataset
+from preprocessing.MmapGraphDataset import MmapGraphDataset
 from models.Graph.GraphAutoEncoder import GraphEncoder, GraphDecoder, GraphVAE
 import random
 
@@ -87,8 +88,9 @@ def main(model_name="default", sample_latex_set="sample", sample_xml_name="sampl
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
     print('CUDA availability:', device)
     
-    sample, vocab = load_dataset(sample_xml_name, sample_latex_set, False, False, max_num_nodes, sample_vocab_type, False, False)
-    sample_loader = DataLoader(sample, batch_size=256, shuffle=False, num_workers=8)
+    pre_transform = make_pre_transform(config)
+    sample, vocab = load_dataset(sample_xml_name, sample_latex_set, False, False, max_num_nodes, sample_vocab_type, False, False, pre_transform=pre_transform)
+    sample_loader = make_loader(sample, config, shuffle=False)
 
     metrics, model = test_model(config, model_path, sample_loader, vocab, device)
     sample_recon_z, sample_recon_g = reconstruct(model,sample_loader, device, config)
@@ -99,8 +101,8 @@ def main(model_name="default", sample_latex_set="sample", sample_xml_name="sampl
         test_recon_z = np.load(latent_space_file)
         print(f"Loaded from saved numpy file of size {test_recon_z.shape}")
     else:
-        test, vocab = load_dataset(xml_name, latex_set, False, False, max_num_nodes, vocab_type, False, False)
-        test_loader = DataLoader(test, batch_size=256, shuffle=False, num_workers=8)
+        test, vocab = load_dataset(xml_name, latex_set, False, False, max_num_nodes, vocab_type, False, False, pre_transform=pre_transform)
+        test_loader = make_loader(test, config, shuffle=False)
 
         test_recon_z, test_recon_g = reconstruct(model, test_loader, device, config)
         np.save(latent_space_file, test_recon_z)
@@ -125,11 +127,12 @@ def main(model_name="default", sample_latex_set="sample", sample_xml_name="sampl
 
 
 
-def load_dataset(xml_name, latex_set, debug, force_reload, max_num_nodes, vocab_type, shuffle, split_set = True):
+def load_dataset(xml_name, latex_set, debug, force_reload, max_num_nodes, vocab_type, shuffle, split_set = True, on_disk = False, pre_transform = None):
         print("Loading dataset...")
         mathml = MathmlDataset(xml_name,latex_set=latex_set,debug=debug,force_reload=False)
         vocab = VocabBuilder(xml_name,vocab_type=vocab_type, debug=debug, reload_vocab=False)
-        dataset = GraphDataset(mathml.xml_dir,vocab, max_num_nodes= max_num_nodes, force_reload=force_reload, debug=debug)
+        dataset_class = MmapGraphDataset if on_disk else GraphDataset
+        dataset = dataset_class(mathml.xml_dir,vocab, max_num_nodes= max_num_nodes, force_reload=force_reload, debug=debug, pre_transform=pre_transform)
 
         if split_set:
             _, _, test = dataset.split(shuffle=shuffle)
@@ -206,15 +209,15 @@ def test_all_models(model_name="default"):
             max_num_nodes = config.get("max_num_nodes",40)
             shuffle = config.get("shuffle",False)
 
-            batch_size = config.get("batch_size",256)
 
             print("Training #: ", i)
 
             if test == None:
-                test, vocab = load_dataset(xml_name, latex_set, debug, force_reload, max_num_nodes, vocab_type, shuffle)
+                pre_transform = make_pre_transform(config)
+                test, vocab = load_dataset(xml_name, latex_set, debug, force_reload, max_num_nodes, vocab_type, shuffle, on_disk=config.get("on_disk",False), pre_transform=pre_transform)
             
 
-            test_loader = DataLoader(test, batch_size=batch_size, shuffle=False, num_workers=8)
+            test_loader = make_loader(test, config, shuffle=False)
             metrics, _ = test_model(config, best_checkpoint_path, test_loader, vocab, device)
 
             combined_data = {**params, **metrics}
@@ -328,7 +331,7 @@ def test_model(config:dict, model_path:str, test_loader, vocab, device):
     embedding_dim = sum(method["onehot"].values()) + sum(method["embed"].values()) + sum(method["linear"].values())
     
 
-    encoder = GraphEncoder(embedding_dim,hidden_channels,out_channels,layers,layer_type,batch_norm)
+    encoder = GraphEncoder(embedding_dim,hidden_channels,out_channels,layers,layer_type,batch_norm, normalize=not precompute_gcn_norm(config))
     decoder = GraphDecoder(embedding_dim,hidden_channels,out_channels,layers,layer_type, edge_dim=1,batch_norm=batch_norm)
     model = GraphVAE(encoder, decoder, vocab.shape(), method, scale_grad_by_freq, sparse_edges, train_edge_features)
 
@@ -350,6 +353,7 @@ def test_model(config:dict, model_path:str, test_loader, vocab, device):
         return {}, model
     
     model.to(device)
+    build_embedding_index(model, config)
 
     print("Starting testing...")
     loss, auc, ap, acc, sim = validate(model,test_loader,device,config)
@@ -395,6 +399,8 @@ def test_model(config:dict, model_path:str, test_loader, vocab, device):
 
 def reconstruct(model:GraphVAE,data_loader,device,config, max_num_batches = 50): 
     model.eval()
+    if not model.embedding_index:
+        build_embedding_index(model, config)
 
     # Getting params
     train_edge_features = config.get("train_edge_features",False)
@@ -412,12 +418,12 @@ def reconstruct(model:GraphVAE,data_loader,device,config, max_num_batches = 50):
             
             # Encode
             x = model.embed_x(batch.x,batch.tag,batch.pos,batch.nums).to(device)          
-            z = model.encode(x, batch.edge_index,edge_weight)
+            z = model.encode(x, *encoder_edges(model, batch, edge_weight))
 
             graph_embedding = pyg_nn.global_mean_pool(z, batch.batch)
 
             # Decode
-            x_recon, edge_index_recon, e_recon = model.decode_all(z, batch.edge_index)
+            x_recon, edge_index_recon, e_recon = model.decode_all(z, batch.edge_index, batch=batch.batch)
             recon_data, raw_data = model.reverse_embed_x(x_recon)
 
             latent_z.append(graph_embedding.cpu().detach().numpy())
@@ -433,6 +439,13 @@ def reconstruct(model:GraphVAE,data_loader,device,config, max_num_batches = 50):
 
 
 
+def build_embedding_index(model:GraphVAE, config):
+    """Approximate nearest neighbour decoding of the large embed vocabs, when ```ann_decoding``` is set"""
+    if config.get("ann_decoding",False):
+        print("Building the embedding indexes...")
+        model.build_embedding_index(min_size=config.get("ann_min_vocab",50000), num_probes=config.get("ann_probes",8))
+
+
 def generate_all_possible_edges(num_nodes):
     """Generate all possible edges for a graph with num_nodes nodes."""
     row = torch.arange(num_nodes).repeat_interleave(num_nodes)
@@ -32,8 +32,15 @@ from config import CONFIG
 # from preprocessing.GraphEmbedder import GraphEmbedder
 from preprocessing.MathmlDataset import MathmlDataset
 from preprocessing.GraphDataset import GraphDataset
+from preprocessing.MmapGraphDataset import MmapGraphDataset
+from preprocessing.GcnNorm import GcnNorm
+from preprocessing.NegativePool import NegativePool
+from preprocessing.NodeBudgetSampler import NodeBudgetSampler
 from preprocessing.VocabBuilder import VocabBuilder
 from models.Graph.GraphAutoEncoder import GraphEncoder, GraphVAE, GraphDecoder
+from models.Graph.Compile import CompiledStep
+from models.Graph.Metrics import LinkMetrics
+from models.Graph.NegativeSampling import in_graph_negative_sampling
 import random
 # from tensorboardX import SummaryWriter
 
@@ -200,6 +207,9 @@ def train_model(train_config: dict):
     # sample_edges = config.get("sample_edges","sparse")
     sparse_edges = config.get("gen_sparse_edges",True)
     train_edge_features = config.get("train_edge_features",False)
+    on_disk = config.get("on_disk",False)
+    precomputed_norm = precompute_gcn_norm(config)
+    pre_transform = make_pre_transform(config)
 
     mn_type = config.get("mn_type","embed")
 
@@ -246,7 +256,8 @@ def train_model(train_config: dict):
     # load and setup dataset
     mathml = MathmlDataset(xml_name,latex_set=latex_set,debug=debug)
     vocab = VocabBuilder(xml_name,vocab_type=vocab_type, debug=debug, reload_vocab=force_reload)
-    dataset = GraphDataset(mathml.xml_dir,vocab, max_num_nodes= max_num_nodes, force_reload=force_reload, debug=debug)
+    dataset_class = MmapGraphDataset if on_disk else GraphDataset
+    dataset = dataset_class(mathml.xml_dir,vocab, max_num_nodes= max_num_nodes, force_reload=force_reload, debug=debug, pre_transform=pre_transform)
 
     train, val, _ = dataset.split(shuffle=shuffle)
     
@@ -256,7 +267,7 @@ def train_model(train_config: dict):
     # load models
     embedding_dim = sum(method["onehot"].values()) + sum(method["embed"].values()) + sum(method["linear"].values())
 
-    encoder = GraphEncoder(embedding_dim,hidden_channels,out_channels,layers,layer_type,batch_norm)
+    encoder = GraphEncoder(embedding_dim,hidden_channels,out_channels,layers,layer_type,batch_norm, normalize=not precomputed_norm)
     decoder = GraphDecoder(embedding_dim,hidden_channels,out_channels,layers,layer_type, edge_dim=1,batch_norm=batch_norm)
     model = GraphVAE(encoder, decoder, vocab.shape(), method, scale_grad_by_freq, sparse_edges, train_edge_features)
 
@@ -265,8 +276,8 @@ def train_model(train_config: dict):
     model.to(device)
 
     
-    train_loader = DataLoader(train, batch_size=config.get("batch_size",256), shuffle=True, num_workers=8)
-    val_loader = DataLoader(val, batch_size=config.get("batch_size",256), shuffle=False, num_workers=8)
+    train_loader = make_loader(train, config, shuffle=True)
+    val_loader = make_loader(val, config, shuffle=False)
     # test_loader = DataLoader(test_data, batch_size=batch_size, shuffle=False, num_workers=8)
     # print("Number of nodes per batch: ", train_loader.dataset.))
 
@@ -285,7 +296,7 @@ def train_model(train_config: dict):
     print("Starting training...")
     for epoch in range(start,epochs):
 
-        train_loss, train_auc, train_ap, train_acc, train_sim = train_one_epoch(model,optimizer,train_loader,device,config)
+        train_loss, train_auc, train_ap, train_acc, train_sim = train_one_epoch(model,optimizer,train_loader,device,config,epoch)
         val_loss, val_auc, val_ap, val_acc, val_sim = validate(model,val_loader,device,config)
 
         # reduce learning rate
@@ -305,23 +316,131 @@ def train_model(train_config: dict):
             session.report(metrics=metrics, checkpoint=Checkpoint.from_directory(tempdir))
 
 
-def train_one_epoch(model:GraphVAE,optimizer,train_loader,device, config ): # variational=False,force_undirected=True,neg_sampling_method="sparse"
+def precompute_gcn_norm(config):
+    """
+    True when the GCN normalisation is precomputed by the ```GcnNorm``` pre-transform instead of
+    being recomputed by the encoder at every step. Only GCNConv layers normalise.
+    """
+    layer_type = config.get("layer_type",GCNConv)
+    is_gcn = layer_type is GCNConv or layer_type == "GCNConv"
+    return config.get("precompute_gcn_norm",False) and is_gcn
+
+
+def make_pre_transform(config):
+    """
+    Pre-transform of the dataset: the ```GcnNorm``` edges when the normalisation is precomputed and
+    the ```NegativePool``` negatives when ```negative_pools``` is set, None without either.
+
+    The pools are drawn inside each graph, so they need ```sample_edges``` to be "in_graph": with
+    another sampler, turning the pools on would change the negatives the metrics are measured on.
+    """
+    transforms = []
+    if precompute_gcn_norm(config):
+        transforms.append(GcnNorm(edge_weight=config.get("train_edge_features",False)))
+    num_pools = config.get("negative_pools",None)
+    if num_pools:
+        if config.get("sample_edges","sparse") != "in_graph":
+            raise ValueError(f"negative_pools stores in-graph negatives, expected sample_edges 'in_graph', but got '{config.get('sample_edges','sparse')}'")
+        transforms.append(NegativePool(num_pools, config.get("neg_sampling_ratio",1.0), config.get("force_undirected",True), config.get("seed",42)))
+
+    if len(transforms) > 1:
+        return T.Compose(transforms)
+    return transforms[0] if transforms else None
+
+
+def autocast(device, config):
+    """
+    Autocast of the forward pass: bf16 when ```precision``` is "bf16", a disabled context (fp32)
+    otherwise. The losses are computed in fp32 either way, see ```GraphVAE.recon_full_loss```.
+    """
+    return torch.autocast(device.type, dtype=torch.bfloat16, enabled=config.get("precision","fp32") == "bf16")
+
+
+def compiled_step(model, config):
+    """
+    ```CompiledStep``` running the encode -> decode -> loss step of the model when ```compile``` is
+    set in the config, None otherwise. It's kept on the model so the graphs compiled for each bucket
+    are reused from an epoch to the next.
+    """
+    if not config.get("compile",False):
+        return None
+    if getattr(model, "_compiled_step", None) is None:
+        compile_kwargs = {"mode": config["compile_mode"]} if config.get("compile_mode",None) else {}
+        model._compiled_step = CompiledStep(model, config.get("compile_bucket_growth",1.5), **compile_kwargs)
+    return model._compiled_step
+
+
+def encoder_edges(model, batch, edge_weight):
+    """Edges and weights fed to the encoder, the ones normalised by ```GcnNorm``` when it doesn't normalise itself"""
+    if not model.encoder.normalize:
+        return batch.gcn_edge_index, batch.gcn_edge_weight
+    return batch.edge_index, edge_weight
+
+
+def make_loader(dataset, config, shuffle=False, num_workers=8):
+    """
+    DataLoader of ```batch_size``` graphs, or of at most ```node_budget``` nodes per batch when it is set in the config.
+
+    With a node budget the batches hold a similar number of nodes whatever the size of the graphs,
+    which keeps the cost of the dense decoding and of the negative sampling steady across steps.
+    """
+    node_budget = config.get("node_budget",None)
+    if node_budget is None:
+        return DataLoader(dataset, batch_size=config.get("batch_size",256), shuffle=shuffle, num_workers=num_workers)
+
+    sampler = NodeBudgetSampler(dataset, node_budget, shuffle=shuffle, seed=config.get("seed",42))
+    return DataLoader(dataset, batch_sampler=sampler, num_workers=num_workers)
+
+
+def sample_negatives(batch, config, slot=None):
+    """
+    Negative edges of a batch, ```neg_sampling_ratio``` per positive edge.
+
+    When the dataset stores ```NegativePool``` negatives and a ```slot``` is given, the negatives of
+    pool ```slot % negative_pools``` are read from the batch and nothing is sampled. Otherwise
+    ```sample_edges``` picks the sampler: "sparse" and "dense" are PyG's ```negative_sampling```
+    over all the node pairs of the batch ("dense" asks for num_nodes**2 negatives, so every free
+    pair), "in_graph" draws the pairs inside each graph with ```in_graph_negative_sampling```.
+    """
+    num_pools = config.get("negative_pools",None)
+    if slot is not None and num_pools and "neg_edge_index" in batch:
+        return batch.neg_edge_index[:, batch.neg_slot == slot % num_pools]
+
+    method = config.get("sample_edges","sparse")
+    ratio = config.get("neg_sampling_ratio",1.0)
+    force_undirected = config.get("force_undirected",True)
+    if method == "in_graph":
+        return in_graph_negative_sampling(batch.edge_index, batch.ptr, ratio, force_undirected)
+
+    num_edges = batch.num_nodes**2 if method == "dense" else round(ratio * batch.edge_index.size(1))
+    return negative_sampling(
+        edge_index=batch.edge_index, 
+        num_nodes=batch.num_nodes, 
+        num_neg_samples=num_edges,
+        force_undirected=force_undirected,
+        method=method
+    )
+
+
+def train_one_epoch(model:GraphVAE,optimizer,train_loader,device, config, epoch=0): # variational=False,force_undirected=True,neg_sampling_method="sparse"
     # Training phase
     model.train()
-    total_train_loss = 0
-    total_acc = 0
-    total_sim = 0
-    total_auc = 0
-    total_ap = 0
+    # Accumulated on the device, read once at the end of the epoch
+    total_train_loss = torch.zeros((), device=device)
+    total_acc = torch.zeros((), device=device)
+    total_sim = torch.zeros((), device=device)
+    link_metrics = LinkMetrics(config.get("auc_bins",None))
+    num_metric_batches = 0
 
     # Getting params
     variational = config.get("variational",False)
-    force_undirected = config.get("force_undirected",True)
-    neg_sampling_method = config.get("sample_edges","sparse")
     alpha = config.get("alpha",1)
     beta = config.get("beta",0)
     gamma = config.get("gamma",0)
     train_edge_features = config.get("train_edge_features",False)
+    # Metrics are computed on one batch every metrics_interval batches
+    metrics_interval = config.get("metrics_interval",1)
+    step = compiled_step(model, config)
     
     for i,batch in enumerate(train_loader):
         # if i % 2 == 0:
@@ -332,63 +451,63 @@ def train_one_epoch(model:GraphVAE,optimizer,train_loader,device, config ): # va
 
         # Generate negative edges
         # pos_edge_index = batch.edge_index.to(device)
-        num_edges = batch.num_nodes**2 if neg_sampling_method == "dense" else batch.edge_index.size(1)
-        neg_edge_index = negative_sampling(
-            edge_index=batch.edge_index, 
-            num_nodes=batch.num_nodes, 
-            num_neg_samples=num_edges,
-            force_undirected=force_undirected,
-            method=neg_sampling_method
-        ).to(device)
+        # Pool of this epoch when the negatives are stored with the dataset
+        neg_edge_index = sample_negatives(batch, config, slot=epoch).to(device)
         edge_weight = batch.edge_attr.to(device) if train_edge_features else None
 
-        x = model.embed_x(batch.x,batch.tag,batch.pos,batch.nums).to(device)         
-        z = model.encode(x, batch.edge_index, edge_weight)
+        with autocast(device, config):
+            x = model.embed_x(batch.x,batch.tag,batch.pos,batch.nums).to(device)         
+            if step is not None:
+                loss, z, x_recon = step(x, *encoder_edges(model, batch, edge_weight), batch.edge_index, neg_edge_index, edge_weight, alpha, beta, gamma, variational)
+            else:
+                z = model.encode(x, *encoder_edges(model, batch, edge_weight))
 
-        # Loss calculation
-        loss = model.recon_full_loss(z, x, batch.edge_index, neg_edge_index, edge_weight, alpha, beta, gamma)
-        if variational:
-            loss = loss + (1 / batch.num_nodes) * model.kl_loss()
+                # Loss calculation
+                loss, x_recon = model.recon_full_loss(z, x, batch.edge_index, neg_edge_index, edge_weight, alpha, beta, gamma, return_recon=True, batch=batch.batch)
+                if variational:
+                    loss = loss + (1 / batch.num_nodes) * model.kl_loss()
 
         loss.backward()
         optimizer.step()
-        total_train_loss += loss.item()
+        total_train_loss += loss.detach()
 
-        # AUC, AP
-        auc, ap = model.test(z, batch.edge_index, neg_edge_index)
-        total_auc += auc
-        total_ap += ap  
+        if i % metrics_interval != 0:
+            continue
+        num_metric_batches += 1
 
-        # Accuracy and similarity
-        acc, sim = model.test_nodes(z, batch.edge_index, x, batch.x, edge_weight)
+        with torch.no_grad():
+            # AUC, AP
+            link_metrics.update(model.decoder(z, batch.edge_index, sigmoid=True), model.decoder(z, neg_edge_index, sigmoid=True))
+
+            # Accuracy and similarity, from the node features decoded for the loss
+            acc, sim = model.node_metrics(x_recon.detach(), x.detach(), batch.x)
         total_acc += acc
         total_sim += sim
     
-    avg_train_loss = total_train_loss / len(train_loader)
-    avg_auc = total_auc / len(train_loader)
-    avg_ap = total_ap / len(train_loader)
-    avg_acc = total_acc / len(train_loader)
-    avg_sim = total_sim / len(train_loader)
+    num_metric_batches = max(num_metric_batches, 1)
+    avg_train_loss = total_train_loss.item() / len(train_loader)
+    # AUC, AP of all the edges scored during the epoch
+    avg_auc, avg_ap = link_metrics.compute()
+    avg_acc = total_acc.item() / num_metric_batches
+    avg_sim = total_sim.item() / num_metric_batches
 
     return avg_train_loss, avg_auc, avg_ap, avg_acc, avg_sim
 
 def validate(model:GraphVAE,val_loader,device,config): # variational=False,force_undirected=True,neg_sampling_method="sparse"
     model.eval()
-    total_val_loss = 0
-    total_auc = 0
-    total_ap = 0
-    total_acc = 0
-    total_sim = 0
+    total_val_loss = torch.zeros((), device=device)
+    link_metrics = LinkMetrics(config.get("auc_bins",None))
+    total_acc = torch.zeros((), device=device)
+    total_sim = torch.zeros((), device=device)
 
 
     # Getting params
     variational = config.get("variational",False)
-    force_undirected = config.get("force_undirected",True)
-    neg_sampling_method = config.get("sample_edges","sparse")
     alpha = config.get("alpha",1)
     beta = config.get("beta",0)
     gamma = config.get("gamma",0)
     train_edge_features = config.get("train_edge_features",False)
+    step = compiled_step(model, config)
 
     with torch.no_grad():
         for batch in val_loader:
@@ -396,40 +515,35 @@ def validate(model:GraphVAE,val_loader,device,config): # variational=False,force
 
             # Generate negative edges
             pos_edge_index = batch.edge_index
-            num_edges = batch.num_nodes**2 if neg_sampling_method == "dense" else pos_edge_index.size(1)
-            neg_edge_index = negative_sampling(
-                edge_index=pos_edge_index, 
-                num_nodes=batch.num_nodes, 
-                num_neg_samples=num_edges,
-                force_undirected=force_undirected,
-                method=neg_sampling_method
-            ).to(device)
+            # Always the first pool when the negatives are stored with the dataset
+            neg_edge_index = sample_negatives(batch, config, slot=0).to(device)
             edge_weight = batch.edge_attr.to(device) if train_edge_features else None
             
-            x = model.embed_x(batch.x,batch.tag,batch.pos,batch.nums).to(device)          
-            z = model.encode(x, batch.edge_index,edge_weight)
+            with autocast(device, config):
+                x = model.embed_x(batch.x,batch.tag,batch.pos,batch.nums).to(device)          
+                if step is not None:
+                    loss, z, x_recon = step(x, *encoder_edges(model, batch, edge_weight), pos_edge_index, neg_edge_index, edge_weight, alpha, beta, gamma, variational)
+                else:
+                    z = model.encode(x, *encoder_edges(model, batch, edge_weight))
 
-            # Loss
-            loss = model.recon_full_loss(z, x, pos_edge_index, neg_edge_index, edge_weight, alpha, beta, gamma)
-            if variational:
-                loss = loss + (1 / batch.num_nodes) * model.kl_loss()
-            total_val_loss += loss.item()
+                    # Loss
+                    loss, x_recon = model.recon_full_loss(z, x, pos_edge_index, neg_edge_index, edge_weight, alpha, beta, gamma, return_recon=True, batch=batch.batch)
+                    if variational:
+                        loss = loss + (1 / batch.num_nodes) * model.kl_loss()
+            total_val_loss += loss
 
             # AUC, AP
-            auc, ap = model.test(z, pos_edge_index, neg_edge_index)
-            total_auc += auc
-            total_ap += ap  
+            link_metrics.update(model.decoder(z, pos_edge_index, sigmoid=True), model.decoder(z, neg_edge_index, sigmoid=True))
 
             # Accuracy and similarity
-            acc, sim = model.test_nodes(z, pos_edge_index,x,batch.x, edge_weight)
+            acc, sim = model.node_metrics(x_recon, x, batch.x)
             total_acc += acc
             total_sim += sim
 
-    avg_val_loss = total_val_loss / len(val_loader)
-    avg_auc = total_auc / len(val_loader)
-    avg_ap = total_ap / len(val_loader)
-    avg_acc = total_acc / len(val_loader)
-    avg_sim = total_sim / len(val_loader)
+    avg_val_loss = total_val_loss.item() / len(val_loader)
+    avg_auc, avg_ap = link_metrics.compute()
+    avg_acc = total_acc.item() / len(val_loader)
+    avg_sim = total_sim.item() / len(val_loader)
 
 
     return avg_val_loss, avg_auc, avg_ap, avg_acc, avg_sim
@@ -0,0 +1,74 @@
+#!/data/nsam947/libs/node-v20.13.1-linux-x64/bin/node
+
+/*************************************************************************
+ *
+ *  Long-lived version of tex2mathml_simple.js
+ *
+ *  Reads newline-delimited JSON requests from stdin, one per line:
+ *      {"id": 12, "latex": "f(x) = x^2"}
+ *  and answers each of them with one line on stdout:
+ *      {"id": 12, "mathml": "<span class=\"katex\">...</span>"}
+ *  A {"id": 13, "version": true} request is answered with the KaTeX version.
+ *
+ *  KaTeX is only required once, so the process can be kept alive by the
+ *  python side (preprocessing/KatexPool.py) for the whole preprocessing run.
+ *  Errors are returned in place of the MathML string, exactly like the
+ *  batch script does.
+ */
+
+
+const katex = require('katex');
+const process = require('process');
+const readline = require('readline');
+
+const annotation_regex = /<annotation.*>(.|\s)*<\/annotation>/;
+
+function convert(latex) {
+    try {
+        var mml = katex.renderToString(latex, {
+            output: "mathml",
+            throwOnError: true,
+            strict: "ignore"
+        });
+        return mml.replace(annotation_regex, '');
+    } catch (e) {
+        if (e instanceof katex.ParseError) {
+            return "Error in LaTeX: " + e.message;
+        }
+        return e.message;
+    }
+}
+
+const lines = readline.createInterface({
+    input: process.stdin,
+    crlfDelay: Infinity
+});
+
+lines.on('line', function (line) {
+    if (!line) {
+        return;
+    }
+    var request;
+    try {
+        request = JSON.parse(line);
+    } catch (e) {
+        // Answer the malformed request with an error when its id can still be read, instead of
+        // letting the exception kill the worker and every request it holds
+        var match = /"id"\s*:\s*(-?\d+)/.exec(line);
+        if (match) {
+            process.stdout.write(JSON.stringify({id: Number(match[1]), mathml: "Error in request: " + e.message}) + "\n");
+        }
+        return;
+    }
+    var response;
+    if (request.version) {
+        response = {id: request.id, version: katex.version};
+    } else {
+        response = {id: request.id, mathml: convert(String(request.latex))};
+    }
+    process.stdout.write(JSON.stringify(response) + "\n");
+});
+
+lines.on('close', function () {
+    process.exit(0);
+});
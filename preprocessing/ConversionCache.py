@@ -0,0 +1,90 @@
+import hashlib
+import sqlite3
+
+# SQLite limits the number of parameters of a single query
+QUERY_CHUNK = 500
+
+
+class ConversionCache():
+    """
+    On-disk cache of LaTeX -> MathML conversions backed by SQLite.
+
+    Entries are keyed by the hash of the cleaned LaTeX string and the KaTeX version, so a
+    formula is only converted again if the cleaning or KaTeX itself changed its input or output.
+    """
+    def __init__(self, cache_path, katex_version):
+        self.cache_path = cache_path
+        self.katex_version = str(katex_version)
+        self.hits = 0
+        self.misses = 0
+
+        self.connection = sqlite3.connect(cache_path, timeout=60)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS conversions (key BLOB PRIMARY KEY, mathml TEXT NOT NULL)")
+        self.connection.commit()
+
+    def key(self, latex):
+        return hashlib.sha256((self.katex_version + "\0" + latex).encode("utf-8")).digest()
+
+    def get_many(self, latex_equations):
+        """
+        Look up a batch of cleaned equations.
+
+        Returns:
+        - results (list): cached MathML strings, None where the equation is not cached
+        """
+        keys = [self.key(latex) for latex in latex_equations]
+        found = {}
+        for i in range(0, len(keys), QUERY_CHUNK):
+            chunk = keys[i:i + QUERY_CHUNK]
+            query = "SELECT key, mathml FROM conversions WHERE key IN ({})".format(",".join("?" * len(chunk)))
+            found.update(self.connection.execute(query, chunk).fetchall())
+
+        results = [found.get(key) for key in keys]
+        hits = sum(result is not None for result in results)
+        self.hits += hits
+        self.misses += len(results) - hits
+        return results
+
+    def put_many(self, latex_equations, mathml_results):
+        """Store the conversions of a batch, failed conversions (None) are not cached."""
+        rows = [(self.key(latex), mathml) for latex, mathml in zip(latex_equations, mathml_results) if mathml is not None]
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO conversions (key, mathml) VALUES (?, ?)", rows)
+
+    def imap(self, pool, batches):
+        """
+        Convert an iterable of batches, only sending the equations missing from the cache
+        to the KaTeX pool.
+
+        Args:
+        - pool (KatexPool): pool of KaTeX workers
+        - batches (iterable): batches of cleaned Tex equations
+
+        Returns:
+        - generator of MathML results per batch, in the same order as ```batches```
+        """
+        lookups = []
+
+        def uncached_batches():
+            for batch in batches:
+                cached = self.get_many(batch)
+                lookups.append((batch, cached))
+                yield [latex for latex, mathml in zip(batch, cached) if mathml is None]
+
+        for converted in pool.imap(uncached_batches()):
+            batch, cached = lookups.pop(0)
+            self.put_many([latex for latex, mathml in zip(batch, cached) if mathml is None], converted)
+
+            converted = iter(converted)
+            yield [mathml if mathml is not None else next(converted) for mathml in cached]
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,171 @@
+import json
+import os
+import shutil
+
+import numpy as np
+from tqdm import tqdm
+
+from preprocessing.XmlStream import EquationNode, iter_equations
+
+# Columns of the store, one .npy file each. Node columns are indexed by the offsets of the equations.
+COLUMNS = {
+    "offsets": np.int64,    # (num_equations + 1,) first node of each equation
+    "tags": np.int16,       # (num_nodes,) id in the "tags" string table
+    "texts": np.int32,      # (num_nodes,) id in the "texts" string table, raw text as in the XML
+    "parents": np.int32,    # (num_nodes,) index of the parent inside the equation, -1 for <math>
+    "positions": np.int32,  # (num_nodes,) position among the children of the parent
+}
+
+
+class EquationStore():
+    """
+    Columnar, memory-mappable copy of ```equations.xml```.
+
+    The nodes of all the equations are stored in flat npy columns (tag id, text id, parent,
+    position) with the node offsets of each equation, plus the tag and text string tables.
+    Reading it doesn't parse any XML. The store remembers the size and mtime of the XML it
+    was built from and is considered stale as soon as the XML changes.
+    """
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+
+        with open(os.path.join(store_dir, "meta.json"), "r") as f:
+            meta = json.load(f)
+        self.signature = meta["signature"]
+        self.tag_table = meta["tags"]
+        self.text_table = meta["texts"]
+
+        for column in COLUMNS:
+            setattr(self, column, np.load(os.path.join(store_dir, column + ".npy"), mmap_mode="r"))
+
+    @staticmethod
+    def path(xml_path):
+        """Directory of the store built from ```xml_path```"""
+        return os.path.splitext(xml_path)[0] + ".store"
+
+    @staticmethod
+    def xml_signature(xml_path):
+        stat = os.stat(xml_path)
+        return [stat.st_size, stat.st_mtime_ns]
+
+    @classmethod
+    def exists(cls, xml_path):
+        """Returns True if an up to date store of ```xml_path``` exists."""
+        meta_path = os.path.join(cls.path(xml_path), "meta.json")
+        if not os.path.exists(xml_path) or not os.path.exists(meta_path):
+            return False
+        with open(meta_path, "r") as f:
+            return json.load(f)["signature"] == cls.xml_signature(xml_path)
+
+    @classmethod
+    def open(cls, xml_path):
+        """Returns the store of ```xml_path```, None if there is no up to date store."""
+        return cls(cls.path(xml_path)) if cls.exists(xml_path) else None
+
+    @classmethod
+    def build(cls, xml_path, chunk_size=100000, verbose=False):
+        """
+        Stream ```xml_path``` once and write its store next to it.
+
+        Args:
+        - xml_path (string): equations XML
+        - chunk_size (int): number of equations converted to arrays at once
+
+        Returns:
+        - EquationStore: the new store
+        """
+        store_dir = cls.path(xml_path)
+        tmp_dir = store_dir + ".tmp"
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.makedirs(tmp_dir)
+
+        signature = cls.xml_signature(xml_path)
+        tag_ids, text_ids = {}, {}
+        chunks = {column: [] for column in COLUMNS}
+        rows = {column: [] for column in COLUMNS if column != "offsets"}
+        num_nodes = 0
+        offsets = [0]
+
+        def flush():
+            for column, values in rows.items():
+                chunks[column].append(np.array(values, dtype=COLUMNS[column]))
+                values.clear()
+
+        equations = iter_equations(xml_path)
+        if verbose:
+            equations = tqdm(equations, desc="Building equation store", unit=" equations")
+
+        for i, nodes in enumerate(equations):
+            for node in nodes:
+                rows["tags"].append(tag_ids.setdefault(node.tag, len(tag_ids)))
+                rows["texts"].append(text_ids.setdefault(node.text, len(text_ids)))
+                rows["parents"].append(node.parent)
+                rows["positions"].append(node.position)
+            num_nodes += len(nodes)
+            offsets.append(num_nodes)
+            if (i + 1) % chunk_size == 0:
+                flush()
+        flush()
+        chunks["offsets"].append(np.array(offsets, dtype=COLUMNS["offsets"]))
+
+        for column, arrays in chunks.items():
+            np.save(os.path.join(tmp_dir, column + ".npy"), np.concatenate(arrays).astype(COLUMNS[column], copy=False))
+
+        # Dicts keep the insertion order, so the keys are the tables indexed by id
+        meta = {"signature": signature, "tags": list(tag_ids), "texts": list(text_ids)}
+        with open(os.path.join(tmp_dir, "meta.json"), "w+") as f:
+            json.dump(meta, f)
+
+        if os.path.exists(store_dir):
+            shutil.rmtree(store_dir)
+        os.replace(tmp_dir, store_dir)
+        return cls(store_dir)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def node_range(self, start=0, stop=None):
+        """Returns the (first, last) node indices of the equations ```start``` to ```stop```."""
+        stop = len(self) if stop is None else min(stop, len(self))
+        return int(self.offsets[start]), int(self.offsets[stop])
+
+    def __getitem__(self, idx):
+        """Returns the nodes of the equation ```idx``` as a list of ```EquationNode```"""
+        if idx < -len(self) or idx >= len(self):
+            raise IndexError(f"Equation index {idx} out of range")
+        idx = idx % len(self)
+        return self.nodes(int(self.offsets[idx]), int(self.offsets[idx + 1]))
+
+    def nodes(self, first, last):
+        tags = self.tags[first:last].tolist()
+        texts = self.texts[first:last].tolist()
+        parents = self.parents[first:last].tolist()
+        positions = self.positions[first:last].tolist()
+        return [
+            EquationNode(self.tag_table[tag], self.text_table[text], parent, position)
+            for tag, text, parent, position in zip(tags, texts, parents, positions)
+        ]
+
+    def iter_equations(self, start=0, stop=None):
+        """Same output as ```XmlStream.iter_equations``` for the equations ```start``` to ```stop```"""
+        stop = len(self) if stop is None else min(stop, len(self))
+        offsets = self.offsets[start:stop + 1].tolist()
+        for first, last in zip(offsets[:-1], offsets[1:]):
+            yield self.nodes(first, last)
+
+
+def load_equations(xml_path, limit=None):
+    """
+    Iterate over the equations of ```xml_path```, from its store when it is up to date,
+    otherwise by streaming the XML.
+
+    Returns:
+    - equations (generator): lists of ```EquationNode```, one per equation
+    - total (int): number of equations that will be yielded, None if unknown
+    """
+    store = EquationStore.open(xml_path)
+    if store is None:
+        return iter_equations(xml_path, limit), limit
+    total = len(store) if limit is None else min(limit, len(store))
+    return store.iter_equations(0, total), total
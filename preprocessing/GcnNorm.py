@@ -0,0 +1,56 @@
+import torch
+from torch_geometric.nn.conv.gcn_conv import gcn_norm
+from torch_geometric.transforms import BaseTransform
+
+
+class GcnNorm(BaseTransform):
+    """
+    Pre-transform storing the symmetric GCN normalisation of each graph.
+
+    The self-looped edges and their normalised weights are kept next to the original edges in
+    ```gcn_edge_index``` and ```gcn_edge_weight```, ```edge_index``` is left untouched for the
+    reconstruction losses. A ```GraphEncoder(normalize=False)``` fed with them gives the same
+    output as ```GCNConv``` normalising on the fly.
+
+    Args:
+    - edge_weight (bool): normalise with ```edge_attr``` as edge weights, like the encoder does with ```train_edge_features```
+    """
+    def __init__(self, edge_weight=False):
+        self.edge_weight = edge_weight
+
+    def forward(self, data):
+        edge_weight = data.edge_attr.float() if self.edge_weight else None
+        data.gcn_edge_index, data.gcn_edge_weight = gcn_norm(data.edge_index, edge_weight, data.num_nodes, add_self_loops=True)
+        return data
+
+    def transform_collated(self, data, slices):
+        """
+        Same as ```forward``` on every graph of a collated dataset at once.
+
+        The graphs are normalised as one block-diagonal graph, then the edges are grouped back
+        per graph (original edges then self-loops, as ```forward``` orders them) with their slices.
+        """
+        node_slices = slices["x"]
+        num_graphs = len(node_slices) - 1
+        graph_ids = torch.arange(num_graphs)
+        node_graph = graph_ids.repeat_interleave(node_slices.diff())
+        edge_graph = graph_ids.repeat_interleave(slices["edge_index"].diff())
+
+        edge_index = data.edge_index + node_slices[edge_graph]
+        edge_weight = data.edge_attr.float() if self.edge_weight else None
+        edge_index, edge_weight = gcn_norm(edge_index, edge_weight, data.num_nodes, add_self_loops=True)
+
+        edge_graph = node_graph[edge_index[1]]
+        order = torch.sort(edge_graph, stable=True).indices
+        edge_graph = edge_graph[order]
+        gcn_slices = torch.cat([torch.zeros(1, dtype=torch.long), torch.bincount(edge_graph, minlength=num_graphs).cumsum(0)])
+
+        data.gcn_edge_index = edge_index[:, order] - node_slices[edge_graph]
+        data.gcn_edge_weight = edge_weight[order]
+        slices["gcn_edge_index"] = gcn_slices
+        slices["gcn_edge_weight"] = gcn_slices.clone()
+        return data, slices
+
+    def __repr__(self):
+        # Part of the fingerprint of the processed dataset
+        return f"{self.__class__.__name__}(edge_weight={self.edge_weight})"
@@ -1,14 +1,18 @@
+import hashlib
+import json
+import multiprocessing
 import os
 import numpy as np
 import torch
 from torch_geometric.data import Data, InMemoryDataset
 from tqdm import tqdm
-import xml.etree.ElementTree as ET
 import networkx as nx
 from sklearn.model_selection import train_test_split
 
 from config import MATHML_TAGS
-from preprocessing.VocabBuilder import VocabBuilder, rn, clean_text
+from preprocessing.VocabBuilder import VocabBuilder, clean_text
+from preprocessing.EquationStore import EquationStore, load_equations
+from preprocessing.XmlStream import XmlIndex
 
 GRAPH_TYPES = [
     "Graph",
@@ -21,8 +25,10 @@ ALGO_TYPES = [
 ]
 
 class GraphDataset(InMemoryDataset):
-    def __init__(self, root, vocab:VocabBuilder, graph_type = "Graph", max_num_nodes=50, representation="TreeGraph", transform=None, pre_transform=None, pre_filter=None,log=False, force_reload= False, debug=False, verbose=False):
+    def __init__(self, root, vocab:VocabBuilder, graph_type = "Graph", max_num_nodes=50, representation="TreeGraph", transform=None, pre_transform=None, pre_filter=None,log=False, force_reload= False, debug=False, verbose=False, num_workers=None, save_graphs=False):
         self.debug = debug
+        self.num_workers = num_workers
+        self.save_graphs = save_graphs
         self.verbose = verbose
         self.vocab = vocab      
         self.max_num_nodes = max_num_nodes
@@ -34,59 +40,226 @@ class GraphDataset(InMemoryDataset):
 
         self.xml_path = os.path.join(root, "raw/equations.xml")     
 
+        # The vocab left its counting to this pass (VocabBuilder(fused=True)): the trees are parsed
+        # now, so the vocab is final before it's used in the fingerprint of the processed data
+        self._fused_trees = self.parse_fused() if self.vocab.pending else None
+
+        # Processed data of every set of parameters are kept side by side in processed/<fingerprint>
+        self.params = self.processing_params(pre_transform, pre_filter)
+        self.fingerprint = hashlib.sha256(json.dumps(self.params, sort_keys=True).encode()).hexdigest()[:16]
+
         super(GraphDataset, self).__init__(root, transform, pre_transform,pre_filter,log,force_reload)
+        self._fused_trees = None
         # self.data, self.slices = torch.load(self.processed_paths[0])
         # self.data, self.slices, self._graph_list = self.load_data(force_reload)
-        self.data, self.slices, self._graph_list = torch.load(self.processed_paths[0])
+        self.data, self.slices, self._graph_list = self.load_processed()
     
     @property
     def raw_file_names(self):
         return [self.xml_path]
     
+    @property
+    def processed_dir(self):
+        return os.path.join(self.root, "processed", self.fingerprint)
+
     @property
     def processed_file_names(self):
         return ['data.pt']
 
+    def processing_params(self, pre_transform, pre_filter):
+        """
+        Everything the processed data depends on: the graph parameters, the vocab and XML files
+        it was built from, and the pre transform/filter.
+        """
+        with open(self.vocab.vocab_path, "rb") as f:
+            vocab_hash = hashlib.sha256(f.read()).hexdigest()
+        xml_stat = os.stat(self.xml_path)
+
+        return {
+            "max_num_nodes": self.max_num_nodes,
+            "graph_type": self.graph_type,
+            "representation": self.representation,
+            "vocab_type": self.vocab.vocab_type,
+            "debug": self.debug,
+            "vocab": vocab_hash,
+            "xml": [xml_stat.st_size, xml_stat.st_mtime_ns],
+            "pre_transform": repr(pre_transform),
+            "pre_filter": repr(pre_filter),
+        }
+
+    def update_manifest(self):
+        """Record the parameters of this variant in processed/manifest.json"""
+        manifest_path = os.path.join(self.root, "processed", "manifest.json")
+        manifest = {}
+        if os.path.exists(manifest_path):
+            with open(manifest_path, "r") as f:
+                manifest = json.load(f)
+        manifest[self.fingerprint] = self.params
+        with open(manifest_path, "w+") as f:
+            json.dump(manifest, f, indent=2)
+
     def download(self):
         pass
 
     def load_data(self, force_reload):
         if not os.path.exists(self.processed_paths[0]) or force_reload:
             self.process()
-        return torch.load(self.processed_paths[0])
+        return self.load_processed()
+
+    @property
+    def graphs_path(self):
+        """Optional artifact with the networkx graphs, only loaded when they are requested"""
+        return os.path.join(self.processed_dir, "graphs.pt")
+
+    def load_processed(self):
+        """
+        Returns data and slices. The graph list is None, it's loaded or rebuilt on request.
+        """
+        processed = torch.load(self.processed_paths[0])
+        if len(processed) > 2:
+            # data.pt of an older version with its networkx graphs: move them to their own file
+            # so the next loads only read the tensors
+            print("Moving the networkx graphs out of data.pt...")
+            torch.save(processed[2], self.graphs_path)
+            torch.save((processed[0], processed[1]), self.processed_paths[0])
+        return processed[0], processed[1], None
 
     def get_graph_list(self):
-        """Returns the graph list containing networkx Graph objects."""
+        """
+        Returns the graph list containing networkx Graph objects. They are loaded from
+        ```graphs.pt``` when the dataset was processed with ```save_graphs```, rebuilt from the
+        tensors otherwise (see ```get_graph```).
+        """
+        if self._graph_list is None and os.path.exists(self.graphs_path):
+            graph_list = torch.load(self.graphs_path)
+            self._graph_list = [graph_list[idx] for idx in self.indices()]
+        if self._graph_list is None:
+            return [self.get_graph(idx) for idx in range(len(self))]
         return self._graph_list
 
     def _set_graph_list(self, graph_list):
         self._graph_list = graph_list
+
+    def get_graph(self, idx):
+        """
+        Returns the networkx graph of the equation ```idx```, built from its tensors when no graph
+        list was saved. The texts are then read back from the vocab, so texts missing from the
+        vocab come back as "<unk>".
+        """
+        if self._graph_list is not None or os.path.exists(self.graphs_path):
+            return self.get_graph_list()[idx]
+
+        data = self[idx]
+        texts = [self.vocab.get_text(index, MATHML_TAGS[tag_index]) for index, tag_index in zip(data.x.tolist(), data.tag.tolist())]
+        return self.to_networkx(data.x.tolist(), data.tag.tolist(), data.pos.tolist(), data.nums.tolist(), texts, data.edge_index, data.edge_attr)
+
+    def to_networkx(self, x, tag_x, positions, nums, texts, edge_index, edge_attr):
+        """Build the networkx graph of one equation from its node lists and edge tensors."""
+        G = nx.DiGraph() if self.graph_type == "DiGraph" else nx.Graph()
+        for uid, (index, tag_index, pos, num, text) in enumerate(zip(x, tag_x, positions, nums, texts)):
+            G.add_node(uid, tag=MATHML_TAGS[tag_index], text=text, pos=pos, index=index, num=num)
+
+        # The reversed copies of undirected edges have an edge_attr of 0
+        edge_index = edge_index[:, edge_attr == 1] if not G.is_directed() else edge_index
+        G.add_edges_from(edge_index.t().tolist())
+        return G
     
     def process(self):
-        tree = ET.parse(self.xml_path)
-        root = tree.getroot()
-        data_list = []
-        graph_list = []
+        store = EquationStore.open(self.xml_path)
+        data = None
+
+        if self.num_workers is not None and self.num_workers > 1:
+            if self._fused_trees is not None:
+                print(f"The graphs were built along with the vocab counts (fused), in one process instead of {self.num_workers}")
+            elif store is None:
+                print(f"No equation store next to the XML, building the graphs in one process instead of {self.num_workers}")
+
+        # Trees parsed along with the vocab counts
+        if self._fused_trees is not None:
+            trees, token_ids = self._fused_trees
+        elif self.num_workers is not None and self.num_workers > 1 and store is not None:
+            data, slices, texts = self.process_parallel(store)
+        else:
+            print("Generating Graph dataset...")
+            # Read the equation store when MathmlDataset wrote one, the XML otherwise
+            equations, total = load_equations(self.xml_path, 500 if self.debug else None)
+            iteration = tqdm(equations, desc="Generating Graphs", unit=" equations", total=total or len(XmlIndex(self.xml_path))) if self.verbose else equations
+            trees, token_ids = self.parse_equations(iteration)
 
-        print("Generating Graph dataset...")
-        iteration = tqdm(root, desc="Generating Graphs", unit=" equations", total=len(root)) if self.verbose else root
-        for i, formula in enumerate(iteration):
-            if self.debug and i>= 500:
-                break
-            
-            G, py_g = self.build_graph(formula)
-            if G is None or len(py_g.x) > self.max_num_nodes:
-                continue
+        if data is None:
+            data, slices = self.collate_trees(trees, token_ids)
+            texts = node_texts(trees, token_ids) if self.save_graphs else None
 
-            data_list.append(py_g)
-            graph_list.append(G)
-        
-        data, slices = self.collate(data_list)
-        # self._graph_list = graph_list
+        if self.pre_transform is not None:
+            data, slices = self.apply_pre_transform(data, slices)
 
         print("Saving data...")
-        torch.save((data, slices, graph_list), self.processed_paths[0])
-        self.data, self.slices, self._graph_list = data, slices, graph_list
+        self.save_processed(data, slices)
+        self.update_manifest()
+        self.data, self.slices, self._graph_list = data, slices, None
+
+        if self.save_graphs:
+            self.save_graph_list(data, slices, texts)
+        elif os.path.exists(self.graphs_path):
+            os.remove(self.graphs_path)
+
+    def apply_pre_transform(self, data, slices):
+        """
+        Apply ```pre_transform``` to the collated graphs, in one go when the transform can handle
+        collated data (```transform_collated```), graph by graph otherwise. The transforms of a
+        ```Compose``` are applied one after the other, each in one go when it can.
+        """
+        for transform in getattr(self.pre_transform, "transforms", [self.pre_transform]):
+            if hasattr(transform, "transform_collated"):
+                data, slices = transform.transform_collated(data, slices)
+                continue
+
+            self.data, self.slices = data, slices
+            data_list = [transform(self.get(idx)) for idx in range(len(slices["x"]) - 1)]
+            self._data_list = None
+            data, slices = self.collate(data_list)
+        return data, slices
+
+    def save_processed(self, data, slices):
+        torch.save((data, slices), self.processed_paths[0])
+
+    def save_graph_list(self, data, slices, texts):
+        """Build the networkx graphs with their original texts and save them in ```graphs.pt```"""
+        print("Saving networkx graphs...")
+        x, tag_x, positions, nums = data.x.tolist(), data.tag.tolist(), data.pos.tolist(), data.nums.tolist()
+        node_slices, edge_slices = slices["x"].tolist(), slices["edge_index"].tolist()
+
+        graph_list = []
+        for i in range(len(node_slices) - 1):
+            nodes = slice(node_slices[i], node_slices[i + 1])
+            edges = slice(edge_slices[i], edge_slices[i + 1])
+            graph_list.append(self.to_networkx(
+                x[nodes], tag_x[nodes], positions[nodes], nums[nodes], texts[nodes],
+                data.edge_index[:, edges], data.edge_attr[edges]
+            ))
+        torch.save(graph_list, self.graphs_path)
+
+    def process_parallel(self, store, chunks_per_worker=4):
+        """
+        Build the graphs with a pool of ```num_workers``` processes. Each process reads its own
+        contiguous range of equations from the equation store and returns it already collated,
+        the chunks are merged in order so the graphs keep the same indices as in a serial run.
+        """
+        print(f"Generating Graph dataset with {self.num_workers} processes...")
+        stop = min(len(store), 500) if self.debug else len(store)
+        num_chunks = max(1, min(stop, self.num_workers * chunks_per_worker))
+        bounds = np.linspace(0, stop, num_chunks + 1).astype(np.int64).tolist()
+        ranges = list(zip(bounds[:-1], bounds[1:]))
+
+        with multiprocessing.Pool(self.num_workers, initializer=init_graph_worker, initargs=(self,)) as pool:
+            chunks = pool.imap(build_graph_chunk, ranges)
+            if self.verbose:
+                chunks = tqdm(chunks, desc="Generating Graphs", unit=" chunks", total=len(ranges))
+            chunks = list(chunks)
+
+        data, slices = merge_collated([chunk for chunk, _ in chunks])
+        texts = [text for _, chunk_texts in chunks for text in chunk_texts] if self.save_graphs else None
+        return data, slices, texts
 
     def split(self, train_ratio=0.8, val_ratio=0.1, shuffle= True):
         """
@@ -113,7 +286,9 @@ class GraphDataset(InMemoryDataset):
         val_dataset = self[torch.tensor(val_indices)]
         test_dataset = self[torch.tensor(test_indices)]
 
-        # split corresponding graphs into 3 sets as well
+        # split corresponding graphs into 3 sets as well, when they are already loaded
+        if self._graph_list is None:
+            return train_dataset, val_dataset, test_dataset
         train_graph_list = [self._graph_list[idx] for idx in train_indices]
         val_graph_list = [self._graph_list[idx] for idx in val_indices]
         test_graph_list = [self._graph_list[idx] for idx in test_indices]
@@ -125,93 +300,189 @@ class GraphDataset(InMemoryDataset):
 
         return train_dataset, val_dataset, test_dataset
 
-    def build_graph(self, xml_root):
+    def parse_equations(self, equations, token_ids=None):
+        """
+        Parse the trees of the equations, dropping the ones with more than ```max_num_nodes``` nodes.
+
+        Returns:
+            tuple: the trees (tokens, positions, numbers and parent uids of their nodes) and the
+                (tag, text) -> token id table of their tokens.
+        """
+        token_ids = {} if token_ids is None else token_ids
+        trees = []
+        for nodes in equations:
+            tags, texts, positions, nums, parents = self.parse_tree(nodes)
+            if len(tags) > self.max_num_nodes:
+                continue
+            tokens = [token_ids.setdefault(token, len(token_ids)) for token in zip(tags, texts)]
+            trees.append((tokens, positions, nums, parents))
+        return trees, token_ids
+
+    def parse_fused(self):
         """
-        Build a networkx graph and a corresponding PyTorch Geometric Data object from XML data.
+        Count the vocab and parse the trees in a single pass over the equations.
+
+        The (tag, text) counts of the vocab are gathered while the trees are parsed. The vocab is
+        finalised at the end of the pass, before the tokens are remapped by ```collate_trees```.
+        """
+        print("Generating vocab and Graph dataset in one pass...")
+        # Same number of equations as the separate passes: 10000 counted by the vocab, 500 graphs
+        equations, total = load_equations(self.xml_path, 10000 if self.debug else None)
+        iteration = tqdm(equations, desc="Generating vocab and Graphs", unit=" equations", total=total or len(XmlIndex(self.xml_path))) if self.verbose else equations
+
+        xml_elements = {tag:dict() for tag in MATHML_TAGS}
+        token_ids = {}
+        trees = []
+        for i, nodes in enumerate(iteration):
+            texts = [clean_text(node.text) for node in nodes]
+            for node, text in zip(nodes, texts):
+                xml_elements[node.tag][text] = xml_elements[node.tag].get(text,0) + 1
+
+            if self.debug and i >= 500:
+                continue
+            tags, texts, positions, nums, parents = self.parse_tree(nodes, texts)
+            if len(tags) > self.max_num_nodes:
+                continue
+            tokens = [token_ids.setdefault(token, len(token_ids)) for token in zip(tags, texts)]
+            trees.append((tokens, positions, nums, parents))
+
+        self.vocab.set_xml_elements(xml_elements)
+        return trees, token_ids
+
+    def build_graph(self, nodes):
+        """
+        Build a PyTorch Geometric Data object from the nodes of an equation.
 
         Args:
-            xml_root (Element): The root element of the XML structure containing mathematical formula data.
+            nodes (list): The nodes of one equation in document order, as yielded by ```iter_equations```.
 
         Returns:
-            tuple: A tuple containing a networkx Graph (G) and a PyTorch Geometric Data object (py_g).
+            Data: The PyTorch Geometric graph (py_g), its networkx graph is built on request by ```get_graph```.
         """
-        if self.graph_type == "Graph":
-            G = nx.Graph()
-        elif self.graph_type =="DiGraph":
-            G = nx.DiGraph()
-        else:
-            G = nx.Graph()
+        tags, texts, positions, nums, parents = self.parse_tree(nodes)
+        token_ids = {}
+        tokens = [token_ids.setdefault(token, len(token_ids)) for token in zip(tags, texts)]
+        data, _ = self.collate_trees([(tokens, positions, nums, parents)], token_ids)
+        return data
 
-        x, positions, tags, nums = [], [], [], []
+    def parse_tree(self, nodes, texts=None):
+        """
+        Select the nodes of an equation kept in its tree graph.
 
-        def add_to_list(index, tag_id, pos, num):
-            """Helper function to add node attributes to lists."""
-            x.append(index)
-            tags.append(tag_id)
-            positions.append(pos)
-            nums.append(num)
-        
-        def create_node(element,parent_uid=0):
-            """Recursive function to create nodes and edges in the graph."""
-            global uid
-
-            # Adding parent node "math"
-            if len(G.nodes) == 0:
-                tag = rn(element.tag)
-                text = "" if element.text is None else clean_text(element.text)
-                index, tag_index = self.get_index_from_vocab(tag,text)
-
-                G.add_node(0,tag=tag,text=text,pos=0, index=index, num=-1) # set parent node: math with uid=0
-                add_to_list(index,tag_index,pos=0,num=-1)
-                uid = 1                               # start new nodes from uid=1
-
-            # Go through each child
-            for i, child in enumerate(element):
-                tag = rn(child.tag)
-                text = "" if child.text is None else clean_text(child.text)
-                index, tag_index = self.get_index_from_vocab(tag,text)
-                pos = max(i,255)
-                
+        Args:
+            nodes (list): The nodes of one equation in document order, as yielded by ```iter_equations```.
+            texts (list): The cleaned texts of the nodes, cleaned here if not given.
+
+        Returns:
+            tuple: tags, texts, positions, numbers and parent uid (-1 for the root) of the graph nodes.
+        """
+        if texts is None:
+            texts = [clean_text(node.text) for node in nodes]
+        tags, kept_texts, positions, nums, parents = [], [], [], [], []
+
+        # uid of each node in the graph, None if the node is left out
+        uids = [None] * len(nodes)
+        # parents that stopped adding children after a "mn" that isn't a number
+        stopped = set()
+
+        for i, (node, text) in enumerate(zip(nodes, texts)):
+            tag = node.tag
+
+            # Adding parent node "math" with uid=0
+            if node.parent == -1:
+                parent_uid, pos, num = -1, 0, -1
+            else:
+                # Skip the children of removed nodes and the siblings following a bad "mn"
+                parent_uid = uids[node.parent]
+                if parent_uid is None or node.parent in stopped:
+                    continue
+
+                pos = max(node.position,255)
                 num = -1
                 if tag == "mn":
                     try: 
                         num = float(text)
                     except:
-                        return None
-                    
-
-                # Add new node and edge between himself and the parent
-                G.add_node(uid, tag=tag, text=text,pos=pos, index=index, num=num)
-                add_to_list(index,tag_index,pos=pos,num=num)
-                G.add_edge(parent_uid, uid)
-                uid += 1
-
-                # Check for children itself and if one or more is found, recursive call
-                children = [x for x in child]
-                if children:
-                    create_node(child,uid-1)
-        
-        create_node(xml_root,0)
-
-        # Extract edge index
-        edge_index = torch.tensor(list(G.edges), dtype=torch.long).t().contiguous()
-        edge_features = torch.ones((edge_index.shape[1],)) #(edge_index.shape[1],1)
-        if not G.is_directed():
-            edge_index = torch.cat([edge_index, edge_index.flip(0)], dim=1)
-            edge_features = torch.cat([edge_features, torch.zeros(edge_features.shape)],dim=0)
-        
-        # Create pytorch geometric graph
-        py_g = Data(
-            x=torch.tensor(x,dtype=torch.long),
-            edge_index= edge_index,
-            edge_attr= edge_features,
-            tag = torch.tensor(tags,dtype=torch.long),
-            pos=torch.tensor(positions,dtype=torch.long),
-            nums = torch.tensor(nums,dtype=torch.float32),
+                        stopped.add(node.parent)
+                        continue
+
+            uids[i] = len(tags)
+            tags.append(tag)
+            kept_texts.append(text)
+            positions.append(pos)
+            nums.append(num)
+            parents.append(parent_uid)
+
+        return tags, kept_texts, positions, nums, parents
+
+    def collate_trees(self, trees, token_ids):
+        """
+        Build the collated data and slices of the parsed trees straight from flat arrays,
+        the same output as ```InMemoryDataset.collate``` without a Data object per graph.
+
+        Args:
+            trees (list): (tokens, positions, numbers, parent uids) of each graph
+            token_ids (dict): (tag, text) -> token id table of the tokens
+
+        Returns:
+            tuple: data and slices
+        """
+        # Vectorised remap of the tokens to vocab and tag indices
+        lookup = np.array([self.get_index_from_vocab(tag, text) for tag, text in token_ids], dtype=np.int64).reshape(-1, 2)
+
+        num_nodes = np.array([len(tokens) for tokens, _, _, _ in trees], dtype=np.int64)
+        node_slices = np.concatenate([[0], np.cumsum(num_nodes)])
+        tokens = np.fromiter((token for tree in trees for token in tree[0]), dtype=np.int64, count=node_slices[-1])
+        positions = np.fromiter((pos for tree in trees for pos in tree[1]), dtype=np.int64, count=node_slices[-1])
+        nums = np.fromiter((num for tree in trees for num in tree[2]), dtype=np.float32, count=node_slices[-1])
+        parents = np.fromiter((parent for tree in trees for parent in tree[3]), dtype=np.int64, count=node_slices[-1])
+
+        # Edges (parent, child) grouped by parent, children in document order. Parents are
+        # made global so one stable sort orders the edges of every graph at once.
+        children = np.flatnonzero(parents >= 0)
+        graph_offsets = np.repeat(node_slices[:-1], num_nodes)
+        children = children[np.argsort(parents[children] + graph_offsets[children], kind="stable")]
+        edges = np.stack([parents[children], children - graph_offsets[children]])
+        edge_attr = np.ones(edges.shape[1], dtype=np.float32)
+
+        # Each graph has one edge per node but its root
+        num_edges = np.maximum(num_nodes - 1, 0)
+        if self.graph_type != "DiGraph":
+            # Per graph: its edges followed by their reversed copies, with an edge_attr of 0
+            graph_ids = np.repeat(np.arange(len(trees)), num_edges)
+            edge_offsets = np.concatenate([[0], np.cumsum(num_edges)])[:-1]
+            forward = np.arange(edges.shape[1]) + edge_offsets[graph_ids]
+            backward = forward + num_edges[graph_ids]
+
+            undirected = np.empty((2, 2 * edges.shape[1]), dtype=np.int64)
+            undirected[:, forward] = edges
+            undirected[:, backward] = edges[::-1]
+            edges = undirected
+
+            edge_attr = np.zeros(edges.shape[1], dtype=np.float32)
+            edge_attr[forward] = 1
+            num_edges = 2 * num_edges
+        edge_slices = np.concatenate([[0], np.cumsum(num_edges)])
+
+        data = Data(
+            x=torch.from_numpy(lookup[tokens, 0]),
+            edge_index=torch.from_numpy(edges),
+            edge_attr=torch.from_numpy(edge_attr),
+            pos=torch.from_numpy(positions),
+            tag=torch.from_numpy(lookup[tokens, 1]),
+            nums=torch.from_numpy(nums),
         )
+        node_slices, edge_slices = torch.from_numpy(node_slices), torch.from_numpy(edge_slices)
+        slices = {
+            "x": node_slices,
+            "edge_index": edge_slices,
+            "edge_attr": edge_slices.clone(),
+            "pos": node_slices.clone(),
+            "tag": node_slices.clone(),
+            "nums": node_slices.clone(),
+        }
+        return data, slices
 
-        return G, py_g
-    
     def get_index_from_vocab(self, tag, text):
         """
         Return an index based on the type of vocabulary used.
@@ -242,6 +513,45 @@ class GraphDataset(InMemoryDataset):
                 index = self.vocab.vocab_table[tag].get(text,self.unknown_id)
         
         return index, tag_index
-    
-    
 
+
+# Set in each process of the pool by ```init_graph_worker```
+_worker_dataset = None
+_worker_store = None
+
+def init_graph_worker(dataset):
+    global _worker_dataset, _worker_store
+    _worker_dataset = dataset
+    _worker_store = EquationStore.open(dataset.xml_path)
+
+def build_graph_chunk(bounds):
+    """
+    Returns the collated data and slices of the equations ```bounds[0]``` to ```bounds[1]```, and
+    the texts of their nodes when the networkx graphs are saved.
+    """
+    start, stop = bounds
+    trees, token_ids = _worker_dataset.parse_equations(_worker_store.iter_equations(start, stop))
+    texts = node_texts(trees, token_ids) if _worker_dataset.save_graphs else None
+    return _worker_dataset.collate_trees(trees, token_ids), texts
+
+def node_texts(trees, token_ids):
+    """Returns the cleaned texts of all the nodes of the parsed trees, in node order."""
+    token_texts = [text for _, text in token_ids]
+    return [token_texts[token] for tokens, _, _, _ in trees for token in tokens]
+
+def merge_collated(chunks):
+    """
+    Concatenate collated (data, slices) chunks. Edge indices are local to each graph, so only
+    the slices have to be shifted by the size of the previous chunks.
+    """
+    data_list = [data for data, _ in chunks]
+    data = Data(**{key: torch.cat([chunk[key] for chunk in data_list], dim=-1 if key == "edge_index" else 0) for key in data_list[0].keys()})
+
+    slices = {}
+    for key in chunks[0][1]:
+        merged, offset = [chunks[0][1][key][:1]], 0
+        for _, chunk_slices in chunks:
+            merged.append(chunk_slices[key][1:] + offset)
+            offset += int(chunk_slices[key][-1])
+        slices[key] = torch.cat(merged)
+    return data, slices
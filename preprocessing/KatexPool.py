@@ -0,0 +1,197 @@
+import itertools
+import json
+import os
+import queue
+import subprocess
+import threading
+import time
+
+NODE_BIN_DIR = "/data/nsam947/libs/node-v20.13.1-linux-x64/bin"
+
+
+class KatexPool():
+    """
+    Pool of long-lived ``node tex2mathml_worker.js`` processes.
+
+    Each worker loads KaTeX once and then answers newline-delimited JSON requests, so the
+    Node startup is only paid once per worker instead of once per batch. Equations of a batch
+    are spread over all the workers and several batches can be in flight at the same time.
+    """
+    def __init__(self, num_workers=None, timeout=120):
+        self.num_workers = max(1, num_workers or os.cpu_count() or 1)
+        self.timeout = timeout
+
+        current_file_path = os.path.dirname(os.path.abspath(__file__))
+        self.root_folder = os.path.dirname(current_file_path)
+        self.script_path = os.path.join(self.root_folder, "node", "tex2mathml_worker.js")
+
+        # Add the directory where node is installed to PATH
+        self.env = os.environ.copy()
+        self.env["PATH"] = NODE_BIN_DIR + os.pathsep + self.env["PATH"]
+
+        self._ids = itertools.count()
+        self._results = {}
+        self._abandoned = set()
+        self._condition = threading.Condition()
+        self.workers = [self._spawn() for _ in range(self.num_workers)]
+        self._next_worker = 0
+
+    def _spawn(self):
+        process = subprocess.Popen(
+            ["node", self.script_path],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            cwd=self.root_folder,
+            env=self.env,
+            text=True,
+            encoding="utf-8",
+        )
+        worker = {"process": process, "queue": queue.Queue(), "pending": set()}
+        threading.Thread(target=self._write, args=(worker,), daemon=True).start()
+        threading.Thread(target=self._read, args=(worker,), daemon=True).start()
+        return worker
+
+    def _write(self, worker):
+        """Feed the queued requests to the worker stdin."""
+        stdin = worker["process"].stdin
+        while True:
+            lines = worker["queue"].get()
+            if lines is None:
+                stdin.close()
+                break
+            try:
+                stdin.write(lines)
+                stdin.flush()
+            except (BrokenPipeError, OSError, ValueError):
+                break
+
+    def _read(self, worker):
+        """Collect the answers of the worker until its stdout closes."""
+        for line in worker["process"].stdout:
+            try:
+                response = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            with self._condition:
+                uid = response.get("id")
+                worker["pending"].discard(uid)
+                if uid in self._abandoned:
+                    self._abandoned.discard(uid)
+                elif "version" in response:
+                    self._results[uid] = response["version"]
+                else:
+                    self._results[uid] = response.get("mathml")
+                self._condition.notify_all()
+
+        # The worker died: whatever it still had to convert is lost
+        with self._condition:
+            for uid in worker["pending"]:
+                if uid in self._abandoned:
+                    self._abandoned.discard(uid)
+                else:
+                    self._results[uid] = None
+            worker["pending"].clear()
+            self._condition.notify_all()
+
+    def _replace_dead_workers(self):
+        """Replace the workers that died since the last request (killed when stuck, crashed)."""
+        for i, worker in enumerate(self.workers):
+            if worker["process"].poll() is not None:
+                self.workers[i] = self._spawn()
+
+    def submit(self, latex_equations):
+        """
+        Send a batch of equations to the workers without waiting for the results.
+
+        Args:
+        - latex_equations (list): Tex equations to convert
+
+        Returns:
+        - ids (list): request ids to give to ```collect```
+        """
+        self._replace_dead_workers()
+        ids = [next(self._ids) for _ in latex_equations]
+        requests = [[] for _ in self.workers]
+        for uid, latex in zip(ids, latex_equations):
+            requests[self._next_worker].append((uid, latex))
+            self._next_worker = (self._next_worker + 1) % self.num_workers
+
+        for worker, worker_requests in zip(self.workers, requests):
+            if not worker_requests:
+                continue
+            with self._condition:
+                worker["pending"].update(uid for uid, _ in worker_requests)
+            lines = "".join(json.dumps({"id": uid, "latex": latex}) + "\n" for uid, latex in worker_requests)
+            worker["queue"].put(lines)
+        return ids
+
+    def collect(self, ids):
+        """
+        Wait for the results of a submitted batch.
+
+        Returns:
+        - results (list): MathML strings in the same order as the submitted equations,
+            None for the ones that could not be converted in time
+        """
+        deadline = time.monotonic() + self.timeout
+        with self._condition:
+            while not all(uid in self._results for uid in ids):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+
+            results = [self._results.pop(uid, None) for uid in ids]
+            missing = {uid for uid, result in zip(ids, results) if result is None}
+            stuck = [worker for worker in self.workers if worker["pending"] & missing]
+            for worker in stuck:
+                self._abandoned.update(worker["pending"] & missing)
+
+        # Workers stuck on an equation are restarted at the next submit
+        for worker in stuck:
+            worker["process"].kill()
+            worker["process"].wait()
+        return results
+
+    def version(self):
+        """Returns the version of KaTeX loaded by the workers."""
+        self._replace_dead_workers()
+        worker = self.workers[0]
+        uid = next(self._ids)
+        with self._condition:
+            worker["pending"].add(uid)
+        worker["queue"].put(json.dumps({"id": uid, "version": True}) + "\n")
+        return self.collect([uid])[0]
+
+    def convert(self, latex_equations):
+        """Convert a single batch of equations, blocking until it's done."""
+        return self.collect(self.submit(latex_equations))
+
+    def imap(self, batches, prefetch=2):
+        """
+        Convert an iterable of batches, keeping ```prefetch``` batches in flight so the
+        workers never wait for the python side.
+        """
+        in_flight = []
+        for batch in batches:
+            in_flight.append(self.submit(batch))
+            if len(in_flight) > prefetch:
+                yield self.collect(in_flight.pop(0))
+        while in_flight:
+            yield self.collect(in_flight.pop(0))
+
+    def close(self):
+        for worker in self.workers:
+            worker["queue"].put(None)
+        for worker in self.workers:
+            try:
+                worker["process"].wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                worker["process"].kill()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
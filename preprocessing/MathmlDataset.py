@@ -1,13 +1,17 @@
 import html
+import itertools
 import json
 import os
 import re
-import subprocess
 import xml.etree.ElementTree as ET
 from torch.utils.data import Dataset
-from datasets import load_dataset
+from datasets import load_dataset, Dataset as HFDataset
 from tqdm import tqdm
 from config import ROOT_DIR
+from preprocessing.ConversionCache import ConversionCache
+from preprocessing.EquationStore import EquationStore
+from preprocessing.KatexPool import KatexPool
+from preprocessing.XmlStream import XmlIndex, XmlWriter, is_incomplete, stitch_shards
 
 EXCLUDED_COMMANDS = [
     r"\\begin{align\*?}", r"\\end{align\*?}",  # align and align*
@@ -44,6 +48,9 @@ EXCLUDED_COMMANDS = [
     r"\\mathbb\b"  # \mathbb
 ]
 
+# Compiled once, every formula goes through it
+EXCLUDED_PATTERN = re.compile('|'.join(EXCLUDED_COMMANDS))
+
 DATASET_NAMES = {
     "OleehyO": "OleehyO/latex-formulas",
     "sample": "dataset/latex_examples.json",
@@ -51,14 +58,20 @@ DATASET_NAMES = {
 }
 
 class MathmlDataset(Dataset):
-    def __init__(self, xml_name:str, latex_set="OleehyO", force_reload=False, debug=False, select_raw=False, batch_size=1000, verbose=False):
+    def __init__(self, xml_name:str, latex_set="OleehyO", force_reload=False, debug=False, select_raw=False, batch_size=1000, verbose=False, num_workers=None, resume=True, use_cache=True, num_shards=None, write_store=True):
         self.latex_set = latex_set if latex_set in DATASET_NAMES.keys() else None
         self.force_reload = force_reload
         self.debug = debug
         self.verbose = verbose
         self.select_raw = select_raw
         self.batch_size = batch_size
-        self.root = None
+        self.num_workers = num_workers
+        self.resume = resume
+        self.use_cache = use_cache
+        self.num_shards = num_shards
+        self.write_store = write_store
+        self.index = None
+        self.store = None
         self.stats = {
             "success": 0,
             "error": 0,
@@ -74,6 +87,7 @@ class MathmlDataset(Dataset):
         self.xml_dir = os.path.join(root_path,xml_name)
         self.xml_path = os.path.join(root_path,xml_name,"raw/equations.xml")
         self.latex_path = DATASET_NAMES.get(latex_set,None)
+        self.cache_path = os.path.join(root_path,"katex_cache.sqlite")
 
         if not os.path.exists(self.xml_dir):
             os.makedirs(self.xml_dir)
@@ -82,7 +96,7 @@ class MathmlDataset(Dataset):
         if not os.path.exists(raw_dir):
             os.makedirs(raw_dir)
 
-        if not os.path.exists(self.xml_path) or force_reload:
+        if not os.path.exists(self.xml_path) or force_reload or is_incomplete(self.xml_path):
             self.process_data()
         else:
             self.load_xml()
@@ -91,59 +105,101 @@ class MathmlDataset(Dataset):
     def process_data(self):
 
         print("Loading Latex dataset...")
-        all_equations = self.load_latex()
-
-        # Create the root element with the <span class="katex"> tag
-        ET.register_namespace('', 'http://www.w3.org/1998/Math/MathML')
-        self.root = ET.Element("span", attrib={"class": "katex"})
-
-        # Go through by batch and convert to XML
-        batch_equations = process_equations_in_batches(all_equations,self.batch_size)
-        iteration = tqdm(batch_equations, desc="Generating XML",unit=" batch", total=int(len(all_equations)/self.batch_size)) if self.verbose else batch_equations
-        for i,batch in enumerate(iteration):
-            if self.debug and i>5:
-                break
-
-            # Clean formulas and convert with katex nodejs
-            cleaned_batch = [remove_commands(formula) for formula in batch]
-            mathml_results = call_js(cleaned_batch)
-
-            if mathml_results:
-                for mathml_string in mathml_results:
-                    try:
-                        # Parse the MathML string into an ElementTree element
-                        span_element = ET.fromstring(mathml_string)
-                        mathml_element = span_element.find("{http://www.w3.org/1998/Math/MathML}math")
-
-                        if mathml_element is not None:
-                            # Append the <math> element to the root <span class="katex"> element
-                            self.root.append(mathml_element)
-                            self.stats["success"] += 1
-                        else:
-                            self.stats["NoneType"] += 1
-                    except TypeError as e:
-                        self.stats["TypeError"] += 1
-                    except Exception as e:
-                        self.stats["error"] += 1
-        # Save dataset
-        print("Saving XML...")
-        tree = ET.ElementTree(self.root)
-        tree.write(self.xml_path, encoding="utf-8", xml_declaration=True)
+        all_equations = self.load_latex(clean=True)
+        if self.debug:
+            all_equations = all_equations[:6 * self.batch_size]
 
-    
+        # A forced reload starts over even after an interrupted run
+        resume = self.resume and not self.force_reload
+
+        if self.num_shards is not None and self.num_shards > 1:
+            self.process_shards(all_equations, resume)
+        else:
+            convert_to_xml(
+                all_equations, self.xml_path, self.stats,
+                batch_size=self.batch_size, num_workers=self.num_workers, resume=resume,
+                cache_path=self.cache_path if self.use_cache else None, verbose=self.verbose
+            )
+
+        print(f"Saved XML to {self.xml_path}")
+        self.load_xml()
 
-    def load_latex(self):
+    def process_shards(self, all_equations, resume=True):
+        """
+        Convert the equations with one process per shard. Each process owns its KaTeX worker and
+        writes its own XML shard, the shards listed in the manifest are then stitched together.
+        """
+        shard_dir = os.path.join(self.xml_dir,"raw/shards")
+        if not os.path.exists(shard_dir):
+            os.makedirs(shard_dir)
+
+        # datasets.map gives each process one contiguous shard, in the same order as the equations
+        equations = HFDataset.from_dict({"latex_formula": list(all_equations)})
+        num_proc = min(self.num_shards, len(equations))
+        ranges = shard_ranges(len(equations), num_proc)
+        shards = equations.map(
+            convert_shard,
+            batched=True,
+            batch_size=None,
+            with_rank=True,
+            num_proc=num_proc,
+            input_columns="latex_formula",
+            remove_columns=equations.column_names,
+            load_from_cache_file=False,
+            fn_kwargs={
+                "shard_dir": shard_dir,
+                "ranges": ranges,
+                "batch_size": self.batch_size,
+                "resume": resume,
+                "cache_path": self.cache_path if self.use_cache else None,
+            },
+            desc="Converting shards",
+        )
+
+        manifest = {"num_shards": num_proc, "shards": []}
+        for shard, (start, stop) in zip(shards, ranges):
+            shard_stats = json.loads(shard["stats"])
+            manifest["shards"].append({"path": shard["path"], "start": start, "stop": stop, "stats": shard_stats})
+            for key, value in shard_stats.items():
+                self.stats[key] = self.stats.get(key, 0) + value
+
+        manifest_path = os.path.join(shard_dir,"manifest.json")
+        with open(manifest_path,"w+") as f:
+            json.dump(manifest, f)
+
+        print("Stitching XML shards...")
+        stitch_shards(manifest_path, self.xml_path)
+
+        # Shards of a previous run with more shards aren't part of this one
+        shard_paths = {shard["path"] for shard in manifest["shards"]}
+        for file_name in os.listdir(shard_dir):
+            path = os.path.join(shard_dir, file_name)
+            if file_name.startswith("equations-") and not any(path.startswith(shard_path) for shard_path in shard_paths):
+                os.remove(path)
+
+    def load_latex(self, clean=False):
         """
         Method to load the selected latex set
+
+        Args:
+        - clean (bool): remove the ```EXCLUDED_COMMANDS``` from the formulas
         """
         if self.latex_set == "OleehyO":
             formulas = "raw_formulas" if self.select_raw else "cleaned_formulas"
             data = load_dataset(self.latex_path, formulas, trust_remote_code=True, split="train")
+            if self.debug:
+                # process_data only converts the first 6 batches in debug mode
+                data = data.select(range(min(len(data), 6 * self.batch_size)))
+            if clean:
+                data = data.map(clean_batch, batched=True, num_proc=self.num_workers, input_columns="latex_formula", desc="Cleaning formulas")
+                return data["cleaned_formula"]
             return data["latex_formula"]
         
         elif self.latex_set == "sample":
             with open(self.latex_path,"r") as f:
                 data = json.load(f)
+            if clean:
+                return [remove_commands(formula) for formula in data["train"]]
             return data["train"]
 
         elif self.latex_set == "Pfahler":
@@ -152,16 +208,126 @@ class MathmlDataset(Dataset):
 
 
     def load_xml(self):
-        tree = ET.parse(self.xml_path)
-        self.root = tree.getroot()
+        """
+        Load (or build) the byte-offset index of the equations and their binary store, the XML
+        itself is only parsed one equation at a time in ```__getitem__```.
+        """
+        self.index = XmlIndex(self.xml_path)
+
+        # The downstream stages read the equation store instead of parsing the XML again
+        if self.write_store:
+            self.store = EquationStore.open(self.xml_path)
+            if self.store is None:
+                print("Writing equation store...")
+                self.store = EquationStore.build(self.xml_path, verbose=self.verbose)
 
     def __len__(self):
-        return len(self.root)
+        return len(self.index)
 
     def __getitem__(self, idx):
-        return self.root[idx]
+        return self.index[idx]
+
+
+
+def convert_to_xml(equations, xml_path, stats, batch_size=1000, num_workers=None, resume=True, cache_path=None, verbose=False, params=None):
+    """
+    Convert cleaned Tex equations with a pool of KaTeX workers and stream them into ```xml_path```.
+
+    Args:
+    - equations (list): cleaned Tex equations
+    - xml_path (string): XML file to write
+    - stats (dict): conversion stats, updated in place
+    - cache_path (string): path of the conversion cache, None to disable it
+    - params (dict): more parameters a run must share to be resumed (see ```XmlWriter```)
 
+    Returns:
+    - stats (dict): conversion stats
+    """
+    batch_equations = process_equations_in_batches(equations, batch_size)
+
+    # The XML is written batch by batch, skip the batches already committed by a previous run. It
+    # only resumes a run that split the same equations in the same batches
+    params = {"batch_size": batch_size, "num_equations": len(equations), **(params or {})}
+    with XmlWriter(xml_path, resume=resume, params=params) as writer:
+        stats.update(writer.stats)
+        batch_equations = itertools.islice(batch_equations, writer.batches, None)
+
+        # Convert the cleaned formulas with the pool of katex nodejs workers
+        cleaned_batches = (list(batch) for batch in batch_equations)
+        with KatexPool(num_workers) as pool:
+            cache = open_cache(pool, cache_path)
+            try:
+                converted_batches = cache.imap(pool, cleaned_batches) if cache is not None else pool.imap(cleaned_batches)
+                iteration = tqdm(converted_batches, desc="Generating XML",unit=" batch", total=int(len(equations)/batch_size), initial=writer.batches) if verbose else converted_batches
+                for mathml_results in iteration:
+                    writer.write_batch(parse_results(mathml_results, stats), stats)
+            finally:
+                # Also closes the connection and its WAL when a worker fails
+                if cache is not None:
+                    print(f"Conversion cache: {cache.hits} hits, {cache.misses} misses")
+                    cache.close()
+    return stats
+
+def convert_shard(equations, rank, shard_dir, ranges, batch_size=1000, resume=True, cache_path=None):
+    """
+    ```datasets.map``` function converting a whole shard with its own KaTeX worker.
+
+    The shard only resumes the progress of a run that gave it the same equations: the number of
+    shards and the range of the shard are stored with its progress.
 
+    Args:
+    - ranges (list): (start, stop) of the equations of every shard, see ```shard_ranges```
+
+    Returns:
+    - dict: one row with the path of the XML shard and its conversion stats
+    """
+    shard_path = os.path.join(shard_dir, f"equations-{rank:05d}.xml")
+    start, stop = ranges[rank]
+    params = {"num_shards": len(ranges), "start": start, "stop": stop}
+    stats = {"success": 0, "error": 0, "TypeError": 0, "NoneType": 0}
+    convert_to_xml(equations, shard_path, stats, batch_size=batch_size, num_workers=1, resume=resume, cache_path=cache_path, params=params)
+    return {"path": [shard_path], "stats": [json.dumps(stats)]}
+
+def shard_ranges(num_equations, num_shards):
+    """(start, stop) of each shard, split as ```datasets.Dataset.shard(contiguous=True)``` does for ```map```"""
+    size, remainder = divmod(num_equations, num_shards)
+    starts = [size * rank + min(rank, remainder) for rank in range(num_shards)]
+    return [(start, start + size + (1 if rank < remainder else 0)) for rank, start in enumerate(starts)]
+
+def open_cache(pool:KatexPool, cache_path):
+    """
+    Open the LaTeX -> MathML cache shared by all the xml datasets, keyed on the KaTeX version of the pool.
+    """
+    if cache_path is None:
+        return None
+    katex_version = pool.version()
+    if katex_version is None:
+        print("Couldn't get the KaTeX version, the conversion cache is disabled")
+        return None
+    return ConversionCache(cache_path, katex_version)
+
+def parse_results(mathml_results, stats):
+    """
+    Parse the MathML strings returned by KaTeX and returns the <math> elements.
+    """
+    elements = []
+    if mathml_results:
+        for mathml_string in mathml_results:
+            try:
+                # Parse the MathML string into an ElementTree element
+                span_element = ET.fromstring(mathml_string)
+                mathml_element = span_element.find("{http://www.w3.org/1998/Math/MathML}math")
+
+                if mathml_element is not None:
+                    elements.append(mathml_element)
+                    stats["success"] += 1
+                else:
+                    stats["NoneType"] += 1
+            except TypeError as e:
+                stats["TypeError"] += 1
+            except Exception as e:
+                stats["error"] += 1
+    return elements
 
 def process_equations_in_batches(equations, batch_size=1000):
     for i in range(0, len(equations), batch_size):
@@ -177,60 +343,21 @@ def remove_commands(text):
     Returns:
     - text (string): output Latex equation
     """
-    # Construct a regular expression pattern to match any of the specified commands
-    pattern = '|'.join(EXCLUDED_COMMANDS)
-
     # Replace all occurrences of the pattern with an empty string
-    return re.sub(pattern, '', text)
-
-def call_js(latex_equations, paper_id=""):
-    try:
-        current_file_path = os.path.dirname(os.path.abspath(__file__))
-        root_folder = os.path.dirname(current_file_path)
-        script_path = os.path.join(root_folder,"node" ,"tex2mathml_simple.js")
-
-        # Add the directory where node is installed to PATH
-        env = os.environ.copy()
-        node_bin_dir = "/data/nsam947/libs/node-v20.13.1-linux-x64/bin"
-        env["PATH"] = node_bin_dir + os.pathsep + env["PATH"]
-
-        # logging.debug("Running tex2mathml.js with environment PATH: {}".format(env["PATH"]))
-
-        result = subprocess.run(
-            [script_path],
-            input=json.dumps(latex_equations),
-            cwd=root_folder,
-            env=env,
-            universal_newlines=True,
-            text=True,
-            capture_output=True,
-            timeout=120
-        )
-
-        # logging.debug("stderr output: {}".format(result.stderr))
-        # logging.debug("stdout output: {}".format(result.stdout))
+    return EXCLUDED_PATTERN.sub('', text)
 
-        raw_output = result.stdout.strip()
-        # logging.debug("Raw output before JSON parsing: {}".format(raw_output))
+def clean_batch(formulas):
+    """
+    Batched version of ```remove_commands``` for ```datasets.Dataset.map(batched=True)```.
 
-        # if result.stderr:
-        #     logging.warning("Unexpected error in tex2mathml.js (Arxiv ID: {}):".format(paper_id) + result.stderr)
+    Args:
+    - formulas (list): batch of the "latex_formula" column
 
-        if raw_output:
-            try:
-                result_data = json.loads(raw_output)
-                return result_data
-            except json.JSONDecodeError as e:
-                # logging.error("JSON decoding failed: {}".format(e))
-                return None
-
-    except subprocess.TimeoutExpired:
-        # logging.warning("Timeout for paper {}: \n".format(paper_id) + "\n")
-        return False
-    except Exception as e:
-        # logging.error("Error calling tex2mathml.js: {}".format(e))
-        return False
-    
+    Returns:
+    - dict: the "cleaned_formula" column
+    """
+    sub = EXCLUDED_PATTERN.sub
+    return {"cleaned_formula": [sub('', formula) for formula in formulas]}
 
 if __name__=="__main__":
     # Usage example
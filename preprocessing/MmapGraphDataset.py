@@ -0,0 +1,74 @@
+import json
+import os
+
+import numpy as np
+import torch
+from torch_geometric.data import Data
+from torch_geometric.data.separate import separate
+
+from preprocessing.GraphDataset import GraphDataset
+
+ON_DISK_DIR = "on_disk"
+
+
+class MmapGraphDataset(GraphDataset):
+    """
+    On-disk variant of ```GraphDataset```.
+
+    The collated tensors (x, tag, pos, nums, edge_index, edge_attr) and their slices are saved
+    as flat npy arrays and memory-mapped on load instead of being unpickled from ```data.pt```.
+    Graphs are zero-copy slices of the mapped arrays, so the dataset doesn't have to fit in RAM
+    and the DataLoader workers share the same pages of the page cache.
+    """
+    @property
+    def processed_file_names(self):
+        return [os.path.join(ON_DISK_DIR, "meta.json")]
+
+    @property
+    def on_disk_dir(self):
+        return os.path.join(self.processed_dir, ON_DISK_DIR)
+
+    def process(self):
+        # Reuse the data.pt of a GraphDataset built with the same root instead of rebuilding it
+        data_path = os.path.join(self.processed_dir, "data.pt")
+        if os.path.exists(data_path) and not self.force_reload:
+            print("Converting data.pt to memory-mapped arrays...")
+            processed = torch.load(data_path)
+            if len(processed) > 2:
+                torch.save(processed[2], self.graphs_path)
+            self.save_processed(processed[0], processed[1])
+            self.data, self.slices, self._graph_list = processed[0], processed[1], None
+        else:
+            super().process()
+
+    def save_processed(self, data, slices):
+        os.makedirs(self.on_disk_dir, exist_ok=True)
+        for key in data.keys():
+            np.save(os.path.join(self.on_disk_dir, f"{key}.npy"), data[key].numpy())
+            np.save(os.path.join(self.on_disk_dir, f"slices_{key}.npy"), slices[key].numpy())
+
+        # Written last, an interrupted save is processed again
+        with open(self.processed_paths[0], "w+") as f:
+            json.dump({"keys": list(data.keys())}, f)
+
+    def load_processed(self):
+        with open(self.processed_paths[0], "r") as f:
+            keys = json.load(f)["keys"]
+
+        # Copy-on-write mapping: pages are shared until a tensor is modified in place
+        def load(name):
+            return torch.from_numpy(np.load(os.path.join(self.on_disk_dir, f"{name}.npy"), mmap_mode="c"))
+
+        data = Data(**{key: load(key) for key in keys})
+        slices = {key: load(f"slices_{key}") for key in keys}
+        return data, slices, None
+
+    def get(self, idx):
+        # InMemoryDataset.get keeps a copy of every graph it returns, the slices are enough here
+        return separate(
+            cls=self._data.__class__,
+            batch=self._data,
+            idx=idx,
+            slice_dict=self.slices,
+            decrement=False,
+        )
@@ -0,0 +1,69 @@
+import torch
+from torch_geometric.transforms import BaseTransform
+
+from models.Graph.NegativeSampling import in_graph_negative_sampling
+
+
+class NegativePool(BaseTransform):
+    """
+    Pre-transform storing ```num_pools``` sets of negative edges with each graph.
+
+    Each pool is drawn inside the graph by ```in_graph_negative_sampling```. The pools are kept
+    together in ```neg_edge_index``` and ```neg_slot``` gives the pool of each edge. Like
+    ```edge_index```, ```neg_edge_index``` is shifted by the node offsets when the graphs are
+    batched. Validation and test always read pool 0, so their negatives are the same at every
+    epoch. Training reads pool ```epoch % num_pools``` (see ```sample_negatives```).
+
+    Args:
+    - num_pools (int): number of negative sets per graph
+    - ratio (float): number of negatives per positive edge in each pool
+    - force_undirected (bool): unordered pairs stored in both directions
+    - seed (int): seed of the sampling, the pools are the same at every processing
+    """
+    def __init__(self, num_pools=4, ratio=1.0, force_undirected=True, seed=42):
+        self.num_pools = num_pools
+        self.ratio = ratio
+        self.force_undirected = force_undirected
+        self.seed = seed
+        self.generator = torch.Generator().manual_seed(seed)
+
+    def forward(self, data):
+        ptr = torch.tensor([0, data.num_nodes])
+        pools = [in_graph_negative_sampling(data.edge_index, ptr, self.ratio, self.force_undirected, generator=self.generator) for _ in range(self.num_pools)]
+        data.neg_edge_index = torch.cat(pools, dim=1)
+        data.neg_slot = torch.cat([torch.full((pool.size(1),), slot, dtype=torch.long) for slot, pool in enumerate(pools)])
+        return data
+
+    def transform_collated(self, data, slices):
+        """
+        Same as ```forward``` on every graph of a collated dataset at once.
+
+        The pools are drawn for all the graphs together, then the edges are grouped back per graph
+        (by pool within a graph) with their slices.
+        """
+        generator = torch.Generator().manual_seed(self.seed)
+        node_slices = slices["x"]
+        num_graphs = len(node_slices) - 1
+        graph_ids = torch.arange(num_graphs)
+        node_graph = graph_ids.repeat_interleave(node_slices.diff())
+        edge_graph = graph_ids.repeat_interleave(slices["edge_index"].diff())
+
+        edge_index = data.edge_index + node_slices[edge_graph]
+        pools = [in_graph_negative_sampling(edge_index, node_slices, self.ratio, self.force_undirected, generator=generator) for _ in range(self.num_pools)]
+        neg_edge_index = torch.cat(pools, dim=1)
+        neg_slot = torch.cat([torch.full((pool.size(1),), slot, dtype=torch.long) for slot, pool in enumerate(pools)])
+
+        neg_graph = node_graph[neg_edge_index[0]]
+        order = torch.sort(neg_graph, stable=True).indices
+        neg_graph = neg_graph[order]
+        neg_slices = torch.cat([torch.zeros(1, dtype=torch.long), torch.bincount(neg_graph, minlength=num_graphs).cumsum(0)])
+
+        data.neg_edge_index = neg_edge_index[:, order] - node_slices[neg_graph]
+        data.neg_slot = neg_slot[order]
+        slices["neg_edge_index"] = neg_slices
+        slices["neg_slot"] = neg_slices.clone()
+        return data, slices
+
+    def __repr__(self):
+        # Part of the fingerprint of the processed dataset
+        return f"{self.__class__.__name__}(num_pools={self.num_pools}, ratio={self.ratio}, force_undirected={self.force_undirected}, seed={self.seed})"
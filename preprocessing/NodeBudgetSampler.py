@@ -0,0 +1,73 @@
+import numpy as np
+from torch.utils.data import Sampler
+from torch_geometric.data import InMemoryDataset
+
+
+class NodeBudgetSampler(Sampler):
+    """
+    Batch sampler filling each batch up to a budget of nodes instead of a fixed number of graphs.
+
+    When shuffling, the graphs are shuffled, then sorted by node count inside buckets of
+    ```bucket_size``` graphs, so the graphs of a batch have similar sizes, and the batches are
+    shuffled again. Without shuffling the graphs are packed in the dataset order.
+    A graph larger than the budget gets a batch on its own.
+    """
+    def __init__(self, dataset, node_budget, shuffle=False, bucket_size=None, seed=42):
+        self.num_nodes = graph_sizes(dataset)
+        self.node_budget = node_budget
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+
+        # About 100 batches per bucket by default
+        mean_nodes = max(1, int(self.num_nodes.mean())) if len(self.num_nodes) else 1
+        self.bucket_size = bucket_size or 100 * max(1, node_budget // mean_nodes)
+        self._num_batches = None
+
+    def pack(self, order):
+        """Greedily split the graphs of ```order``` into batches of at most ```node_budget``` nodes."""
+        batches, batch, total = [], [], 0
+        for idx, size in zip(order.tolist(), self.num_nodes[order].tolist()):
+            if batch and total + size > self.node_budget:
+                batches.append(batch)
+                batch, total = [], 0
+            batch.append(idx)
+            total += size
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def plan(self):
+        """Returns the batches of the next epoch."""
+        if not self.shuffle:
+            return self.pack(np.arange(len(self.num_nodes)))
+
+        generator = np.random.default_rng(self.seed + self.epoch)
+        order = generator.permutation(len(self.num_nodes))
+        for start in range(0, len(order), self.bucket_size):
+            bucket = order[start:start + self.bucket_size]
+            order[start:start + self.bucket_size] = bucket[np.argsort(self.num_nodes[bucket], kind="stable")]
+
+        batches = self.pack(order)
+        return [batches[i] for i in generator.permutation(len(batches))]
+
+    def __iter__(self):
+        batches = self.plan()
+        self._num_batches = len(batches)
+        if self.shuffle:
+            self.epoch += 1
+        return iter(batches)
+
+    def __len__(self):
+        # Number of batches of the last epoch, train_one_epoch averages its metrics with it
+        if self._num_batches is None:
+            self._num_batches = len(self.plan())
+        return self._num_batches
+
+
+def graph_sizes(dataset):
+    """Returns the number of nodes of each graph of the dataset, read from the slices when possible."""
+    if isinstance(dataset, InMemoryDataset):
+        slices = dataset.slices["x"].numpy()
+        return np.diff(slices)[np.asarray(dataset.indices(), dtype=np.int64)]
+    return np.array([data.num_nodes for data in dataset], dtype=np.int64)
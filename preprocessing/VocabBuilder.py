@@ -2,11 +2,13 @@ import os
 import random
 import unicodedata
 import json
-import xml.etree.ElementTree as ET
 import html
+import numpy as np
 from tqdm import tqdm
 
 from config import MATHML_TAGS, ROOT_DIR
+from preprocessing.EquationStore import EquationStore
+from preprocessing.XmlStream import XmlIndex, iter_equations, rn
 
 
 VOCAB_TYPES = [
@@ -16,12 +18,14 @@ VOCAB_TYPES = [
 ]
 
 class VocabBuilder():
-    def __init__(self, xml_name: str, vocab_type="combined", reload_vocab=False, reload_xml_elements=False, debug=False, ) -> None:
+    def __init__(self, xml_name: str, vocab_type="combined", reload_vocab=False, reload_xml_elements=False, debug=False, fused=False) -> None:
         self.xml_name = xml_name
         self.reload_vocab = reload_vocab
         self.reload_xml_elements = reload_xml_elements
         self.debug = debug
         self.vocab_type = vocab_type if vocab_type in VOCAB_TYPES else "combined"
+        # True while the xml elements are left to the single pass of GraphDataset
+        self.pending = False
 
         root_path = os.path.join(ROOT_DIR,"data/pre_processed")
 
@@ -32,23 +36,41 @@ class VocabBuilder():
 
         self.xml_elements = {tag:dict() for tag in MATHML_TAGS}
         self.vocab_table = {} 
+        self._inverse_table = None
 
         if not os.path.exists(self.xml_path):
             raise Exception("No XML found!")
 
+        # GraphDataset counts the xml elements while it builds the graphs
+        if fused and (not os.path.exists(self.element_dict_path) or reload_xml_elements):
+            self.pending = True
+        else:
+            self.build()
+
+    def build(self):
         # checks if xml_elements has been processed
-        if not os.path.exists(self.element_dict_path) or reload_xml_elements:
+        if not os.path.exists(self.element_dict_path) or self.reload_xml_elements:
             self.process_xml_elements()
         else:
             self.load_xml_elements()
-        
+        self.build_vocab()
+
+    def build_vocab(self):
         # checks if vocab has been processed
-        if not os.path.exists(self.vocab_path) or reload_vocab:
+        if not os.path.exists(self.vocab_path) or self.reload_vocab:
             self.process_vocab()
         else:
             self.load_vocab()
+        self.pending = False
+
+    def set_xml_elements(self, xml_elements):
+        """Use the (tag, text) counts gathered by the fused pass of GraphDataset and finalise the vocab."""
+        self.xml_elements = xml_elements
+        self.save_xml_elements()
+        self.build_vocab()
     
     def process_vocab(self):
+        self._inverse_table = None
         def index_vocab(values, index):
             sorted_vals = dict(sorted(values.items(), key=lambda item: item[1], reverse=True))
             indexed_vals = {}
@@ -103,47 +125,82 @@ class VocabBuilder():
         
 
     def process_xml_elements(self):
-        print("Loading XML...")
-        tree = ET.parse(self.xml_path)
-        root = tree.getroot()       
-
-        def find_in_element(element):         
-
-            # First element   
-            if "math" in element.tag:
-                tag = rn(element.tag)
-                text = "" if element.text is None else clean_text(element.text)
-                self.xml_elements[tag][text] = self.xml_elements[tag].get(text,0) + 1
-
-            for child in element:
-                tag = rn(child.tag)
-                text = "" if child.text is None else clean_text(child.text)
-
-                self.xml_elements[tag][text] = self.xml_elements[tag].get(text,0) + 1
-
-                children = [x for x in child]
-                if children:
-                    find_in_element(child)
-
-        # iterate over each XML equation
-        for i, formula in enumerate(tqdm(root,desc="Generating vocab",unit=" equations",total=len(root))):
-            if self.debug and i>= 10000:
-                break
-            # Run recursive function
-            find_in_element(formula)
-        
+        limit = 10000 if self.debug else None
+        store = EquationStore.open(self.xml_path)
+
+        if store is not None:
+            print("Loading equation store...")
+            self.count_store_elements(store, limit)
+        else:
+            print("Loading XML...")
+            total = len(XmlIndex(self.xml_path)) if limit is None else limit
+
+            # iterate over each XML equation, counting every node (tag, text)
+            for nodes in tqdm(iter_equations(self.xml_path, limit),desc="Generating vocab",unit=" equations",total=total):
+                for node in nodes:
+                    text = clean_text(node.text)
+                    self.xml_elements[node.tag][text] = self.xml_elements[node.tag].get(text,0) + 1
+
+        self.save_xml_elements()
+
+    def save_xml_elements(self):
         print("Saving xml elements...")
         with open(self.element_dict_path,"w+") as f:
             json.dump(self.xml_elements,f)
 
+    def count_store_elements(self, store, limit=None):
+        """
+        Same counts as the XML pass, but on the columns of the equation store: the (tag, text)
+        pairs are counted with numpy and only the distinct texts go through ```clean_text```.
+        """
+        first, last = store.node_range(0, limit)
+        pairs = store.tags[first:last].astype(np.int64) * len(store.text_table) + store.texts[first:last]
+        pairs, first_seen, counts = np.unique(pairs, return_index=True, return_counts=True)
+
+        # Keep the order of first occurrence, the vocab ids of equally frequent texts depend on it
+        order = np.argsort(first_seen, kind="stable")
+        pairs, counts = pairs[order], counts[order]
+
+        cleaned = {}
+        for pair, count in zip(pairs.tolist(), counts.tolist()):
+            tag_id, text_id = divmod(pair, len(store.text_table))
+            tag = store.tag_table[tag_id]
+            if text_id not in cleaned:
+                cleaned[text_id] = clean_text(store.text_table[text_id])
+            text = cleaned[text_id]
+            self.xml_elements[tag][text] = self.xml_elements[tag].get(text,0) + count
+
     def load_vocab(self):
         with open(self.vocab_path,"r") as f:
             self.vocab_table = json.load(f)
+        self._inverse_table = None
     
     def load_xml_elements(self):
         with open(self.element_dict_path,"r") as f:
             self.xml_elements = json.load(f)
 
+    def get_text(self, index, tag):
+        """
+        Inverse of the vocab lookup: returns the text of the vocab ```index``` of a ```tag``` element.
+        """
+        if self._inverse_table is None:
+            if self.vocab_type == "split":
+                self._inverse_table = {element: {i: text for text, i in values.items()} for element, values in self.vocab_table.items()}
+            else:
+                self._inverse_table = {i: text for text, i in self.vocab_table.items()}
+
+        if self.vocab_type == "split":
+            return self._inverse_table.get(tag, {}).get(index, "")
+
+        text = self._inverse_table.get(index, "<unk>")
+        # concat entries are "tag_text", or only "tag" when the text is empty
+        if self.vocab_type == "concat":
+            if text == tag:
+                return ""
+            if text.startswith(tag + "_"):
+                return text[len(tag) + 1:]
+        return text
+
     # def __len__(self):
     def shape(self):
 
@@ -170,10 +227,6 @@ def clean_text(text):
     text = text.replace('\u00a0',' ').strip()
     return text
 
-def rn(x):
-    """Remove Namespace"""
-    return x.replace(r"{http://www.w3.org/1998/Math/MathML}", "")
-
 
 
 if __name__=="__main__":
@@ -0,0 +1,267 @@
+import json
+import mmap
+import os
+import re
+import xml.etree.ElementTree as ET
+from collections import namedtuple
+
+import numpy as np
+
+# lxml parses faster when it is installed, both expose the same iterparse API
+try:
+    from lxml import etree as iterparse_backend
+except ImportError:
+    iterparse_backend = ET
+
+MATHML_NAMESPACE = "http://www.w3.org/1998/Math/MathML"
+
+XML_HEADER = b"<?xml version='1.0' encoding='utf-8'?>\n<span class=\"katex\">"
+XML_FOOTER = b"</span>\n"
+
+# A <math> child of the root, either self-closing or up to its closing tag (<math> elements are never nested)
+MATH_ELEMENT_PATTERN = re.compile(rb"<math(?:\s[^>]*)?/>|<math[\s>].*?</math>", re.S)
+
+# One node of an equation: tag without namespace, raw text ("" if None), index of the parent
+# node in the equation (-1 for <math>) and position among the children of the parent
+EquationNode = namedtuple("EquationNode", ["tag", "text", "parent", "position"])
+
+
+def iter_equations(xml_path, limit=None):
+    """
+    Stream the equations of an XML file without building its DOM.
+
+    Args:
+    - xml_path (string): equations XML, a root element holding the <math> elements
+    - limit (int): stop after this many equations
+
+    Returns:
+    - generator of lists of ```EquationNode```, one list per equation in document (pre-)order
+    """
+    context = iterparse_backend.iterparse(xml_path, events=("start", "end"))
+    root = None
+    nodes, stack, num_children = [], [], []
+    count = 0
+
+    for event, element in context:
+        if event == "start":
+            if root is None:
+                root = element
+                continue
+            parent = stack[-1] if stack else -1
+            position = num_children[-1] if stack else 0
+            if stack:
+                num_children[-1] += 1
+
+            nodes.append([rn(element.tag), "", parent, position])
+            stack.append(len(nodes) - 1)
+            num_children.append(0)
+
+        elif element is not root:
+            # The text is only guaranteed to be parsed at the end event
+            node = stack.pop()
+            num_children.pop()
+            nodes[node][1] = "" if element.text is None else element.text
+
+            if not stack:
+                yield [EquationNode(*node) for node in nodes]
+                nodes = []
+                # Drop the equation that was just processed to keep memory bounded
+                root.clear()
+
+                count += 1
+                if limit is not None and count >= limit:
+                    return
+
+
+def rn(x):
+    """Remove Namespace"""
+    return x.replace("{" + MATHML_NAMESPACE + "}", "")
+
+
+class XmlWriter():
+    """
+    Append-only writer for ```equations.xml```.
+
+    Every converted batch is serialised straight to disk instead of being kept in one big
+    in-memory tree. After each batch the file is flushed and a small progress file records
+    how many batches and bytes are committed, so an interrupted run can be resumed from the
+    last committed batch.
+
+    Args:
+    - xml_path (string): XML file to write
+    - resume (bool): resume from the progress of a previous run, start over otherwise
+    - params (dict): what the batches depend on (batch size, number of equations, ...), stored with
+      the progress. A run with other params starts over, its batches wouldn't be the same.
+    """
+    def __init__(self, xml_path, resume=True, params=None):
+        self.xml_path = xml_path
+        self.progress_path = xml_path + ".progress.json"
+        self.params = params or {}
+        self.batches = 0
+        self.stats = {}
+
+        ET.register_namespace('', MATHML_NAMESPACE)
+
+        progress = self.load_progress() if resume else None
+        if progress is not None and progress.get("params", {}) != self.params:
+            print(f"The progress of {xml_path} was made with {progress.get('params', {})}, not {self.params}: starting over")
+            progress = None
+        if progress is not None and os.path.getsize(xml_path) >= progress["offset"]:
+            # Drop whatever was written after the last committed batch
+            self.file = open(xml_path, "r+b")
+            self.file.truncate(progress["offset"])
+            self.file.seek(progress["offset"])
+            self.batches = progress["batches"]
+            self.stats = progress["stats"]
+            print(f"Resuming XML generation after {self.batches} batches")
+        else:
+            self.file = open(xml_path, "wb")
+            self.file.write(XML_HEADER)
+            self.commit()
+
+    def load_progress(self):
+        if not os.path.exists(self.progress_path) or not os.path.exists(self.xml_path):
+            return None
+        with open(self.progress_path, "r") as f:
+            return json.load(f)
+
+    def write_batch(self, elements, stats=None):
+        """
+        Write the <math> elements of one batch and commit them.
+
+        Args:
+        - elements (list): ElementTree <math> elements
+        - stats (dict): conversion stats to store with the progress
+        """
+        self.file.write(b"".join(ET.tostring(element, encoding="utf-8", xml_declaration=False) for element in elements))
+        self.batches += 1
+        if stats is not None:
+            self.stats = stats
+        self.commit()
+
+    def commit(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+        progress = {"batches": self.batches, "offset": self.file.tell(), "stats": self.stats, "params": self.params}
+        tmp_path = self.progress_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(progress, f)
+        os.replace(tmp_path, self.progress_path)
+
+    def close(self):
+        """Close the root element, the file is complete so the progress is removed."""
+        self.file.write(XML_FOOTER)
+        self.file.close()
+        os.remove(self.progress_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            # Keep the progress so the run can be resumed
+            self.file.close()
+
+
+def is_incomplete(xml_path):
+    """Returns True if a previous generation of ```xml_path``` was interrupted."""
+    return os.path.exists(xml_path + ".progress.json")
+
+
+def stitch_shards(manifest_path, xml_path, chunk_size=1 << 20):
+    """
+    Concatenate the <math> elements of the XML shards listed in the manifest into ```xml_path```.
+    """
+    with open(manifest_path, "r") as f:
+        manifest = json.load(f)
+
+    tmp_path = xml_path + ".tmp"
+    with open(tmp_path, "wb") as out:
+        out.write(XML_HEADER)
+        for shard in manifest["shards"]:
+            with open(shard["path"], "rb") as f:
+                if f.read(len(XML_HEADER)) != XML_HEADER:
+                    raise Exception(f"{shard['path']} is not a complete XML shard")
+
+                # Copy everything between the root opening and closing tags
+                remaining = os.path.getsize(shard["path"]) - len(XML_HEADER) - len(XML_FOOTER)
+                while remaining > 0:
+                    chunk = f.read(min(chunk_size, remaining))
+                    out.write(chunk)
+                    remaining -= len(chunk)
+
+                if f.read() != XML_FOOTER:
+                    raise Exception(f"{shard['path']} is not a complete XML shard")
+        out.write(XML_FOOTER)
+    os.replace(tmp_path, xml_path)
+
+    # A previous unsharded run may have left its progress behind
+    if is_incomplete(xml_path):
+        os.remove(xml_path + ".progress.json")
+
+
+class XmlIndex():
+    """
+    Byte-offset index of the <math> children of an equations XML file.
+
+    The (start, end) offsets are computed once and saved next to the XML, so the number of
+    equations is known without parsing anything and a single equation can be parsed on demand.
+    The index is rebuilt when the XML file changed since it was computed.
+    """
+    def __init__(self, xml_path, rebuild=False):
+        self.xml_path = xml_path
+        self.index_path = os.path.splitext(xml_path)[0] + ".index.npz"
+        self._file = None
+
+        stat = os.stat(xml_path)
+        self.signature = np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+        if rebuild or not self.load():
+            self.build()
+
+    def load(self):
+        if not os.path.exists(self.index_path):
+            return False
+        index = np.load(self.index_path)
+        if not np.array_equal(index["signature"], self.signature):
+            return False
+        self.offsets = index["offsets"]
+        return True
+
+    def build(self):
+        print("Indexing XML...")
+        with open(self.xml_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            offsets = [match.span() for match in MATH_ELEMENT_PATTERN.finditer(mm)]
+        self.offsets = np.array(offsets, dtype=np.int64).reshape(-1, 2)
+        np.savez(self.index_path, offsets=self.offsets, signature=self.signature)
+
+    def read(self, idx):
+        """Returns the raw bytes of the equation ```idx```"""
+        if self._file is None:
+            self._file = open(self.xml_path, "rb")
+        start, end = self.offsets[idx]
+        self._file.seek(start)
+        return self._file.read(end - start)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, idx):
+        """Parse the <math> element ```idx``` on its own"""
+        if idx < -len(self) or idx >= len(self):
+            raise IndexError(f"Equation index {idx} out of range")
+        raw = self.read(idx)
+
+        # Files written as a single tree only declare the namespace on the root
+        if not raw.startswith(b"<math xmlns="):
+            raw = b'<math xmlns="' + MATHML_NAMESPACE.encode() + b'"' + raw[len(b"<math"):]
+        return ET.fromstring(raw)
+
+    def __getstate__(self):
+        # Open file handles can't be shared with DataLoader workers
+        state = self.__dict__.copy()
+        state["_file"] = None
+        return state
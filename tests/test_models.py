@@ -0,0 +1,193 @@
+import copy
+import unittest
+
+import torch
+import torch.nn.functional as F
+from sklearn.metrics import average_precision_score, roc_auc_score
+
+from config import CONFIG
+from models.Graph.Compile import CompiledStep
+from models.Graph.EmbeddingIndex import EmbeddingIndex
+from models.Graph.GraphAutoEncoder import GraphDecoder, GraphEncoder, GraphVAE
+from models.Graph.Metrics import LinkMetrics
+from models.Graph.NegativeSampling import in_graph_negative_sampling
+from models.train import make_pre_transform
+
+
+class Test_LinkMetrics(unittest.TestCase):
+
+    def setUp(self):
+        generator = torch.Generator().manual_seed(0)
+        # Rounded so that some scores are tied, within and across batches
+        self.batches = [
+            (torch.rand(n, generator=generator).sqrt().round(decimals=2), torch.rand(n + 7, generator=generator).round(decimals=2))
+            for n in [50, 120, 33]
+        ]
+        pos = torch.cat([pos for pos, _ in self.batches])
+        neg = torch.cat([neg for _, neg in self.batches])
+        labels = torch.cat([torch.ones_like(pos), torch.zeros_like(neg)]).numpy()
+        scores = torch.cat([pos, neg]).numpy()
+        self.expected = roc_auc_score(labels, scores), average_precision_score(labels, scores)
+
+    def test_exact(self):
+        metrics = LinkMetrics()
+        for pos, neg in self.batches:
+            metrics.update(pos, neg)
+        auc, ap = metrics.compute()
+        self.assertAlmostEqual(auc, self.expected[0], places=10)
+        self.assertAlmostEqual(ap, self.expected[1], places=10)
+
+    def test_histogram(self):
+        metrics = LinkMetrics(num_bins=1000)
+        for pos, neg in self.batches:
+            metrics.update(pos, neg)
+        auc, ap = metrics.compute()
+        self.assertAlmostEqual(auc, self.expected[0], places=2)
+        self.assertAlmostEqual(ap, self.expected[1], places=2)
+
+    def test_reset(self):
+        metrics = LinkMetrics()
+        metrics.update(*self.batches[0])
+        metrics.reset()
+        for pos, neg in self.batches:
+            metrics.update(pos, neg)
+        self.assertAlmostEqual(metrics.compute()[0], self.expected[0], places=10)
+
+
+class Test_EmbeddingIndex(unittest.TestCase):
+
+    def setUp(self):
+        generator = torch.Generator().manual_seed(0)
+        self.weight = torch.randn(5000, 16, generator=generator)
+        self.queries = self.weight[:300] + 0.1 * torch.randn(300, 16, generator=generator)
+        similarity = torch.mm(F.normalize(self.queries, dim=1), F.normalize(self.weight, dim=1).t())
+        self.expected = similarity.argmax(dim=1)
+
+    def test_all_lists_is_exact(self):
+        index = EmbeddingIndex(self.weight, num_lists=20, num_probes=20)
+        self.assertTrue(torch.equal(index.search(self.queries)[1], self.expected))
+
+    def test_recall(self):
+        index = EmbeddingIndex(self.weight, num_probes=8)
+        recall = (index.search(self.queries)[1] == self.expected).float().mean().item()
+        self.assertGreater(recall, 0.95)
+
+
+class Test_NegativeSampling(unittest.TestCase):
+
+    def setUp(self):
+        generator = torch.Generator().manual_seed(0)
+        # Random trees of 1 to 40 nodes, as one batch
+        sizes = [1, 2, 3, 5, 12, 40]
+        self.ptr = torch.tensor([0] + sizes).cumsum(0)
+        edges = []
+        for start, size in zip(self.ptr.tolist(), sizes):
+            for node in range(1, size):
+                parent = torch.randint(0, node, (1,), generator=generator).item()
+                edges += [(start + parent, start + node), (start + node, start + parent)]
+        self.edge_index = torch.tensor(edges).t()
+        self.graph = torch.arange(len(sizes)).repeat_interleave(torch.tensor(sizes))
+        torch.manual_seed(0)
+
+    def check(self, neg_edge_index):
+        pairs = neg_edge_index.t().tolist()
+        self.assertEqual(len(set(map(tuple, pairs))), len(pairs))
+        self.assertFalse(set(map(tuple, pairs)) & set(map(tuple, self.edge_index.t().tolist())))
+        self.assertTrue(torch.equal(self.graph[neg_edge_index[0]], self.graph[neg_edge_index[1]]))
+        self.assertFalse((neg_edge_index[0] == neg_edge_index[1]).any())
+
+    def test_undirected(self):
+        neg_edge_index = in_graph_negative_sampling(self.edge_index, self.ptr, ratio=1.0, force_undirected=True)
+        self.check(neg_edge_index)
+        pairs = set(map(tuple, neg_edge_index.t().tolist()))
+        self.assertEqual(pairs, {(col, row) for row, col in pairs})
+        # One negative pair per tree edge, except for the graphs with too few free pairs
+        counts = torch.bincount(self.graph[neg_edge_index[0]], minlength=6).tolist()
+        self.assertEqual(counts, [0, 0, 2, 8, 22, 78])
+
+    def test_ratio(self):
+        neg_edge_index = in_graph_negative_sampling(self.edge_index, self.ptr, ratio=3.0, force_undirected=False)
+        self.check(neg_edge_index)
+        counts = torch.bincount(self.graph[neg_edge_index[0]], minlength=6).tolist()
+        self.assertEqual(counts, [0, 0, 2, 12, 66, 234])
+
+    def test_pools_need_in_graph_sampling(self):
+        self.assertRaises(ValueError, make_pre_transform, dict(CONFIG, negative_pools=4, sample_edges="sparse"))
+        self.assertIsNotNone(make_pre_transform(dict(CONFIG, negative_pools=4, sample_edges="in_graph")))
+
+
+class Test_CompiledStep(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        method = {"onehot": {}, "embed": {"concat": 16}, "linear": {}, "loss": "cosine", "scale": "log"}
+        # A single encoder layer on the mixed-sign embeddings, so some edges are scored below 0.5
+        encoder = GraphEncoder(16, 16, 8, 1)
+        decoder = GraphDecoder(16, 32, 8, 3, edge_dim=1)
+        self.model = GraphVAE(encoder, decoder, 50, method, False, True, True).eval()
+
+        # Two random trees
+        self.ptr = torch.tensor([0, 30, 75])
+        edges = []
+        for start, stop in zip(self.ptr[:-1].tolist(), self.ptr[1:].tolist()):
+            for node in range(start + 1, stop):
+                parent = torch.randint(start, node, (1,)).item()
+                edges += [(parent, node), (node, parent)]
+        self.edge_index = torch.tensor(edges).t()
+        self.edge_weight = torch.ones(self.edge_index.size(1))
+        self.neg_edge_index = in_graph_negative_sampling(self.edge_index, self.ptr)
+        # Decoded edges, some are dropped by the decoder
+        self.pos_edge_index = torch.cat([self.edge_index, self.neg_edge_index], dim=1)
+        self.pos_weight = torch.ones(self.pos_edge_index.size(1))
+        nodes = torch.randint(2, 50, (75,))
+        self.x = self.model.embed_x(nodes, torch.zeros_like(nodes), torch.zeros_like(nodes), -torch.ones(75))
+
+    def test_same_loss_as_eager(self):
+        with torch.no_grad():
+            z = self.model.encode(self.x, self.edge_index, self.edge_weight)
+            self.assertFalse((self.model.decoder(z, self.pos_edge_index, sigmoid=True) > 0.5).all())
+            loss, x_recon = self.model.recon_full_loss(z, self.x, self.pos_edge_index, self.neg_edge_index, self.pos_weight, 1, 1, 1, return_recon=True)
+            loss = loss + (1 / self.x.size(0)) * self.model.kl_loss()
+
+            # The eager backend runs the same padded step without compiling it
+            cache_size_limit = torch._dynamo.config.cache_size_limit
+            step = CompiledStep(self.model, backend="eager")
+            padded_loss, padded_z, padded_x_recon = step(self.x, self.edge_index, self.edge_weight, self.pos_edge_index, self.neg_edge_index, self.pos_weight, 1, 1, 1, True)
+            # The dynamo config is only changed while the step runs
+            self.assertEqual(torch._dynamo.config.cache_size_limit, cache_size_limit)
+
+        self.assertAlmostEqual(padded_loss.item(), loss.item(), places=5)
+        self.assertTrue(torch.allclose(padded_z, z, atol=1e-5))
+        self.assertTrue(torch.allclose(padded_x_recon, x_recon, atol=1e-5))
+
+    def test_batch_norm_in_train_mode(self):
+        torch.manual_seed(0)
+        method = {"onehot": {}, "embed": {"concat": 16}, "linear": {}, "loss": "cosine", "scale": "log"}
+        encoder = GraphEncoder(16, 16, 8, 2, batch_norm=True)
+        decoder = GraphDecoder(16, 32, 8, 3, edge_dim=1, batch_norm=True)
+        model = GraphVAE(encoder, decoder, 50, method, False, True, True).train()
+        # The sampling of z depends on the padded size, the means are compared
+        model.reparametrize = lambda mu, logstd: mu
+        padded_model = copy.deepcopy(model)
+
+        z = model.encode(self.x, self.edge_index, self.edge_weight)
+        loss, x_recon = model.recon_full_loss(z, self.x, self.pos_edge_index, self.neg_edge_index, self.pos_weight, 1, 1, 1, return_recon=True)
+        loss = loss + (1 / self.x.size(0)) * model.kl_loss()
+        loss.backward()
+
+        step = CompiledStep(padded_model, backend="eager")
+        padded_loss, padded_z, padded_x_recon = step(self.x, self.edge_index, self.edge_weight, self.pos_edge_index, self.neg_edge_index, self.pos_weight, 1, 1, 1, True)
+        padded_loss.backward()
+
+        self.assertAlmostEqual(padded_loss.item(), loss.item(), places=5)
+        self.assertTrue(torch.allclose(padded_z, z, atol=1e-5))
+        self.assertTrue(torch.allclose(padded_x_recon, x_recon, atol=1e-5))
+        for name, buffer in padded_model.named_buffers():
+            self.assertTrue(torch.allclose(buffer, model.get_buffer(name), atol=1e-6), name)
+        for name, param in padded_model.named_parameters():
+            if param.grad is not None:
+                self.assertTrue(torch.allclose(param.grad, model.get_parameter(name).grad, atol=1e-5), name)
+
+
+if __name__=="__main__":
+    unittest.main()
@@ -14,8 +14,27 @@ import random
 # from sklearn.preprocessing import PowerTransformer, RobustScaler
 # from torch_geometric.data import Data
 # import networkx as nx
+import os
+import subprocess
+import tempfile
 import unittest
-from preprocessing.MathmlDataset import MathmlDataset, DATASET_NAMES
+from unittest import mock
+import xml.etree.ElementTree as ET
+import numpy as np
+import torch
+from datasets import Dataset as HFDataset
+from torch_geometric.data import Data, InMemoryDataset
+from preprocessing.MathmlDataset import MathmlDataset, DATASET_NAMES, convert_to_xml, shard_ranges
+from preprocessing.ConversionCache import ConversionCache
+from preprocessing.EquationStore import EquationStore
+from preprocessing.GcnNorm import GcnNorm
+from preprocessing.GraphDataset import GraphDataset
+from preprocessing.KatexPool import NODE_BIN_DIR, KatexPool
+from preprocessing.MmapGraphDataset import MmapGraphDataset
+from preprocessing.NegativePool import NegativePool
+from preprocessing.NodeBudgetSampler import NodeBudgetSampler
+from preprocessing.VocabBuilder import VocabBuilder
+from preprocessing.XmlStream import MATHML_NAMESPACE, XmlIndex, XmlWriter, is_incomplete, iter_equations, stitch_shards
 
 class Test_MathmlDataset(unittest.TestCase):
 
@@ -39,6 +58,453 @@ class Test_MathmlDataset(unittest.TestCase):
 
 
 
+class Test_XmlStream(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.xml_path = os.path.join(self.tmp_dir.name, "equations.xml")
+        ET.register_namespace('', MATHML_NAMESPACE)
+        self.formulas = [
+            '<math xmlns="{}"><mrow><mi>x</mi><mo>=</mo><mn>2</mn></mrow></math>',
+            '<math xmlns="{}" display="block"><mi>&lt;</mi></math>',
+            '<math xmlns="{}"/>',
+        ]
+        self.elements = [ET.fromstring(formula.format(MATHML_NAMESPACE)) for formula in self.formulas]
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def assertSameElements(self, expected, found):
+        self.assertEqual(len(expected), len(found))
+        for element, other in zip(expected, found):
+            self.assertEqual(ET.tostring(element), ET.tostring(other))
+
+    def test_index_streamed_xml(self):
+        with XmlWriter(self.xml_path) as writer:
+            writer.write_batch(self.elements[:2])
+            writer.write_batch(self.elements[2:])
+
+        index = XmlIndex(self.xml_path)
+        self.assertSameElements(self.elements, [index[i] for i in range(len(index))])
+        self.assertSameElements(list(ET.parse(self.xml_path).getroot()), [index[i] for i in range(len(index))])
+        self.assertSameElements(self.elements[-1:], [index[-1]])
+        self.assertRaises(IndexError, index.__getitem__, len(index))
+
+    def test_resume(self):
+        def interrupted_run(params):
+            with self.assertRaises(KeyboardInterrupt):
+                with XmlWriter(self.xml_path, params=params) as writer:
+                    writer.write_batch(self.elements[:2])
+                    raise KeyboardInterrupt
+
+        interrupted_run({"batch_size": 2})
+        with XmlWriter(self.xml_path, params={"batch_size": 2}) as writer:
+            self.assertEqual(writer.batches, 1)
+            writer.write_batch(self.elements[2:])
+        self.assertSameElements(self.elements, list(ET.parse(self.xml_path).getroot()))
+
+        # Other batches, or no resuming: the run starts over
+        interrupted_run({"batch_size": 2})
+        with XmlWriter(self.xml_path, params={"batch_size": 3}) as writer:
+            self.assertEqual(writer.batches, 0)
+        interrupted_run({"batch_size": 2})
+        with XmlWriter(self.xml_path, resume=False, params={"batch_size": 2}) as writer:
+            self.assertEqual(writer.batches, 0)
+
+    def test_index_single_tree_xml(self):
+        # Layout written by ElementTree.write, the namespace is only declared on the root
+        root = ET.Element("span", attrib={"class": "katex"})
+        for element in self.elements:
+            root.append(element)
+        ET.ElementTree(root).write(self.xml_path, encoding="utf-8", xml_declaration=True)
+
+        index = XmlIndex(self.xml_path)
+        self.assertSameElements(list(ET.parse(self.xml_path).getroot()), [index[i] for i in range(len(index))])
+
+    def test_equation_store(self):
+        with XmlWriter(self.xml_path) as writer:
+            writer.write_batch(self.elements)
+
+        self.assertIsNone(EquationStore.open(self.xml_path))
+        store = EquationStore.build(self.xml_path)
+        self.assertIsNotNone(EquationStore.open(self.xml_path))
+
+        expected = list(iter_equations(self.xml_path))
+        self.assertEqual(expected, list(store.iter_equations()))
+        self.assertEqual(expected[1:3], list(store.iter_equations(1, 3)))
+        self.assertEqual(expected[-1], store[-1])
+        self.assertRaises(IndexError, store.__getitem__, len(store))
+
+
+class FakeKatexPool():
+    """Stands in for ```KatexPool```: wraps every formula in a <math> element and records it"""
+    converted = []
+    fail_after = None
+
+    def __init__(self, num_workers=None):
+        pass
+
+    def imap(self, batches):
+        for i, batch in enumerate(batches):
+            if self.fail_after is not None and i >= self.fail_after:
+                raise KeyboardInterrupt
+            FakeKatexPool.converted += batch
+            yield [f'<span class="katex"><math xmlns="{MATHML_NAMESPACE}"><mi>{latex}</mi></math></span>' for latex in batch]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+class Test_ConvertToXml(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.xml_path = os.path.join(self.tmp_dir.name, "equations.xml")
+        self.equations = [f"x{i}" for i in range(10)]
+        FakeKatexPool.converted = []
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def texts(self):
+        return [element.find(f"{{{MATHML_NAMESPACE}}}mi").text for element in ET.parse(self.xml_path).getroot()]
+
+    @mock.patch("preprocessing.MathmlDataset.KatexPool", FakeKatexPool)
+    def test_resume(self):
+        # Interrupted after 2 batches of 3
+        with mock.patch.object(FakeKatexPool, "fail_after", 2):
+            with self.assertRaises(KeyboardInterrupt):
+                convert_to_xml(self.equations, self.xml_path, {"success": 0}, batch_size=3)
+        self.assertTrue(is_incomplete(self.xml_path))
+
+        stats = convert_to_xml(self.equations, self.xml_path, {"success": 0}, batch_size=3)
+        self.assertEqual(FakeKatexPool.converted, self.equations)
+        self.assertEqual(self.texts(), self.equations)
+        self.assertEqual(stats["success"], len(self.equations))
+        self.assertFalse(is_incomplete(self.xml_path))
+
+    @mock.patch("preprocessing.MathmlDataset.KatexPool", FakeKatexPool)
+    def test_no_resume(self):
+        with mock.patch.object(FakeKatexPool, "fail_after", 2):
+            with self.assertRaises(KeyboardInterrupt):
+                convert_to_xml(self.equations, self.xml_path, {"success": 0}, batch_size=3)
+
+        convert_to_xml(self.equations, self.xml_path, {"success": 0}, batch_size=3, resume=False)
+        self.assertEqual(FakeKatexPool.converted, self.equations[:6] + self.equations)
+        self.assertEqual(self.texts(), self.equations)
+
+
+def random_mathml(generator, depth=0):
+    """Random MathML element, with nested rows and fractions"""
+    kind = generator.choice(["mi", "mn", "mo", "mrow", "mfrac"] if depth < 3 else ["mi", "mn", "mo"])
+    if kind == "mi":
+        return f"<mi>{generator.choice('xyzab')}</mi>"
+    if kind == "mn":
+        return f"<mn>{generator.randint(0, 20)}</mn>"
+    if kind == "mo":
+        return f"<mo>{generator.choice('+-=')}</mo>"
+    if kind == "mfrac":
+        return f"<mfrac>{random_mathml(generator, depth + 1)}{random_mathml(generator, depth + 1)}</mfrac>"
+    return "<mrow>" + "".join(random_mathml(generator, depth + 1) for _ in range(generator.randint(1, 4))) + "</mrow>"
+
+
+def write_equations(root, num_equations=60, seed=0):
+    """```root```/raw/equations.xml of random equations, with its equation store"""
+    generator = random.Random(seed)
+    xml_path = os.path.join(root, "raw", "equations.xml")
+    os.makedirs(os.path.dirname(xml_path), exist_ok=True)
+    ET.register_namespace('', MATHML_NAMESPACE)
+    with XmlWriter(xml_path) as writer:
+        writer.write_batch([
+            ET.fromstring(f'<math xmlns="{MATHML_NAMESPACE}">{random_mathml(generator)}</math>')
+            for _ in range(num_equations)
+        ])
+    EquationStore.build(xml_path)
+    return xml_path
+
+
+class Test_GraphDataset(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.root = self.tmp_dir.name
+        write_equations(self.root)
+        self.vocab = VocabBuilder(self.root, vocab_type="concat")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def assertSameCollated(self, first, second):
+        (data, slices), (other_data, other_slices) = first, second
+        self.assertEqual(sorted(data.keys()), sorted(other_data.keys()))
+        for key in data.keys():
+            self.assertTrue(torch.equal(data[key], other_data[key]), key)
+            self.assertTrue(torch.equal(slices[key], other_slices[key]), key)
+
+    def test_parallel_same_as_serial(self):
+        parallel = GraphDataset(self.root, self.vocab, num_workers=2)
+        serial = GraphDataset(self.root, self.vocab, num_workers=None, force_reload=True)
+        self.assertGreater(len(serial), 0)
+        self.assertSameCollated((parallel._data, parallel.slices), (serial._data, serial.slices))
+
+
+class Test_MmapGraphDataset(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.root = self.tmp_dir.name
+        write_equations(self.root)
+        self.vocab = VocabBuilder(self.root, vocab_type="concat")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def assertSameGraph(self, graph, other):
+        self.assertEqual(sorted(graph.keys()), sorted(other.keys()))
+        for key in graph.keys():
+            self.assertTrue(torch.equal(graph[key], other[key]), key)
+
+    def test_same_graphs(self):
+        # Built from the equations, no data.pt to convert yet
+        on_disk = MmapGraphDataset(self.root, self.vocab)
+        in_memory = GraphDataset(self.root, self.vocab)
+        self.assertEqual(len(on_disk), len(in_memory))
+        for idx in [0, 1, len(in_memory) // 2, -1]:
+            self.assertSameGraph(on_disk[idx], in_memory[idx])
+
+    def test_convert_data_pt(self):
+        in_memory = GraphDataset(self.root, self.vocab)
+        data, slices = torch.load(in_memory.processed_paths[0])
+        on_disk = MmapGraphDataset(self.root, self.vocab)
+        for key in data.keys():
+            self.assertTrue(torch.equal(on_disk._data[key], data[key]), key)
+            self.assertTrue(torch.equal(on_disk.slices[key], slices[key]), key)
+
+    def test_reload_maps_the_arrays(self):
+        first = MmapGraphDataset(self.root, self.vocab)
+        with mock.patch.object(MmapGraphDataset, "process") as process, mock.patch("preprocessing.MmapGraphDataset.np.load", wraps=np.load) as load:
+            second = MmapGraphDataset(self.root, self.vocab)
+        process.assert_not_called()
+        # Every array is memory-mapped, none is read into memory
+        self.assertGreater(load.call_count, 0)
+        self.assertTrue(all(call.kwargs.get("mmap_mode") == "c" for call in load.call_args_list))
+        self.assertSameGraph(second[-1], first[-1])
+
+
+class Test_Shards(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        ET.register_namespace('', MATHML_NAMESPACE)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_shard_ranges(self):
+        equations = HFDataset.from_dict({"index": list(range(103))})
+        for num_shards in [1, 2, 7, 10, 103]:
+            expected = []
+            for rank in range(num_shards):
+                shard = equations.shard(num_shards, rank, contiguous=True)["index"]
+                expected.append((shard[0], shard[-1] + 1))
+            self.assertEqual(shard_ranges(len(equations), num_shards), expected)
+
+    def test_stitch_shards(self):
+        elements = [ET.fromstring(f'<math xmlns="{MATHML_NAMESPACE}"><mn>{i}</mn></math>') for i in range(5)]
+        manifest = {"num_shards": 2, "shards": []}
+        for rank, shard_elements in enumerate([elements[:3], elements[3:]]):
+            shard_path = os.path.join(self.tmp_dir.name, f"equations-{rank:05d}.xml")
+            with XmlWriter(shard_path) as writer:
+                writer.write_batch(shard_elements[:1])
+                writer.write_batch(shard_elements[1:])
+            manifest["shards"].append({"path": shard_path})
+        manifest_path = os.path.join(self.tmp_dir.name, "manifest.json")
+        with open(manifest_path, "w") as f:
+            json.dump(manifest, f)
+
+        xml_path = os.path.join(self.tmp_dir.name, "equations.xml")
+        stitch_shards(manifest_path, xml_path)
+        stitched = list(ET.parse(xml_path).getroot())
+        self.assertEqual([ET.tostring(element) for element in stitched], [ET.tostring(element) for element in elements])
+
+
+class Test_ConversionCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cache_path = os.path.join(self.tmp_dir.name, "katex_cache.sqlite")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_round_trip(self):
+        with ConversionCache(self.cache_path, "0.16.10") as cache:
+            cache.put_many(["x", "y", "\\bad"], ["<math>x</math>", "<math>y</math>", None])
+            self.assertEqual(cache.connection.execute("SELECT COUNT(*) FROM conversions").fetchone()[0], 2)
+
+        with ConversionCache(self.cache_path, "0.16.10") as cache:
+            # Failed conversions (None) aren't stored
+            self.assertEqual(cache.get_many(["y", "z", "x", "\\bad"]), ["<math>y</math>", None, "<math>x</math>", None])
+            self.assertEqual((cache.hits, cache.misses), (2, 2))
+
+    def test_other_katex_version(self):
+        with ConversionCache(self.cache_path, "0.16.10") as cache:
+            cache.put_many(["x"], ["<math>x</math>"])
+        with ConversionCache(self.cache_path, "0.16.11") as cache:
+            self.assertEqual(cache.get_many(["x"]), [None])
+
+
+def katex_available():
+    """True when node can load KaTeX from the repository, as the workers of ```KatexPool``` do"""
+    pool_env = dict(os.environ, PATH=NODE_BIN_DIR + os.pathsep + os.environ["PATH"])
+    root_folder = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        return subprocess.run(["node", "-e", "require('katex')"], cwd=root_folder, env=pool_env, capture_output=True, timeout=60).returncode == 0
+    except (OSError, subprocess.TimeoutExpired):
+        return False
+
+
+@unittest.skipUnless(katex_available(), "node and KaTeX are needed")
+class Test_KatexPool(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = KatexPool(num_workers=2, timeout=2)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def send(self, worker, line):
+        """Send a raw line to a worker, as the request of a new id"""
+        uid = next(self.pool._ids)
+        with self.pool._condition:
+            worker["pending"].add(uid)
+        worker["queue"].put(line.format(uid=uid))
+        return uid
+
+    def test_batch(self):
+        results = self.pool.convert(["x^2", "\\frac{1}{2}", "\\frac{"])
+        self.assertEqual(len(results), 3)
+        self.assertIn("<math", results[0])
+        self.assertIn("<mfrac>", results[1])
+        self.assertTrue(results[2].startswith("Error in LaTeX"))
+
+    def test_malformed_line(self):
+        worker = self.pool.workers[0]
+        uid = self.send(worker, '{{"id": {uid}, "latex": "x\n')
+        self.assertTrue(self.pool.collect([uid])[0].startswith("Error in request"))
+        # The worker is still alive and converting
+        self.assertIsNone(worker["process"].poll())
+        self.assertIn("<math", self.pool.convert(["y", "z"])[0])
+
+    def test_timeout_kill(self):
+        worker = self.pool.workers[0]
+        # A request the worker never receives, so never answers
+        uid = next(self.pool._ids)
+        with self.pool._condition:
+            worker["pending"].add(uid)
+        self.assertEqual(self.pool.collect([uid]), [None])
+        self.assertIsNotNone(worker["process"].poll())
+
+        # The killed worker is replaced before the next requests
+        self.assertIsNotNone(self.pool.version())
+        self.assertIsNot(self.pool.workers[0], worker)
+        self.assertTrue(all("<math" in result for result in self.pool.convert(["a", "b", "c"])))
+
+
+class Test_NodeBudgetSampler(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(0)
+        self.sizes = [random.randint(1, 40) for _ in range(300)] + [120]
+        self.dataset = [Data(x=torch.zeros(size, dtype=torch.long)) for size in self.sizes]
+
+    def assertBatches(self, batches, node_budget):
+        for batch in batches:
+            total = sum(self.sizes[i] for i in batch)
+            self.assertTrue(total <= node_budget or len(batch) == 1)
+
+    def test_sequential(self):
+        sampler = NodeBudgetSampler(self.dataset, 100)
+        batches = list(sampler)
+        self.assertEqual([i for batch in batches for i in batch], list(range(len(self.dataset))))
+        self.assertEqual(len(sampler), len(batches))
+        self.assertBatches(batches, 100)
+
+    def test_shuffle(self):
+        sampler = NodeBudgetSampler(self.dataset, 100, shuffle=True, bucket_size=50)
+        first, second = list(sampler), list(sampler)
+        self.assertNotEqual(first, second)
+        self.assertEqual(len(sampler), len(second))
+        self.assertEqual(sorted(i for batch in first for i in batch), list(range(len(self.dataset))))
+        self.assertBatches(first, 100)
+
+
+def random_trees(sizes, generator):
+    """Collated random trees, both directions of each edge, the reversed copies with an edge_attr of 0"""
+    data_list = []
+    for size in sizes:
+        parents = [torch.randint(0, node, (1,), generator=generator).item() for node in range(1, size)]
+        edges = [(parent, node) for node, parent in enumerate(parents, start=1)]
+        edge_index = torch.tensor(edges + [(node, parent) for parent, node in edges], dtype=torch.long).reshape(-1, 2).t()
+        edge_attr = torch.cat([torch.ones(len(edges)), torch.zeros(len(edges))])
+        data_list.append(Data(x=torch.zeros(size, dtype=torch.long), edge_index=edge_index, edge_attr=edge_attr))
+    return data_list, *InMemoryDataset.collate(data_list)
+
+
+class Test_GcnNorm(unittest.TestCase):
+
+    def setUp(self):
+        self.data_list, self.data, self.slices = random_trees([7, 1, 2, 30, 12, 3], torch.Generator().manual_seed(0))
+
+    def check_same_as_forward(self, edge_weight):
+        norm = GcnNorm(edge_weight=edge_weight)
+        data, slices = norm.transform_collated(self.data, self.slices)
+        for i, graph in enumerate(self.data_list):
+            expected = norm(graph.clone())
+            edges = slice(slices["gcn_edge_index"][i], slices["gcn_edge_index"][i + 1])
+            self.assertTrue(torch.equal(data.gcn_edge_index[:, edges], expected.gcn_edge_index))
+            self.assertTrue(torch.allclose(data.gcn_edge_weight[edges], expected.gcn_edge_weight))
+
+    def test_same_as_forward(self):
+        self.check_same_as_forward(edge_weight=False)
+
+    def test_same_as_forward_with_edge_weight(self):
+        self.check_same_as_forward(edge_weight=True)
+
+
+class Test_NegativePool(unittest.TestCase):
+
+    def setUp(self):
+        self.sizes = [7, 1, 2, 30, 12, 3]
+        self.data_list, self.data, self.slices = random_trees(self.sizes, torch.Generator().manual_seed(0))
+
+    def test_transform_collated(self):
+        pool = NegativePool(num_pools=3, ratio=1.0)
+        data, slices = pool.transform_collated(self.data, self.slices)
+        for i, graph in enumerate(self.data_list):
+            neg_edge_index = data.neg_edge_index[:, slices["neg_edge_index"][i]:slices["neg_edge_index"][i + 1]]
+            neg_slot = data.neg_slot[slices["neg_slot"][i]:slices["neg_slot"][i + 1]]
+            positives = set(map(tuple, graph.edge_index.t().tolist()))
+            num_pairs = self.sizes[i] * (self.sizes[i] - 1)
+
+            for slot in range(3):
+                pairs = list(map(tuple, neg_edge_index[:, neg_slot == slot].t().tolist()))
+                # As many negatives as positive edges, unless the graph has fewer free pairs
+                self.assertEqual(len(pairs), min(graph.edge_index.size(1), num_pairs - len(positives)))
+                self.assertEqual(len(set(pairs)), len(pairs))
+                self.assertFalse(set(pairs) & positives)
+                self.assertTrue(all(row != col and 0 <= row < self.sizes[i] and 0 <= col < self.sizes[i] for row, col in pairs))
+
+    def test_deterministic(self):
+        pool = NegativePool(num_pools=2)
+        first, _ = pool.transform_collated(self.data.clone(), dict(self.slices))
+        second, _ = pool.transform_collated(self.data.clone(), dict(self.slices))
+        self.assertTrue(torch.equal(first.neg_edge_index, second.neg_edge_index))
+
+
 if __name__=="__main__":
     unittest.main()
 
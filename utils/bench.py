@@ -0,0 +1,375 @@
+import json
+import os
+import random
+import re
+import time
+
+import torch
+from datasets import Dataset, load_dataset
+
+from config import CONFIG
+from models.Graph.EmbeddingIndex import EmbeddingIndex
+from models.Graph.GraphAutoEncoder import GraphDecoder, GraphEncoder, GraphVAE
+from models.train import make_loader, make_pre_transform, precompute_gcn_norm, sample_negatives, train_one_epoch, validate
+from preprocessing.GcnNorm import GcnNorm
+from preprocessing.GraphDataset import GraphDataset
+from preprocessing.MathmlDataset import DATASET_NAMES, EXCLUDED_COMMANDS, clean_batch, remove_commands
+from preprocessing.MmapGraphDataset import MmapGraphDataset
+from preprocessing.NodeBudgetSampler import graph_sizes
+from preprocessing.VocabBuilder import VocabBuilder
+
+
+def timed(function, *args, repeat=3, **kwargs):
+    """Returns the best wall time out of ```repeat``` runs and the last result."""
+    best, result = float("inf"), None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def load_latex_sample(latex_set="OleehyO", sample_size=50000):
+    if latex_set == "OleehyO":
+        data = load_dataset(DATASET_NAMES[latex_set], "cleaned_formulas", trust_remote_code=True, split="train")
+        return data.select(range(min(len(data), sample_size)))["latex_formula"]
+    with open(DATASET_NAMES[latex_set], "r") as f:
+        return json.load(f)["train"][:sample_size]
+
+
+def bench_remove_commands(latex_set="OleehyO", sample_size=50000, num_proc=4):
+    """
+    Formulas/sec of the LaTeX cleaning stage: the former per-formula pattern build,
+    the precompiled pattern, and the batched ```datasets.map``` path.
+    """
+    formulas = load_latex_sample(latex_set, sample_size)
+    print(f"Benchmarking remove_commands on {len(formulas)} formulas of '{latex_set}'")
+
+    def remove_commands_uncompiled(text):
+        pattern = '|'.join(EXCLUDED_COMMANDS)
+        return re.sub(pattern, '', text)
+
+    before, expected = timed(lambda: [remove_commands_uncompiled(formula) for formula in formulas])
+    compiled, cleaned = timed(lambda: [remove_commands(formula) for formula in formulas])
+    batched, batch_cleaned = timed(lambda: clean_batch(formulas)["cleaned_formula"])
+
+    dataset = Dataset.from_dict({"latex_formula": formulas})
+    mapped, mapped_cleaned = timed(
+        lambda: dataset.map(clean_batch, batched=True, num_proc=num_proc, input_columns="latex_formula", load_from_cache_file=False)["cleaned_formula"],
+        repeat=1
+    )
+
+    assert expected == cleaned == batch_cleaned == list(mapped_cleaned), "The cleaning outputs differ"
+
+    results = {
+        "per-formula pattern (before)": before,
+        "precompiled pattern": compiled,
+        "clean_batch": batched,
+        f"datasets.map(batched=True, num_proc={num_proc})": mapped,
+    }
+    for name, seconds in results.items():
+        print(f"{name:<45} {len(formulas) / seconds:>12,.0f} formulas/sec")
+    return results
+
+
+def bench_dataset_load(xml_name="default", vocab_type="concat", max_num_nodes=100, repeat=3):
+    """
+    Load time of the processed dataset: data.pt with its pickled networkx graphs (before),
+    data.pt with the tensors only, and the memory-mapped arrays of ```MmapGraphDataset```.
+    """
+    vocab = VocabBuilder(xml_name, vocab_type=vocab_type)
+    dataset = GraphDataset(vocab.dir_path, vocab, max_num_nodes=max_num_nodes)
+    print(f"Benchmarking the load of {len(dataset)} graphs of '{xml_name}'")
+
+    # Layout written by the previous versions
+    legacy_path = os.path.join(dataset.processed_dir, "bench_legacy_data.pt")
+    torch.save((dataset._data, dataset.slices, dataset.get_graph_list()), legacy_path)
+    # The first construction converts data.pt to the memory-mapped arrays
+    MmapGraphDataset(vocab.dir_path, vocab, max_num_nodes=max_num_nodes)
+
+    results = {
+        "torch.load data.pt with graph list (before)": timed(torch.load, legacy_path, repeat=repeat)[0],
+        "torch.load data.pt": timed(torch.load, dataset.processed_paths[0], repeat=repeat)[0],
+        "GraphDataset(...)": timed(lambda: GraphDataset(vocab.dir_path, vocab, max_num_nodes=max_num_nodes), repeat=repeat)[0],
+        "MmapGraphDataset(...)": timed(lambda: MmapGraphDataset(vocab.dir_path, vocab, max_num_nodes=max_num_nodes), repeat=repeat)[0],
+    }
+    os.remove(legacy_path)
+
+    for name, seconds in results.items():
+        print(f"{name:<45} {seconds:>10.3f} s")
+    return results
+
+
+def bench_model(vocab, config, embedding_dim=64):
+    """Small GraphVAE embedding the concat vocab, as built by ```train_model```."""
+    method = {"onehot": {}, "embed": {"concat": embedding_dim}, "linear": {}, "loss": "cosine", "scale": "log"}
+    layer_type = config.get("layer_type")
+    encoder = GraphEncoder(embedding_dim, config.get("hidden_channels"), config.get("out_channels"), config.get("num_layers"), layer_type, normalize=not precompute_gcn_norm(config))
+    decoder = GraphDecoder(embedding_dim, config.get("hidden_channels"), config.get("out_channels"), config.get("num_layers"), layer_type, edge_dim=1)
+    return GraphVAE(encoder, decoder, vocab.shape(), method, False, config.get("gen_sparse_edges"), config.get("train_edge_features"))
+
+
+def bench_loader(xml_name="default", max_num_nodes=100, num_graphs=20000, node_budget=None, num_workers=0):
+    """
+    Training steps/sec and nodes/sec of ```batch_size``` graphs per batch (before) against
+    batches of at most ```node_budget``` nodes. The default budget is the mean number of
+    nodes of the fixed size batches, so both loaders see the same number of steps.
+    """
+    torch.manual_seed(42)
+    vocab = VocabBuilder(xml_name, vocab_type="concat")
+    dataset = GraphDataset(vocab.dir_path, vocab, max_num_nodes=max_num_nodes)[:num_graphs]
+    config = dict(CONFIG)
+    sizes = graph_sizes(dataset)
+    num_nodes = int(sizes.sum())
+    if node_budget is None:
+        node_budget = int(config["batch_size"] * sizes.mean())
+
+    print(f"Benchmarking one training epoch over {len(dataset)} graphs of '{xml_name}', node budget {node_budget}")
+
+    results = {}
+    for name, node_budget_config in [(f"batch_size={config['batch_size']} (before)", None), (f"node_budget={node_budget}", node_budget)]:
+        config["node_budget"] = node_budget_config
+        loader = make_loader(dataset, config, shuffle=True, num_workers=num_workers)
+        model = bench_model(vocab, config)
+        optimizer = torch.optim.Adam(model.parameters(), lr=config["lr"])
+
+        seconds, _ = timed(train_one_epoch, model, optimizer, loader, torch.device("cpu"), config, repeat=1)
+        results[name] = {"steps/sec": len(loader) / seconds, "nodes/sec": num_nodes / seconds, "steps": len(loader)}
+
+    for name, result in results.items():
+        print(f"{name:<30} {result['steps']:>6} steps {result['steps/sec']:>10.2f} steps/sec {result['nodes/sec']:>12,.0f} nodes/sec")
+    return results
+
+
+def bench_gcn_norm(xml_name="default", max_num_nodes=100, num_graphs=20000, repeat=3):
+    """
+    Training steps/sec with the GCN normalisation recomputed by every GCNConv (before) against
+    the edges and weights precomputed by the ```GcnNorm``` pre-transform.
+    """
+    vocab = VocabBuilder(xml_name, vocab_type="concat")
+    dataset = GraphDataset(vocab.dir_path, vocab, max_num_nodes=max_num_nodes, pre_transform=GcnNorm())[:num_graphs]
+    config = dict(CONFIG)
+    print(f"Benchmarking one training epoch over {len(dataset)} graphs of '{xml_name}' with {config['num_layers']} GCNConv layers")
+
+    results = {}
+    for name, precompute in [("normalised by GCNConv (before)", False), ("precomputed by GcnNorm", True)]:
+        config["precompute_gcn_norm"] = precompute
+        torch.manual_seed(42)
+        loader = make_loader(dataset, config, shuffle=False, num_workers=0)
+        model = bench_model(vocab, config)
+        optimizer = torch.optim.Adam(model.parameters(), lr=config["lr"])
+
+        seconds, _ = timed(train_one_epoch, model, optimizer, loader, torch.device("cpu"), config, repeat=repeat)
+        results[name] = len(loader) / seconds
+
+    for name, steps in results.items():
+        print(f"{name:<35} {steps:>10.2f} steps/sec")
+    return results
+
+
+def bench_metrics_interval(xml_name="default", max_num_nodes=100, num_graphs=20000, intervals=(1, 10, 100)):
+    """Training steps/sec when the training metrics are computed every ```metrics_interval``` batches."""
+    vocab = VocabBuilder(xml_name, vocab_type="concat")
+    dataset = GraphDataset(vocab.dir_path, vocab, max_num_nodes=max_num_nodes)[:num_graphs]
+    config = dict(CONFIG)
+    print(f"Benchmarking one training epoch over {len(dataset)} graphs of '{xml_name}'")
+
+    results = {}
+    for interval in intervals:
+        config["metrics_interval"] = interval
+        torch.manual_seed(42)
+        loader = make_loader(dataset, config, shuffle=False, num_workers=0)
+        model = bench_model(vocab, config)
+        optimizer = torch.optim.Adam(model.parameters(), lr=config["lr"])
+
+        seconds, _ = timed(train_one_epoch, model, optimizer, loader, torch.device("cpu"), config, repeat=1)
+        results[interval] = len(loader) / seconds
+
+    for interval, steps in results.items():
+        print(f"metrics_interval={interval:<10} {steps:>10.2f} steps/sec")
+    return results
+
+
+def bench_embedding_index(num_rows=300000, embedding_dim=64, num_queries=2000, noise=0.3, probes=(8, 32)):
+    """
+    Nearest embedding search of ```reverse_embed_x```: every row compared (before) against the
+    IVF ```EmbeddingIndex```, on a random table with queries close to its rows.
+    """
+    generator = torch.Generator().manual_seed(42)
+    weight = torch.randn(num_rows, embedding_dim, generator=generator)
+    queries = weight[torch.randint(0, num_rows, (num_queries,), generator=generator)]
+    queries = queries + noise * torch.randn(num_queries, embedding_dim, generator=generator)
+    print(f"Benchmarking the search of {num_queries} queries in {num_rows} embeddings of dim {embedding_dim}")
+
+    normalized = torch.nn.functional.normalize(weight, p=2, dim=1)
+    exact_time, exact = timed(lambda: torch.mm(torch.nn.functional.normalize(queries, p=2, dim=1), normalized.t()).argmax(dim=1))
+    build_time, index = timed(EmbeddingIndex, weight, repeat=1)
+
+    results = {"exact (before)": (exact_time, 1.0)}
+    for num_probes in probes:
+        index.num_probes = num_probes
+        seconds, (_, found) = timed(index.search, queries)
+        results[f"IVF {index.num_lists} lists, {num_probes} probes"] = (seconds, (found == exact).float().mean().item())
+
+    print(f"Index built in {build_time:.2f} s")
+    for name, (seconds, recall) in results.items():
+        print(f"{name:<35} {num_queries / seconds:>12,.0f} queries/sec   recall {recall:.3f}")
+    return results
+
+
+def bench_dense_decoding(xml_name="default", max_num_nodes=100, batch_sizes=(64, 256, 1024), max_full_nodes=5000):
+    """
+    Time of ```decode_all``` without sparse edges: full (num_nodes, num_nodes) adjacency of the
+    batch (before) against the per-graph blocks of ```dense_batch_edges```. The full matrix is
+    skipped for batches of more than ```max_full_nodes``` nodes.
+    """
+    vocab = VocabBuilder(xml_name, vocab_type="concat")
+    dataset = GraphDataset(vocab.dir_path, vocab, max_num_nodes=max_num_nodes)
+    config = dict(CONFIG, gen_sparse_edges=False)
+    torch.manual_seed(42)
+    model = bench_model(vocab, config).eval()
+    print(f"Benchmarking the dense decoding of '{xml_name}' batches")
+
+    results = {}
+    for batch_size in batch_sizes:
+        batch = next(iter(make_loader(dataset, dict(config, batch_size=batch_size), num_workers=0)))
+        with torch.no_grad():
+            z = model.encode(model.embed_x(batch.x, batch.tag, batch.pos, batch.nums), batch.edge_index)
+            full = timed(model.decode_all, z, batch.edge_index)[0] if batch.num_nodes <= max_full_nodes else None
+            blocks = timed(model.decode_all, z, batch.edge_index, batch=batch.batch)[0]
+        results[batch_size] = (batch.num_nodes, full, blocks)
+
+    for batch_size, (num_nodes, full, blocks) in results.items():
+        full = "skipped" if full is None else f"{full * 1e3:.1f} ms"
+        print(f"batch_size={batch_size:<6} {num_nodes:>7} nodes   full adjacency (before) {full:>10}   per graph {blocks * 1e3:>8.1f} ms")
+    return results
+
+
+def bench_negative_sampling(xml_name="default", max_num_nodes=100, batch_sizes=(64, 256, 1024), max_dense_nodes=5000, repeat=5):
+    """
+    Time of the negative sampling of a batch and share of the negatives joining two graphs: PyG's
+    ```negative_sampling``` over the whole batch, sparse and dense (before), against
+    ```in_graph_negative_sampling```. The dense sampling is skipped above ```max_dense_nodes``` nodes.
+    """
+    vocab = VocabBuilder(xml_name, vocab_type="concat")
+    dataset = GraphDataset(vocab.dir_path, vocab, max_num_nodes=max_num_nodes)
+    print(f"Benchmarking the negative sampling of '{xml_name}' batches")
+
+    results = {}
+    for batch_size in batch_sizes:
+        batch = next(iter(make_loader(dataset, dict(CONFIG, batch_size=batch_size), num_workers=0)))
+        results[batch_size] = {}
+        for method in ["sparse", "dense", "in_graph"]:
+            if method == "dense" and batch.num_nodes > max_dense_nodes:
+                continue
+            config = dict(CONFIG, sample_edges=method)
+            seconds, neg_edge_index = timed(sample_negatives, batch, config, repeat=repeat)
+            cross_graph = (batch.batch[neg_edge_index[0]] != batch.batch[neg_edge_index[1]]).float().mean().item()
+            name = f"{method} (before)" if method != "in_graph" else method
+            results[batch_size][name] = (seconds, neg_edge_index.size(1), cross_graph)
+
+    for batch_size, methods in results.items():
+        print(f"batch_size={batch_size}")
+        for name, (seconds, num_edges, cross_graph) in methods.items():
+            print(f"  {name:<20} {seconds * 1e3:>10.2f} ms {num_edges:>10} negatives   {cross_graph:>7.1%} across graphs")
+    return results
+
+
+def bench_negative_pool(xml_name="default", max_num_nodes=100, num_graphs=20000, num_pools=4, repeat=3):
+    """
+    Time of ```validate``` and spread of its AUC across calls on the same model: negatives sampled
+    at every batch (before) against the ```NegativePool``` negatives stored with the dataset.
+    """
+    vocab = VocabBuilder(xml_name, vocab_type="concat")
+    config = dict(CONFIG, negative_pools=num_pools, sample_edges="in_graph")
+    dataset = GraphDataset(vocab.dir_path, vocab, max_num_nodes=max_num_nodes, pre_transform=make_pre_transform(config))[:num_graphs]
+    loader = make_loader(dataset, config, shuffle=False, num_workers=0)
+    torch.manual_seed(42)
+    model = bench_model(vocab, config)
+    print(f"Benchmarking validate over {len(dataset)} graphs of '{xml_name}'")
+
+    results = {}
+    for name, pools in [(f"sampled, {config['sample_edges']} (before)", None), (f"{num_pools} stored pools", num_pools)]:
+        run_config = dict(config, negative_pools=pools)
+        times, aucs = [], []
+        for _ in range(repeat):
+            seconds, metrics = timed(validate, model, loader, torch.device("cpu"), run_config, repeat=1)
+            times.append(seconds)
+            aucs.append(metrics[1])
+        results[name] = (min(times), aucs)
+
+    for name, (seconds, aucs) in results.items():
+        print(f"{name:<30} {len(loader) / seconds:>10.2f} steps/sec   val_auc {min(aucs):.4f} - {max(aucs):.4f}")
+    return results
+
+
+def bench_precision(xml_name="default", max_num_nodes=100, num_graphs=20000, hidden_channels=256, epochs=3):
+    """
+    Training steps/sec (fastest epoch) and losses in fp32 (before) and under the bf16 autocast of
+    ```precision```, on the same machine. Wider layers than the default config show more of the
+    bf16 matmuls.
+    """
+    vocab = VocabBuilder(xml_name, vocab_type="concat")
+    dataset = GraphDataset(vocab.dir_path, vocab, max_num_nodes=max_num_nodes)[:num_graphs]
+    print(f"Benchmarking {epochs} training epochs over {len(dataset)} graphs of '{xml_name}', hidden_channels={hidden_channels}")
+
+    results = {}
+    for precision in ["fp32", "bf16"]:
+        config = dict(CONFIG, precision=precision, hidden_channels=hidden_channels)
+        # PyG's negative sampling draws from random
+        random.seed(42)
+        torch.manual_seed(42)
+        loader = make_loader(dataset, config, shuffle=False, num_workers=0)
+        model = bench_model(vocab, config)
+        optimizer = torch.optim.Adam(model.parameters(), lr=config["lr"])
+
+        seconds, losses = float("inf"), []
+        for _ in range(epochs):
+            epoch_seconds, metrics = timed(train_one_epoch, model, optimizer, loader, torch.device("cpu"), config, repeat=1)
+            seconds = min(seconds, epoch_seconds)
+            losses.append(metrics[0])
+        results[precision] = (len(loader) / seconds, losses)
+
+    for precision, (steps, losses) in results.items():
+        name = f"{precision} (before)" if precision == "fp32" else precision
+        print(f"{name:<15} {steps:>10.2f} steps/sec   losses {', '.join(f'{loss:.4f}' for loss in losses)}")
+    return results
+
+
+def bench_compile(xml_name="default", max_num_nodes=100, num_graphs=5000, layer_types=None, node_budget=None):
+    """
+    Compile time and steady-state training step time of the eager step (before) and of the
+    ```CompiledStep```, per layer type. The first compiled epoch compiles every bucket, its extra
+    time over the second epoch is the compile time. The loader has a node budget (the mean number
+    of nodes of ```batch_size``` graphs by default) so most batches fall in one bucket.
+
+    Args:
+    - layer_types (tuple): layer types to compare, the configured ```layer_type``` by default
+    """
+    if layer_types is None:
+        layer_types = (CONFIG["layer_type"],)
+    vocab = VocabBuilder(xml_name, vocab_type="concat")
+    dataset = GraphDataset(vocab.dir_path, vocab, max_num_nodes=max_num_nodes)[:num_graphs]
+    if node_budget is None:
+        node_budget = int(CONFIG["batch_size"] * graph_sizes(dataset).mean())
+    print(f"Benchmarking the training step over {len(dataset)} graphs of '{xml_name}', node budget {node_budget}")
+
+    results = {}
+    for layer_type in layer_types:
+        for compiled in [False, True]:
+            config = dict(CONFIG, layer_type=layer_type, compile=compiled, node_budget=node_budget)
+            torch.manual_seed(42)
+            loader = make_loader(dataset, config, shuffle=False, num_workers=0)
+            model = bench_model(vocab, config)
+            optimizer = torch.optim.Adam(model.parameters(), lr=config["lr"])
+
+            first, _ = timed(train_one_epoch, model, optimizer, loader, torch.device("cpu"), config, repeat=1)
+            steady, _ = timed(train_one_epoch, model, optimizer, loader, torch.device("cpu"), config, repeat=2)
+            buckets = len(model._compiled_step.buckets) if compiled else None
+            results[(layer_type.__name__, compiled)] = (max(first - steady, 0), steady / len(loader), buckets)
+
+    for (layer_name, compiled), (compile_time, step_time, buckets) in results.items():
+        name = f"{layer_name} {'compiled' if compiled else 'eager (before)'}"
+        compile_info = f"compile {compile_time:>6.1f} s, {buckets} buckets" if compiled else ""
+        print(f"{name:<30} {step_time * 1e3:>10.1f} ms/step   {compile_info}")
+    return results
@@ -4,7 +4,6 @@ import random
 import unicodedata
 from matplotlib import pyplot as plt
 import networkx as nx
-import xml.etree.ElementTree as ET
 import html
 import numpy as np
 import pandas as pd
@@ -12,6 +11,7 @@ from sklearn.preprocessing import PowerTransformer, RobustScaler
 import torch
 from tqdm import tqdm
 from utils import save, plot
+from preprocessing.XmlStream import iter_equations
 
 MATHML_TAGS = [
     "maction",
@@ -50,42 +50,14 @@ MATHML_TAGS = [
 
 def xml_occurences(xml_path="dataset/equations.xml", debug=False):
 
-
-    tree = ET.parse(xml_path)
-    root = tree.getroot()
-
     xml_tags = {}
     xml_texts = {}
 
-    def count_in_element(element):        
-        
-        if "math" in element.tag:
-            tag = rn(element.tag)
-            text = "" if element.text is None else element.text
-            xml_tags[tag] = xml_tags.get(tag, 0) + 1
-            xml_texts[text] = xml_texts.get(text, 0) + 1
-
-        for child in element:
-            tag = rn(child.tag)
-            text = "" if child.text is None else child.text
-            
-
-            xml_tags[tag] = xml_tags.get(tag, 0) + 1
-            xml_texts[text] = xml_texts.get(text, 0) + 1
-
-            children = [x for x in child]
-            if children:
-                count_in_element(child)
-
-
-
     # iterate over each XML equation
-    for i, formula in enumerate(tqdm(root,desc="Counting occurences",unit="equations")):
-        if debug and i>= 10:
-            break
-
-        # Run recursive function
-        count_in_element(formula)
+    for nodes in tqdm(iter_equations(xml_path, 10 if debug else None),desc="Counting occurences",unit="equations"):
+        for node in nodes:
+            xml_tags[node.tag] = xml_tags.get(node.tag, 0) + 1
+            xml_texts[node.text] = xml_texts.get(node.text, 0) + 1
     
     print("Number of different tags: ", len(xml_tags.keys()))
     print("Number of different labels: ",len(xml_texts.keys()))
@@ -96,24 +68,21 @@ def xml_occurences(xml_path="dataset/equations.xml", debug=False):
 
 def count_text_occurences_per_tag(xml_path="dataset/raw/cleaned_formulas_katex.xml", debug=False):
 
-    tree = ET.parse(xml_path)
-    root = tree.getroot()
     embedding_table = {tag:dict() for tag in MATHML_TAGS}
     vocab_table = {"":0,"<unk>":1}
 
     bad_things = {"numbers":0}
 
-    def find_in_element(element):    
-        
-        if "math" in element.tag:
-            tag = rn(element.tag)
-            text = "" if element.text is None else clean_text(element.text)
+    # iterate over each XML equation
+    for nodes in tqdm(iter_equations(xml_path, 10000 if debug else None),desc="Counting occurences",unit="equations"):
+        for node in nodes:
+            tag = node.tag
+            text = clean_text(node.text)
             embedding_table[tag][text] = embedding_table[tag].get(text,0) + 1
 
-
-        for child in element:
-            tag = rn(child.tag)
-            text = "" if child.text is None else clean_text(child.text)
+            # The <math> root is only counted
+            if node.parent == -1:
+                continue
 
             if tag=="mn":
                 try:
@@ -121,21 +90,8 @@ def count_text_occurences_per_tag(xml_path="dataset/raw/cleaned_formulas_katex.x
                 except:
                     bad_things["numbers"] +=1
 
-            embedding_table[tag][text] = embedding_table[tag].get(text,0) + 1
             if text not in vocab_table:
                 vocab_table[text] = len(vocab_table)
-
-            children = [x for x in child]
-            if children:
-                find_in_element(child)
-    
-    # iterate over each XML equation
-    for i, formula in enumerate(tqdm(root,desc="Counting occurences",unit="equations")):
-        if debug and i>= 10000:
-            break
-
-        # Run recursive function
-        find_in_element(formula)
     
     for tag,values in embedding_table.items():
         if len(values) > 1: